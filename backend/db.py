@@ -1,14 +1,368 @@
 import os
+import time
+import logging
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
 import psycopg2
+from psycopg2 import extensions
 from dotenv import load_dotenv
 
 load_dotenv()
 
+LOG = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the acquire timeout."""
+
+
+class PoolClosed(Exception):
+    """Raised when checking out a connection from a pool that has been closed."""
+
+
+def _conn_params() -> Dict[str, str]:
+    return {
+        "dbname": os.getenv("POSTGRES_DB", "med_db"),
+        "user": os.getenv("POSTGRES_USER", "med_user"),
+        "password": os.getenv("POSTGRES_PASSWORD", "med_pass"),
+        "host": os.getenv("POSTGRES_HOST", "database"),
+        "port": os.getenv("POSTGRES_PORT", "5432"),
+    }
+
+
+def get_conninfo() -> str:
+    return " ".join(f"{k}={v}" for k, v in _conn_params().items())
+
+
 def get_db_conn():
-    return psycopg2.connect(
-        dbname=os.getenv("POSTGRES_DB", "med_db"),
-        user=os.getenv("POSTGRES_USER", "med_user"),
-        password=os.getenv("POSTGRES_PASSWORD", "med_pass"),
-        host=os.getenv("POSTGRES_HOST", "database"),
-        port=os.getenv("POSTGRES_PORT", "5432")
-    )
+    """Open a dedicated, unpooled connection (scripts and LISTEN sessions).
+
+    Request handlers and tools should use ``get_pool().connection()`` instead.
+    """
+    return psycopg2.connect(**_conn_params())
+
+
+def vector_literal(vector) -> str:
+    """Render a vector as pgvector text ('[0.1,0.2,...]') for ``%s::vector`` parameters."""
+    return "[" + ",".join(repr(float(x)) for x in vector) + "]"
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    min_size: int = 1
+    max_size: int = 10
+    acquire_timeout: float = 10.0
+    # Idle connections older than this are pinged with SELECT 1 before reuse.
+    health_check_after: float = 30.0
+    max_lifetime: float = 3600.0
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        return cls(
+            min_size=int(os.getenv("POSTGRES_POOL_MIN_SIZE", cls.min_size)),
+            max_size=int(os.getenv("POSTGRES_POOL_MAX_SIZE", cls.max_size)),
+            acquire_timeout=float(os.getenv("POSTGRES_POOL_ACQUIRE_TIMEOUT", cls.acquire_timeout)),
+            health_check_after=float(os.getenv("POSTGRES_POOL_HEALTH_CHECK_AFTER", cls.health_check_after)),
+            max_lifetime=float(os.getenv("POSTGRES_POOL_MAX_LIFETIME", cls.max_lifetime)),
+        )
+
+
+class PoolStats:
+    """Counters shared by the sync and async pools."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.acquire_timeouts = 0
+        self.connections_opened = 0
+        self.connections_discarded = 0
+        self.failed_health_checks = 0
+        self.acquire_seconds_total = 0.0
+        self.acquire_seconds_max = 0.0
+
+    def incr(self, name: str, by: int = 1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + by)
+
+    def record_acquire(self, seconds: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.acquire_seconds_total += seconds
+            self.acquire_seconds_max = max(self.acquire_seconds_max, seconds)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            avg = self.acquire_seconds_total / self.checkouts if self.checkouts else 0.0
+            return {
+                "checkouts": self.checkouts,
+                "acquire_timeouts": self.acquire_timeouts,
+                "connections_opened": self.connections_opened,
+                "connections_discarded": self.connections_discarded,
+                "failed_health_checks": self.failed_health_checks,
+                "acquire_ms_avg": round(avg * 1000.0, 3),
+                "acquire_ms_max": round(self.acquire_seconds_max * 1000.0, 3),
+            }
+
+
+class _Slot:
+    __slots__ = ("conn", "created_at", "last_used")
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool with bounded size and health checks."""
+
+    def __init__(self, cfg: Optional[PoolConfig] = None, connect=None):
+        self.cfg = cfg or PoolConfig.from_env()
+        self.stats = PoolStats()
+        self._connect = connect or get_db_conn
+        self._cond = threading.Condition()
+        self._idle: List[_Slot] = []
+        self._slots: Dict[int, _Slot] = {}
+        self._size = 0
+        self._closed = False
+
+        for _ in range(self.cfg.min_size):
+            try:
+                slot = self._open()
+            except Exception as e:
+                LOG.warning("db pool prefill failed: %s", e)
+                break
+            with self._cond:
+                self._size += 1
+                self._idle.append(slot)
+
+    def _open(self) -> _Slot:
+        slot = _Slot(self._connect())
+        self._slots[id(slot.conn)] = slot
+        self.stats.incr("connections_opened")
+        return slot
+
+    def _discard(self, slot: _Slot) -> None:
+        self._slots.pop(id(slot.conn), None)
+        try:
+            slot.conn.close()
+        except Exception:
+            pass
+        self.stats.incr("connections_discarded")
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _healthy(self, slot: _Slot) -> bool:
+        if slot.conn.closed:
+            return False
+        now = time.monotonic()
+        if now - slot.created_at > self.cfg.max_lifetime:
+            return False
+        if now - slot.last_used < self.cfg.health_check_after:
+            return True
+        try:
+            with slot.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            slot.conn.rollback()
+            return True
+        except Exception:
+            self.stats.incr("failed_health_checks")
+            return False
+
+    def getconn(self, timeout: Optional[float] = None):
+        timeout = self.cfg.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        while True:
+            slot = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolClosed("connection pool is closed")
+                    if self._idle:
+                        slot = self._idle.pop()
+                        break
+                    if self._size < self.cfg.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats.incr("acquire_timeouts")
+                        raise PoolTimeout(
+                            f"no connection available after {timeout:.1f}s "
+                            f"(max_size={self.cfg.max_size})"
+                        )
+                    self._cond.wait(remaining)
+
+            if slot is None:
+                try:
+                    slot = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(slot):
+                self._discard(slot)
+                continue
+
+            self.stats.record_acquire(time.monotonic() - start)
+            return slot.conn
+
+    def putconn(self, conn) -> None:
+        slot = self._slots.get(id(conn))
+        if slot is None:
+            raise ValueError("connection does not belong to this pool")
+
+        if conn.closed or self._closed:
+            self._discard(slot)
+            return
+
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except Exception:
+            self._discard(slot)
+            return
+
+        slot.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(slot)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """Check out a connection; commit on success, roll back on error, then return it."""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+            if not conn.closed and not conn.autocommit:
+                conn.commit()
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            sizes = {"pool_size": self._size, "pool_available": len(self._idle)}
+        return {**sizes, "pool_min": self.cfg.min_size, "pool_max": self.cfg.max_size, **self.stats.as_dict()}
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for slot in idle:
+            self._discard(slot)
+
+
+class AsyncConnectionPool:
+    """asyncio front-end backed by psycopg3's ``psycopg_pool.AsyncConnectionPool``."""
+
+    def __init__(self, cfg: Optional[PoolConfig] = None):
+        from psycopg_pool import AsyncConnectionPool as _PsycopgAsyncPool
+
+        self.cfg = cfg or PoolConfig.from_env()
+        self.stats = PoolStats()
+        self._pool = _PsycopgAsyncPool(
+            conninfo=get_conninfo(),
+            min_size=self.cfg.min_size,
+            max_size=self.cfg.max_size,
+            timeout=self.cfg.acquire_timeout,
+            max_lifetime=self.cfg.max_lifetime,
+            check=_PsycopgAsyncPool.check_connection,
+            open=False,
+        )
+
+    async def open(self) -> None:
+        await self._pool.open()
+
+    @asynccontextmanager
+    async def connection(self, timeout: Optional[float] = None):
+        from psycopg_pool import PoolTimeout as _PsycopgPoolTimeout
+
+        start = time.monotonic()
+        acquired = False
+        try:
+            async with self._pool.connection(timeout=timeout) as conn:
+                acquired = True
+                self.stats.record_acquire(time.monotonic() - start)
+                yield conn
+        except _PsycopgPoolTimeout as e:
+            if acquired:
+                raise
+            self.stats.incr("acquire_timeouts")
+            raise PoolTimeout(str(e)) from e
+
+    def get_stats(self) -> Dict[str, Any]:
+        s = self._pool.get_stats()
+        stats = self.stats.as_dict()
+        stats["connections_opened"] = s.get("connections_num", 0)
+        stats["connections_discarded"] = s.get("connections_lost", 0)
+        return {
+            "pool_size": s.get("pool_size", 0),
+            "pool_available": s.get("pool_available", 0),
+            "pool_min": self.cfg.min_size,
+            "pool_max": self.cfg.max_size,
+            **stats,
+        }
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+
+_pool: Optional[ConnectionPool] = None
+_async_pool: Optional[AsyncConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+async def get_async_pool() -> AsyncConnectionPool:
+    global _async_pool
+    if _async_pool is None:
+        pool = AsyncConnectionPool()
+        await pool.open()
+        if _async_pool is None:
+            _async_pool = pool
+        else:
+            await pool.close()
+    return _async_pool
+
+
+def pool_stats() -> Dict[str, Any]:
+    return {
+        "sync": _pool.get_stats() if _pool else None,
+        "async": _async_pool.get_stats() if _async_pool else None,
+    }
+
+
+async def close_pools() -> None:
+    global _pool, _async_pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
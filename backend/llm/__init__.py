@@ -1,2 +1,34 @@
 # llm/__init__.py
 
+
+# === OpenAI Chat API (async) ===
+async def aopenai_chat_stream_v2(
+    messages,
+    api_key: str,
+    model: str = "gpt-3.5-turbo",
+    temperature: float = 0.7,
+    max_tokens: int = 1024
+):
+    """
+    Async streaming OpenAI chat (yields text chunks).
+    """
+    from llm.async_client import get_openai_client
+    async for chunk in get_openai_client(api_key).chat_stream(
+        messages, model=model, temperature=temperature, max_tokens=max_tokens
+    ):
+        yield chunk
+
+async def aopenai_chat_v2(
+    messages,
+    api_key: str,
+    model: str = "gpt-3.5-turbo",
+    temperature: float = 0.7,
+    max_tokens: int = 1024
+):
+    """
+    Async non-streaming OpenAI chat (returns full response).
+    """
+    from llm.async_client import get_openai_client
+    return await get_openai_client(api_key).chat(
+        messages, model=model, temperature=temperature, max_tokens=max_tokens
+    )
@@ -0,0 +1,222 @@
+# llm/agent.py
+"""
+Multi-step ReAct agent loop.
+
+Each step sends the question plus the transcript so far to the model, which answers
+with the JSON schema from utils/prompt.build_agent_prompt. Tool calls requested in
+the same step ("actions") are independent by contract and run concurrently; their
+observations are fed back in the next step. The loop ends when the model sets
+"finalized", answers without calling a tool, or AGENT_MAX_STEPS is reached.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from llm.cohere_chat import acohere_chat
+from tools.registry import AGENT_TOOL_NAMES, ToolRegistry, registry as default_registry
+from utils.prompt import build_agent_messages
+
+LOG = logging.getLogger(__name__)
+
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "5"))
+# Steps are sampled at temperature 0: tool choice should not vary between identical runs,
+# and deterministic calls are served from the LLM response cache (llm/response_cache.py),
+# so a repeated question with unchanged observations costs no model calls.
+AGENT_TEMPERATURE = float(os.getenv("AGENT_TEMPERATURE", "0"))
+# Observations are fed back to the model, so keep them to a sane size.
+AGENT_MAX_OBSERVATION_CHARS = int(os.getenv("AGENT_MAX_OBSERVATION_CHARS", "4000"))
+
+# Arguments the agent adds unless the model sets them: charts come back as links
+# (rendered only if someone opens them) rather than inline images the model cannot use.
+AGENT_TOOL_DEFAULTS: Dict[str, Dict[str, Any]] = {"templated_query_tool": {"chart_format": "url"}}
+
+
+@dataclass
+class ToolCall:
+    tool: str
+    input: Dict[str, Any]
+    observation: Any = None
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+
+@dataclass
+class AgentStep:
+    index: int
+    thought: str = ""
+    calls: List[ToolCall] = field(default_factory=list)
+    llm_seconds: float = 0.0
+    tool_seconds: float = 0.0
+
+
+@dataclass
+class AgentResult:
+    response: str
+    finalized: bool
+    steps: List[AgentStep] = field(default_factory=list)
+    seconds: float = 0.0
+
+    def tools_called(self) -> List[str]:
+        """Names of the tools the agent called, in first-call order."""
+        return list(dict.fromkeys(c.tool for s in self.steps for c in s.calls))
+
+    def timings(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "step": s.index,
+                "llm_seconds": round(s.llm_seconds, 3),
+                "tool_seconds": round(s.tool_seconds, 3),
+                "tools": [{"tool": c.tool, "seconds": round(c.seconds, 3), "error": c.error} for c in s.calls],
+            }
+            for s in self.steps
+        ]
+
+
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+
+def parse_model_output(text: str) -> Optional[Dict[str, Any]]:
+    """The JSON object in a model reply (tolerates code fences and surrounding prose)."""
+    text = _FENCE.sub("", text.strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _as_input(raw) -> Dict[str, Any]:
+    if isinstance(raw, dict):
+        return raw
+    if isinstance(raw, str):
+        try:
+            parsed = json.loads(raw)
+            if isinstance(parsed, dict):
+                return parsed
+        except ValueError:
+            pass
+        return {"query": raw} if raw else {}
+    return {}
+
+
+def requested_calls(data: Dict[str, Any]) -> List[ToolCall]:
+    """Tool calls in a model reply: "actions" list, or a single tool_name/tool + input/action."""
+    calls = []
+    for a in data.get("actions") or []:
+        if isinstance(a, dict) and (a.get("tool") or a.get("tool_name")):
+            calls.append(ToolCall(a.get("tool") or a.get("tool_name"), _as_input(a.get("input", {}))))
+    if not calls:
+        name = data.get("tool_name") or data.get("tool")
+        if name:
+            calls.append(ToolCall(name, _as_input(data.get("input", data.get("action")))))
+    return calls
+
+
+def _for_model(observation: Any) -> Any:
+    # Inline chart images and specs are for the UI; the model only needs to know one exists,
+    # or the link it can pass on.
+    if isinstance(observation, dict) and observation.get("chart"):
+        chart = observation["chart"]
+        if isinstance(chart, dict) and chart.get("png_url"):
+            return {**observation, "chart": chart["png_url"]}
+        return {**observation, "chart": "[chart generated]"}
+    return observation
+
+
+def _clip(observation: Any) -> str:
+    observation = _for_model(observation)
+    text = observation if isinstance(observation, str) else json.dumps(observation, default=str)
+    if len(text) > AGENT_MAX_OBSERVATION_CHARS:
+        return text[:AGENT_MAX_OBSERVATION_CHARS] + " ...[truncated]"
+    return text
+
+
+async def run_tool(call: ToolCall, tools: List[str], registry: ToolRegistry) -> ToolCall:
+    started = time.perf_counter()
+    try:
+        if call.tool not in tools:
+            raise ValueError(f"Unknown tool: {call.tool}")
+        # The registry runs the tool on its pool with its own timeout and limits.
+        kwargs = {**AGENT_TOOL_DEFAULTS.get(call.tool, {}), **call.input}
+        call.observation = await registry.call(call.tool, **kwargs)
+    except Exception as e:
+        call.error = f"{type(e).__name__}: {e}"
+        call.observation = f"[Tool Error] {call.error}"
+    call.seconds = time.perf_counter() - started
+    return call
+
+
+async def run_agent(
+    query: str,
+    max_steps: Optional[int] = None,
+    tools: Optional[List[str]] = None,
+    registry: Optional[ToolRegistry] = None,
+) -> AgentResult:
+    tools = tools or AGENT_TOOL_NAMES
+    registry = registry or default_registry
+    max_steps = max_steps or AGENT_MAX_STEPS
+    started = time.perf_counter()
+    history: List[Dict[str, str]] = []
+    steps: List[AgentStep] = []
+    last_thought = ""
+
+    for index in range(1, max_steps + 1):
+        step = AgentStep(index)
+        steps.append(step)
+        t0 = time.perf_counter()
+        reply = await acohere_chat(
+            build_agent_messages(query, history=history, enabled_tools=list(tools)),
+            temperature=AGENT_TEMPERATURE,
+        )
+        step.llm_seconds = time.perf_counter() - t0
+
+        data = parse_model_output(reply)
+        if data is None:
+            # Plain-text reply: treat it as the answer.
+            return AgentResult(reply.strip(), True, steps, time.perf_counter() - started)
+        step.thought = str(data.get("thought") or "")
+        last_thought = step.thought or last_thought
+        calls = requested_calls(data)
+        if data.get("finalized") or not calls:
+            answer = data.get("response") or step.thought or reply
+            return AgentResult(str(answer), bool(data.get("finalized")), steps, time.perf_counter() - started)
+
+        t0 = time.perf_counter()
+        step.calls = list(await asyncio.gather(*(run_tool(c, tools, registry) for c in calls)))
+        step.tool_seconds = time.perf_counter() - t0
+        LOG.info(
+            "agent step %d: llm %.2fs, %d tool(s) in %.2fs (%s)",
+            index, step.llm_seconds, len(step.calls), step.tool_seconds,
+            ", ".join(f"{c.tool} {c.seconds:.2f}s" for c in step.calls),
+        )
+
+        history.append({"role": "assistant", "content": reply})
+        history.append({
+            "role": "user",
+            "content": "Observations:\n" + "\n".join(f"[{c.tool}] {_clip(c.observation)}" for c in step.calls),
+        })
+
+    LOG.warning("agent stopped after %d steps without a final answer", max_steps)
+    return AgentResult(last_thought or "I could not finish within the step limit.", False, steps,
+                       time.perf_counter() - started)
+
+
+def agent_result_dict(result: AgentResult) -> Dict[str, Any]:
+    return {
+        "response": result.response,
+        "finalized": result.finalized,
+        "seconds": round(result.seconds, 3),
+        "tools": result.tools_called(),
+        "steps": result.timings(),
+    }
@@ -0,0 +1,311 @@
+# llm/async_client.py
+"""
+Async LLM clients with a shared HTTP connection pool per provider, a per-provider
+concurrency limit, request timeouts and retries with jittered exponential backoff
+on 429/5xx and transport errors.
+"""
+
+import os
+import random
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+LOG = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMProviderError(Exception):
+    """An LLM call failed after exhausting its retries (or with a non-retryable error)."""
+
+    def __init__(self, provider: str, message: str, status_code: Optional[int] = None):
+        super().__init__(f"[{provider}] {message}")
+        self.provider = provider
+        self.status_code = status_code
+
+
+@dataclass(frozen=True)
+class LLMClientConfig:
+    max_concurrency: int = 8
+    timeout_seconds: float = 60.0
+    max_retries: int = 3
+    backoff_base_seconds: float = 0.5
+    backoff_max_seconds: float = 8.0
+    max_connections: int = 20
+
+    @classmethod
+    def from_env(cls, prefix: str) -> "LLMClientConfig":
+        env = lambda name, default: os.getenv(f"{prefix}_{name}", default)
+        return cls(
+            max_concurrency=int(env("MAX_CONCURRENCY", cls.max_concurrency)),
+            timeout_seconds=float(env("TIMEOUT_SECONDS", cls.timeout_seconds)),
+            max_retries=int(env("MAX_RETRIES", cls.max_retries)),
+            backoff_base_seconds=float(env("BACKOFF_BASE_SECONDS", cls.backoff_base_seconds)),
+            backoff_max_seconds=float(env("BACKOFF_MAX_SECONDS", cls.backoff_max_seconds)),
+            max_connections=int(env("MAX_CONNECTIONS", cls.max_connections)),
+        )
+
+
+def status_code_of(exc: BaseException) -> Optional[int]:
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        code = getattr(getattr(exc, "response", None), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AsyncLLMClient:
+    provider = "llm"
+
+    def __init__(self, cfg: Optional[LLMClientConfig] = None):
+        self.cfg = cfg or LLMClientConfig()
+        self._sem = asyncio.Semaphore(self.cfg.max_concurrency)
+        self._http: Optional[httpx.AsyncClient] = None
+        self.counters: Dict[str, int] = {"calls": 0, "retries": 0, "failures": 0, "in_flight": 0}
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            limits = httpx.Limits(
+                max_connections=self.cfg.max_connections,
+                max_keepalive_connections=self.cfg.max_connections,
+            )
+            self._http = httpx.AsyncClient(limits=limits, timeout=self.cfg.timeout_seconds)
+        return self._http
+
+    def _retryable(self, exc: BaseException) -> bool:
+        if isinstance(exc, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+            return True
+        return status_code_of(exc) in RETRYABLE_STATUS
+
+    def _fail(self, exc: BaseException) -> LLMProviderError:
+        self.counters["failures"] += 1
+        if isinstance(exc, asyncio.TimeoutError):
+            return LLMProviderError(self.provider, f"timed out after {self.cfg.timeout_seconds}s")
+        return LLMProviderError(self.provider, str(exc) or type(exc).__name__, status_code_of(exc))
+
+    async def _backoff(self, attempt: int, exc: BaseException) -> None:
+        delay = backoff_delay(attempt, self.cfg.backoff_base_seconds, self.cfg.backoff_max_seconds)
+        self.counters["retries"] += 1
+        LOG.warning("%s call failed (%s); retry %d in %.2fs", self.provider, exc, attempt + 1, delay)
+        await asyncio.sleep(delay)
+
+    async def _complete(self, messages, model: str, temperature: float, max_tokens: int) -> str:
+        raise NotImplementedError
+
+    def _stream(self, messages, model: str, temperature: float, max_tokens: int) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def chat(self, messages, model: str, temperature: float = 0.7, max_tokens: int = 1024) -> str:
+        attempt = 0
+        async with self._sem:
+            self.counters["calls"] += 1
+            self.counters["in_flight"] += 1
+            try:
+                while True:
+                    try:
+                        return await asyncio.wait_for(
+                            self._complete(messages, model, temperature, max_tokens),
+                            timeout=self.cfg.timeout_seconds,
+                        )
+                    except Exception as e:
+                        if attempt >= self.cfg.max_retries or not self._retryable(e):
+                            raise self._fail(e) from e
+                        await self._backoff(attempt, e)
+                        attempt += 1
+            finally:
+                self.counters["in_flight"] -= 1
+
+    async def chat_stream(
+        self, messages, model: str, temperature: float = 0.7, max_tokens: int = 1024
+    ) -> AsyncIterator[str]:
+        # The concurrency slot is held for the whole stream. Retries only happen before
+        # the first chunk; after that a failure is surfaced to the caller.
+        attempt = 0
+        async with self._sem:
+            self.counters["calls"] += 1
+            self.counters["in_flight"] += 1
+            try:
+                while True:
+                    emitted = False
+                    try:
+                        async for chunk in self._stream(messages, model, temperature, max_tokens):
+                            emitted = True
+                            yield chunk
+                        return
+                    except Exception as e:
+                        if emitted or attempt >= self.cfg.max_retries or not self._retryable(e):
+                            raise self._fail(e) from e
+                        await self._backoff(attempt, e)
+                        attempt += 1
+            finally:
+                self.counters["in_flight"] -= 1
+
+    def stats(self) -> Dict[str, object]:
+        return {"provider": self.provider, "max_concurrency": self.cfg.max_concurrency, **self.counters}
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+def last_user_message(messages) -> str:
+    """Cohere's v5 chat takes a single message string: use the last user turn."""
+    if isinstance(messages, list):
+        user_messages = [m for m in messages if m.get("role", "").lower() == "user"]
+        if user_messages:
+            return user_messages[-1].get("message") or user_messages[-1].get("content")
+        return str(messages[-1]) if messages else ""
+    return str(messages)
+
+
+def cohere_history_kwargs(messages) -> Dict[str, object]:
+    """
+    Earlier user/assistant turns as Cohere chat_history (the last user turn is the
+    message itself). Empty when there is no history, so simple prompts are sent as before.
+    """
+    if not isinstance(messages, list):
+        return {}
+    last_user = max((i for i, m in enumerate(messages) if m.get("role", "").lower() == "user"), default=-1)
+    roles = {"user": "USER", "assistant": "CHATBOT", "chatbot": "CHATBOT"}
+    history = [
+        {"role": roles[m.get("role", "").lower()], "message": m.get("message") or m.get("content") or ""}
+        for m in messages[:max(last_user, 0)]
+        if m.get("role", "").lower() in roles
+    ]
+    return {"chat_history": history} if history else {}
+
+
+class AsyncCohereClient(AsyncLLMClient):
+    provider = "cohere"
+
+    def __init__(self, api_key: Optional[str] = None, cfg: Optional[LLMClientConfig] = None):
+        super().__init__(cfg or LLMClientConfig.from_env("COHERE"))
+        self.api_key = api_key or os.getenv("COHERE_API_KEY")
+        self._sdk = None
+
+    @property
+    def sdk(self):
+        if self._sdk is None:
+            import cohere
+            self._sdk = cohere.AsyncClient(
+                api_key=self.api_key,
+                timeout=self.cfg.timeout_seconds,
+                httpx_client=self.http,
+            )
+        return self._sdk
+
+    async def _complete(self, messages, model, temperature, max_tokens) -> str:
+        resp = await self.sdk.chat(
+            model=model,
+            message=last_user_message(messages),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **cohere_history_kwargs(messages),
+        )
+        return resp.text
+
+    async def _stream(self, messages, model, temperature, max_tokens):
+        stream = self.sdk.chat_stream(
+            model=model,
+            message=last_user_message(messages),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **cohere_history_kwargs(messages),
+        )
+        async for event in stream:
+            if event.event_type == "text-generation":
+                yield event.text
+
+
+class AsyncOpenAIClient(AsyncLLMClient):
+    provider = "openai"
+
+    def __init__(self, api_key: Optional[str] = None, cfg: Optional[LLMClientConfig] = None):
+        super().__init__(cfg or LLMClientConfig.from_env("OPENAI"))
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self._sdk = None
+
+    @property
+    def sdk(self):
+        if self._sdk is None:
+            import openai
+            # Retries are handled here (with jitter and the shared semaphore), not by the SDK.
+            self._sdk = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                http_client=self.http,
+                timeout=self.cfg.timeout_seconds,
+                max_retries=0,
+            )
+        return self._sdk
+
+    def _retryable(self, exc: BaseException) -> bool:
+        import openai
+        if isinstance(exc, openai.APIConnectionError):
+            return True
+        return super()._retryable(exc)
+
+    async def _complete(self, messages, model, temperature, max_tokens) -> str:
+        resp = await self.sdk.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        return (resp.choices[0].message.content or "").strip()
+
+    async def _stream(self, messages, model, temperature, max_tokens):
+        stream = await self.sdk.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+_clients: Dict[tuple, AsyncLLMClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_cohere_client() -> AsyncCohereClient:
+    with _clients_lock:
+        key = ("cohere", None)
+        if key not in _clients:
+            _clients[key] = AsyncCohereClient()
+        return _clients[key]
+
+
+def get_openai_client(api_key: Optional[str] = None) -> AsyncOpenAIClient:
+    with _clients_lock:
+        key = ("openai", api_key)
+        if key not in _clients:
+            _clients[key] = AsyncOpenAIClient(api_key=api_key)
+        return _clients[key]
+
+
+def llm_client_stats() -> List[Dict[str, object]]:
+    with _clients_lock:
+        clients = list(_clients.values())
+    return [c.stats() for c in clients]
+
+
+async def close_llm_clients() -> None:
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for c in clients:
+        await c.aclose()
@@ -50,6 +50,8 @@ def openai_chat_v2(
 # llm/cohere_chat.py
 import os
 import cohere
+from llm.async_client import get_cohere_client, last_user_message, cohere_history_kwargs
+from llm.response_cache import cached_call, acached_call
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 co = cohere.Client(COHERE_API_KEY)
 
@@ -57,7 +59,8 @@ def cohere_chat(
     messages,
     model="command-r-plus-08-2024",
     temperature=0.7,
-    max_tokens=1024
+    max_tokens=1024,
+    cache=None
 ):
     """
     Call Cohere's chat endpoint using the latest Cohere v5 API.
@@ -68,29 +71,26 @@ def cohere_chat(
         {"role": "user", "content": "Hello"},
         {"role": "assistant", "content": "Hi!"}
     ]
+
+    Responses are served from the LLM response cache when temperature == 0,
+    or when cache=True; cache=False always calls the API.
     """
 
 
-    # If messages is a list, extract the last user message string
-    if isinstance(messages, list):
-        # Find the last user message
-        user_messages = [m for m in messages if m.get("role", "").lower() == "user"]
-        if user_messages:
-            message = user_messages[-1].get("message") or user_messages[-1].get("content")
-        else:
-            message = str(messages[-1]) if messages else ""
-    else:
-        message = str(messages)
+    message = last_user_message(messages)
 
-    resp = co.chat(
-        model=model,
-        message=message,
-        temperature=temperature,
-        max_tokens=max_tokens,
-    )
+    def call():
+        resp = co.chat(
+            model=model,
+            message=message,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **cohere_history_kwargs(messages),
+        )
+        # Cohere v5 returns text in resp.text for non-streamed chat
+        return resp.text
 
-    # Cohere v5 returns text in resp.text for non-streamed chat
-    return resp.text
+    return cached_call("cohere", messages, model, temperature, max_tokens, cache, call)
 
 
 # --------------------------------------------
@@ -108,23 +108,53 @@ def cohere_chat_stream(
     """
 
 
-    # If messages is a list, extract the last user message string
-    if isinstance(messages, list):
-        user_messages = [m for m in messages if m.get("role", "").lower() == "user"]
-        if user_messages:
-            message = user_messages[-1].get("message") or user_messages[-1].get("content")
-        else:
-            message = str(messages[-1]) if messages else ""
-    else:
-        message = str(messages)
+    message = last_user_message(messages)
 
     stream = co.chat_stream(
         model=model,
         message=message,
         temperature=temperature,
         max_tokens=max_tokens,
+        **cohere_history_kwargs(messages),
     )
 
     for event in stream:
         if event.event_type == "text-generation":
             yield event.text
+
+
+# --------------------------------------------
+# 4. Async versions (shared pool, bounded concurrency, retries)
+# --------------------------------------------
+async def acohere_chat(
+    messages,
+    model="command-r-plus-08-2024",
+    temperature=0.7,
+    max_tokens=1024,
+    cache=None
+):
+    """
+    Async counterpart of cohere_chat(); does not block the event loop.
+    """
+    return await acached_call(
+        "cohere", messages, model, temperature, max_tokens, cache,
+        lambda: get_cohere_client().chat(
+            messages, model=model, temperature=temperature, max_tokens=max_tokens
+        ),
+    )
+
+
+async def acohere_chat_stream(
+    messages,
+    model="command-r-plus-08-2024",
+    temperature=0.7,
+    max_tokens=1024
+):
+    """
+    Async streaming chat generation.
+    Yields each chunk of text as it arrives.
+    """
+    async for chunk in get_cohere_client().chat_stream(
+        messages, model=model, temperature=temperature, max_tokens=max_tokens
+    ):
+        yield chunk
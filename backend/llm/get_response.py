@@ -1,30 +1,32 @@
 import json
-from tools.duckduckgo_tool import web_search_tool
-from tools.email_tool import send_email
-from tools.templated_query_tool import templated_query_tool
-from tools.rag_tool import rag_tool
+from llm.agent import agent_result_dict, run_agent
+from tools.registry import AGENT_TOOL_NAMES, registry
 
-def get_response(prompt: str) -> str:
-    # Call LLM (simulate for now)
-    # In real use, this would call cohere_chat or similar
+def _direct_tool_call(prompt: str):
+    # A prompt that is itself a tool call ({"action": name, "input": {...}}) runs that tool only.
     try:
         response = json.loads(prompt) if prompt.strip().startswith('{') else None
     except Exception:
         response = None
+    if isinstance(response, dict) and response.get('action'):
+        return response
+    return None
 
-    if response and 'action' in response and response['action']:
-        tool_name = response['action']
-        tool_input = response.get('input', {})
-        if tool_name == 'web_search_tool':
-            obs = web_search_tool(**tool_input)
-        elif tool_name == 'send_email':
-            obs = send_email(**tool_input)
-        elif tool_name == 'templated_query_tool':
-            obs = templated_query_tool(**tool_input)
-        elif tool_name == 'rag_tool':
-            obs = rag_tool(**tool_input)
-        else:
-            obs = f"Unknown tool: {tool_name}"
-        response['observation'] = obs
-        return json.dumps(response)
-    return f"Echo: {prompt}"
+async def _run_direct(response: dict) -> str:
+    tool_name = response['action']
+    tool_input = response.get('input', {})
+    if tool_name not in AGENT_TOOL_NAMES:
+        obs = f"Unknown tool: {tool_name}"
+    else:
+        obs = await registry.call(tool_name, **tool_input)
+    response['observation'] = obs
+    return json.dumps(response, default=str)
+
+async def aget_response(prompt: str) -> dict:
+    """
+    Answer a prompt with the ReAct agent; returns the answer plus per-step timings.
+    """
+    direct = _direct_tool_call(prompt)
+    if direct is not None:
+        return {"response": await _run_direct(direct)}
+    return agent_result_dict(await run_agent(prompt))
@@ -0,0 +1,273 @@
+# llm/response_cache.py
+"""
+Response cache for LLM chat calls.
+
+Entries are keyed on (provider, model, temperature, max_tokens, normalized messages),
+expire after a TTL and are bounded in number (least recently used first out).
+Identical concurrent calls are coalesced: the first caller goes upstream and the
+others wait for its result, so N simultaneous identical prompts cost one call.
+
+Only deterministic calls (temperature == 0) are cached by default; pass
+``cache=True`` to opt a sampled call in, or ``cache=False`` to bypass the cache.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_messages(messages) -> list:
+    """Whitespace-insensitive, role-lowercased copy of a chat message list."""
+    if not isinstance(messages, list):
+        return [{"role": "user", "content": _WS.sub(" ", str(messages)).strip()}]
+    normalized = []
+    for m in messages:
+        if not isinstance(m, dict):
+            normalized.append({"role": "user", "content": _WS.sub(" ", str(m)).strip()})
+            continue
+        content = m.get("content", m.get("message", ""))
+        normalized.append({
+            "role": str(m.get("role", "user")).lower(),
+            "content": _WS.sub(" ", str(content)).strip(),
+        })
+    return normalized
+
+
+def cache_key(provider: str, model: str, temperature: float, max_tokens: int, messages) -> str:
+    raw = json.dumps(
+        [provider, model, float(temperature), int(max_tokens), normalize_messages(messages)],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Entry:
+    value: str
+    expires_at: float
+    # How long the upstream call took; every hit saves roughly this much.
+    latency: float
+
+
+class _LeaderCancelled(Exception):
+    """The coalescing leader was cancelled before it produced a result."""
+
+
+class _Flight:
+    """A sync call in progress that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._aflights: Dict[str, asyncio.Future] = {}
+        self.counters: Dict[str, Any] = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "bypassed": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "saved_latency_seconds": 0.0,
+        }
+
+    @staticmethod
+    def enabled_for(temperature: float, cache: Optional[bool]) -> bool:
+        if cache is None:
+            return temperature == 0
+        return cache
+
+    def _lookup(self, key: str) -> Optional[str]:
+        # Caller holds self._lock.
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            self.counters["expirations"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        self.counters["saved_latency_seconds"] += entry.latency
+        return entry.value
+
+    def _store(self, key: str, value: str, latency: float) -> None:
+        # Caller holds self._lock.
+        self._entries[key] = _Entry(value, time.monotonic() + self.ttl_seconds, latency)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _coalesced(self, key: str) -> None:
+        # Caller holds self._lock.
+        self.counters["coalesced"] += 1
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.counters["saved_latency_seconds"] += entry.latency
+
+    def get_or_call(self, key: str, call: Callable[[], str]) -> str:
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.counters["misses"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            with self._lock:
+                self._coalesced(key)
+            return flight.value
+
+        started = time.monotonic()
+        try:
+            flight.value = call()
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._store(key, flight.value, time.monotonic() - started)
+            return flight.value
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    async def aget_or_call(self, key: str, call: Callable[[], Awaitable[str]]) -> str:
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            future = self._aflights.get(key)
+            leader = future is None
+            if leader:
+                future = self._aflights[key] = asyncio.get_running_loop().create_future()
+                self.counters["misses"] += 1
+
+        if not leader:
+            # shield(): a waiter being cancelled must not cancel the shared result.
+            try:
+                value = await asyncio.shield(future)
+            except _LeaderCancelled:
+                return await self.aget_or_call(key, call)
+            with self._lock:
+                self._coalesced(key)
+            return value
+
+        started = time.monotonic()
+        try:
+            value = await call()
+        except BaseException as e:
+            # Waiters retry on their own if the leader was cancelled (e.g. client disconnect).
+            future.set_exception(_LeaderCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            # Mark retrieved so an unobserved failure does not log a warning.
+            future.exception()
+            raise
+        else:
+            with self._lock:
+                self._store(key, value, time.monotonic() - started)
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._aflights.pop(key, None)
+
+    def bypass(self) -> None:
+        with self._lock:
+            self.counters["bypassed"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["misses"] + counters["coalesced"]
+        served = counters["hits"] + counters["coalesced"]
+        counters["saved_latency_seconds"] = round(counters["saved_latency_seconds"], 3)
+        return {
+            "entries": size,
+            "capacity": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hit_ratio": round(served / lookups, 4) if lookups else 0.0,
+            **counters,
+        }
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Process-wide cache from LLM_RESPONSE_CACHE_* settings; LLM_RESPONSE_CACHE_SIZE=0 disables it."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            size = int(os.getenv("LLM_RESPONSE_CACHE_SIZE", "1024"))
+            if size <= 0:
+                return None
+            ttl = float(os.getenv("LLM_RESPONSE_CACHE_TTL_SECONDS", "300"))
+            _cache = ResponseCache(max_entries=size, ttl_seconds=ttl)
+        return _cache
+
+
+def _plan(provider, messages, model, temperature, max_tokens, cache) -> Tuple[Optional[ResponseCache], str]:
+    rc = get_response_cache()
+    if rc is None:
+        return None, ""
+    if not rc.enabled_for(temperature, cache):
+        rc.bypass()
+        return None, ""
+    return rc, cache_key(provider, model, temperature, max_tokens, messages)
+
+
+def cached_call(provider, messages, model, temperature, max_tokens, cache, call: Callable[[], str]) -> str:
+    rc, key = _plan(provider, messages, model, temperature, max_tokens, cache)
+    if rc is None:
+        return call()
+    return rc.get_or_call(key, call)
+
+
+async def acached_call(
+    provider, messages, model, temperature, max_tokens, cache, call: Callable[[], Awaitable[str]]
+) -> str:
+    rc, key = _plan(provider, messages, model, temperature, max_tokens, cache)
+    if rc is None:
+        return await call()
+    return await rc.aget_or_call(key, call)
+
+
+def llm_response_cache_stats() -> Optional[Dict[str, object]]:
+    with _cache_lock:
+        rc = _cache
+    return rc.stats() if rc is not None else None
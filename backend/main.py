@@ -2,15 +2,40 @@
 # Entry point for the backend React agent project
 
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes.agent import agent_router
+from db import close_pools
+from llm.async_client import close_llm_clients
+from tools.registry import registry as tool_registry
+from tools.web_tool import close_web_search
+from tools.email_queue import close_mailer
+from tools.rag_tool import preload_embedding_tokenizer
+from utils.prompt import preload_prompt_tokenizer
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the chart-rendering workers before the first request needs one.
+    tool_registry.prewarm()
+    # Download the prompt and embedding tokenizers off the event loop; token counts
+    # (prompt budgets, embedding batch packing) are estimated until they are ready.
+    preload_prompt_tokenizer()
+    preload_embedding_tokenizer()
+    yield
+    tool_registry.shutdown()
+    await close_web_search()
+    await close_mailer()
+    await close_llm_clients()
+    await close_pools()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow all origins for development (change in production)
 app.add_middleware(
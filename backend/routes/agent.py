@@ -1,13 +1,35 @@
 from fastapi import APIRouter
-from llm.get_response import get_response
+from llm.get_response import aget_response
+from tools.registry import SIDE_EFFECT_TOOLS
+from utils.semantic_cache import get_semantic_cache
+from utils.table_deps import collect_tables
 from .chat_stream import chat_stream_router
 from .ocr import ocr_router
+from .metrics import metrics_router
+from .email import email_router
+from .charts import charts_router
+from .queries import queries_router
 
 agent_router = APIRouter()
 
 @agent_router.get("/agent")
-def agent_endpoint(prompt: str):
-    return {"response": get_response(prompt)}
+async def agent_endpoint(prompt: str, cache: bool = True):
+    semantic = get_semantic_cache() if cache else None
+    if semantic is not None:
+        cached = await semantic.alookup(prompt, scope="agent")
+        if cached is not None:
+            return {"response": cached, "cached": True}
+    with collect_tables() as tables:
+        result = await aget_response(prompt)
+    # A cached "Email sent to ..." would answer the next near-duplicate without sending anything.
+    replayable = result.get("finalized") and SIDE_EFFECT_TOOLS.isdisjoint(result.get("tools", ()))
+    if semantic is not None and replayable:
+        await semantic.astore(prompt, result["response"], scope="agent", tables=tables)
+    return result
 
 agent_router.include_router(chat_stream_router)
 agent_router.include_router(ocr_router)
+agent_router.include_router(metrics_router)
+agent_router.include_router(email_router)
+agent_router.include_router(charts_router)
+agent_router.include_router(queries_router)
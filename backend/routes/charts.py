@@ -0,0 +1,21 @@
+# routes/charts.py
+from fastapi import APIRouter, HTTPException, Response
+from tools.charts import MEDIA_TYPES, get_chart_store
+from tools.registry import arender_chart
+
+charts_router = APIRouter()
+
+
+@charts_router.get("/charts/{chart_id}.{fmt}")
+async def get_chart(chart_id: str, fmt: str):
+    """A chart returned as "url" by templated_query_tool: raw PNG/SVG bytes, or its JSON spec."""
+    spec = get_chart_store().spec(chart_id)
+    if spec is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired chart")
+    if fmt == "json":
+        return spec
+    if fmt not in MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail=f"Unsupported chart format: {fmt}")
+    data = await arender_chart(spec, fmt)
+    # Ids are content hashes, so a given URL always serves the same image.
+    return Response(content=data, media_type=MEDIA_TYPES[fmt], headers={"Cache-Control": "public, max-age=86400, immutable"})
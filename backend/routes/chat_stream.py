@@ -1,28 +1,66 @@
 # routes/chat_stream.py
-from fastapi import APIRouter, Request
+import json
+from fastapi import APIRouter
 from fastapi.responses import StreamingResponse
-from utils.prompt import build_agent_prompt
-from llm.cohere_chat import cohere_chat
-import asyncio
+from utils.prompt import build_agent_messages
+from llm.cohere_chat import acohere_chat_stream
+from utils.semantic_cache import get_semantic_cache
 
 chat_stream_router = APIRouter()
 
 
-async def stream_response(user_query: str):
-    agent_prompt = "You are a helpful AI Agentic Medical Assistant"
-    user_query_with_prompt = f"{build_agent_prompt()}\n\n{user_query}"
-    messages = [
-        {"role": "system", "content": agent_prompt},
-        {"role": "user", "content": user_query_with_prompt}
-    ]
+def build_messages(user_query: str):
+    # Only the tools relevant to the query are described, within PROMPT_TOKEN_BUDGET.
+    return build_agent_messages(user_query)
+
+
+async def stream_response(user_query: str, cache: bool = True):
+    semantic = get_semantic_cache() if cache else None
+    if semantic is not None:
+        cached = await semantic.alookup(user_query, scope="chat-stream")
+        if cached is not None:
+            yield cached
+            return
+
+    messages = build_messages(user_query)
     print("[LLM INPUT]", messages)
-    response = cohere_chat(messages)
-    # Stream response word by word
-    for word in response.split():
-        yield word + " "
-        await asyncio.sleep(0.3)
+    # Chunks are forwarded as the model produces them. If the client goes away,
+    # Starlette cancels this generator, which closes the upstream HTTP stream.
+    chunks = []
+    async for chunk in acohere_chat_stream(messages):
+        chunks.append(chunk)
+        yield chunk
+    # Only complete answers are cached; a cancelled or failed stream never gets here.
+    if semantic is not None:
+        await semantic.astore(user_query, "".join(chunks), scope="chat-stream")
+
+
+async def stream_sse(user_query: str, cache: bool = True):
+    try:
+        async for chunk in stream_response(user_query, cache):
+            yield f"data: {json.dumps(chunk)}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+        return
+    yield "event: done\ndata: {}\n\n"
 
 
 @chat_stream_router.get("/chat-stream")
-async def chat_stream(prompt: str):
-    return StreamingResponse(stream_response(prompt), media_type="text/plain")
+async def chat_stream(prompt: str, format: str = "text", cache: bool = True):
+    """
+    Stream the assistant's answer. format=text (default) sends raw chunked text;
+    format=sse sends Server-Sent Events with JSON-encoded chunks and a final `done` event.
+    A near-duplicate of an earlier question is answered from the semantic cache
+    unless cache=false.
+    """
+    if format == "sse":
+        return StreamingResponse(
+            stream_sse(prompt, cache),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return StreamingResponse(
+        stream_response(prompt, cache),
+        media_type="text/plain",
+        headers={"X-Accel-Buffering": "no"},
+    )
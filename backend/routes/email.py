@@ -0,0 +1,32 @@
+# routes/email.py
+from typing import List
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from tools.email_queue import get_mailer
+
+email_router = APIRouter()
+
+
+class EmailIn(BaseModel):
+    to_email: str
+    subject: str
+    body: str
+
+
+class EmailJobIn(BaseModel):
+    messages: List[EmailIn]
+
+
+@email_router.post("/email/jobs")
+async def submit_email_job(job: EmailJobIn):
+    """Queue messages for background delivery; poll the returned job id for status."""
+    job_id = await get_mailer().submit([m.model_dump() for m in job.messages])
+    return get_mailer().status(job_id)
+
+
+@email_router.get("/email/jobs/{job_id}")
+def email_job_status(job_id: str):
+    status = get_mailer().status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown email job")
+    return status
@@ -0,0 +1,38 @@
+# routes/metrics.py
+from fastapi import APIRouter
+from db import pool_stats
+from utils.embedding_cache import embedding_cache_stats
+from llm.async_client import llm_client_stats
+from llm.response_cache import llm_response_cache_stats
+from utils.semantic_cache import semantic_cache_stats
+from tools.registry import tool_stats
+from tools.web_tool import web_search_stats
+from tools.email_queue import email_queue_stats
+from tools.query_cache import query_cache_stats
+from tools.charts import chart_store_stats
+from utils.schema_catalog import schema_catalog_stats
+from utils.table_router import table_router_stats
+from utils.sql_templates import sql_template_cache_stats
+from utils.sql_guard import sql_guard_stats
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics")
+def metrics():
+    return {
+        "db_pool": pool_stats(),
+        "embedding_cache": embedding_cache_stats(),
+        "llm_clients": llm_client_stats(),
+        "llm_response_cache": llm_response_cache_stats(),
+        "semantic_cache": semantic_cache_stats(),
+        "tools": tool_stats(),
+        "web_search_cache": web_search_stats(),
+        "email_queue": email_queue_stats(),
+        "query_cache": query_cache_stats(),
+        "charts": chart_store_stats(),
+        "schema_catalog": schema_catalog_stats(),
+        "table_router": table_router_stats(),
+        "sql_templates": sql_template_cache_stats(),
+        "sql_guard": sql_guard_stats(),
+    }
@@ -0,0 +1,46 @@
+# routes/queries.py
+import json
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from tools.query_stream import DEFAULT_PAGE_SIZE, open_stream
+from tools.templated_query_tool import QUERIES
+
+queries_router = APIRouter()
+
+
+def _json_arg(name: str, raw: str):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be JSON")
+
+
+@queries_router.get("/queries/{query_name}/rows")
+async def query_rows(
+    query_name: str,
+    params: str = "{}",
+    after: Optional[str] = None,
+    page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=10_000),
+):
+    """
+    Stream every row of a templated query as NDJSON.
+    params: JSON object of query parameters. after: JSON key of the last row already
+    received (a value, or a list for multi-column keys), to resume an interrupted download.
+    A stream that fails part-way ends with an {"_error": ...} line.
+    """
+    if query_name not in QUERIES:
+        raise HTTPException(status_code=404, detail=f"Unknown query name: {query_name}")
+    query_params = _json_arg("params", params)
+    if not isinstance(query_params, dict):
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+    after_key = None
+    if after is not None:
+        after_key = _json_arg("after", after)
+        if not isinstance(after_key, list):
+            after_key = [after_key]
+    try:
+        rows = await open_stream(query_name, query_params, after_key, page_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(rows, media_type="application/x-ndjson")
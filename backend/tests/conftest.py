@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Tests never reach the network; the prompt tokenizer falls back to its estimate.
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+# Tests import backend modules the way main.py does (tools.web_tool, utils.*).
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
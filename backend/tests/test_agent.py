@@ -0,0 +1,54 @@
+"""
+Repeated agent runs are served from the LLM response cache.
+"""
+
+import json
+import asyncio
+
+import pytest
+
+pytest.importorskip("cohere")
+
+import llm.cohere_chat as cohere_chat
+import llm.response_cache as response_cache
+from llm.agent import run_agent
+from llm.response_cache import ResponseCache
+
+
+class ScriptedCohere:
+    """Calls one tool on the first step, then answers from the observation."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def chat(self, messages, model, temperature=0.7, max_tokens=1024):
+        self.calls.append(temperature)
+        if any(m["content"].startswith("Observations:") for m in messages):
+            return json.dumps({"thought": "done", "finalized": True, "response": "12 patients"})
+        return json.dumps({"thought": "count them", "actions": [{"tool": "rag_tool", "input": {"query": "count"}}]})
+
+
+class StubRegistry:
+    def __init__(self):
+        self.calls = 0
+
+    async def call(self, name, **kwargs):
+        self.calls += 1
+        return "12 matching patients"
+
+
+def test_repeated_agent_runs_hit_the_response_cache(monkeypatch):
+    model, tools, cache = ScriptedCohere(), StubRegistry(), ResponseCache(max_entries=16, ttl_seconds=60)
+    monkeypatch.setattr(cohere_chat, "get_cohere_client", lambda: model)
+    monkeypatch.setattr(response_cache, "_cache", cache)
+
+    async def ask():
+        return await run_agent("How many patients take insulin?", tools=["rag_tool"], registry=tools)
+
+    first = asyncio.run(ask())
+    second = asyncio.run(ask())
+
+    assert first.response == second.response == "12 patients"
+    assert model.calls == [0.0, 0.0]
+    assert tools.calls == 2
+    assert cache.stats()["hits"] == 2
@@ -0,0 +1,204 @@
+"""
+Mailer / SMTPSession and the /email/jobs routes against an in-process SMTP stub.
+"""
+
+import time
+import socket
+import asyncio
+import threading
+import socketserver
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import tools.email_queue as email_queue
+from routes.email import email_router
+from tools.email_queue import Mailer, MailerConfig
+from tools.email_tool import SMTPConfig
+
+
+class StubSMTP:
+    """Plain SMTP server that accepts everything unless a recipient has scripted RCPT replies."""
+
+    def __init__(self):
+        self.connections = 0
+        self.delivered = []
+        self.rcpt_attempts = defaultdict(int)
+        # recipient -> reply codes for its next RCPT commands (then 250)
+        self.replies = defaultdict(list)
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode() + b"\r\n")
+
+            def handle(self):
+                with stub._lock:
+                    stub.connections += 1
+                self.reply("220 stub ready")
+                recipient = None
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode().strip()
+                    verb = command.split(" ", 1)[0].upper()
+                    if verb in ("EHLO", "HELO"):
+                        self.reply("250 stub")
+                    elif verb == "RCPT":
+                        address = command[command.index("<") + 1:command.index(">")]
+                        with stub._lock:
+                            stub.rcpt_attempts[address] += 1
+                            scripted = stub.replies[address]
+                            code = scripted.pop(0) if scripted else 250
+                        recipient = address if code == 250 else None
+                        self.reply(f"{code} recipient {address}")
+                    elif verb == "DATA":
+                        self.reply("354 go ahead")
+                        while self.rfile.readline() not in (b".\r\n", b""):
+                            pass
+                        with stub._lock:
+                            stub.delivered.append(recipient)
+                        self.reply("250 queued")
+                    elif verb == "QUIT":
+                        self.reply("221 bye")
+                        return
+                    elif verb in ("MAIL", "RSET", "NOOP"):
+                        self.reply("250 ok")
+                    else:
+                        self.reply("502 not implemented")
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubSMTP()
+    yield server
+    server.close()
+
+
+def smtp_config(port: int) -> SMTPConfig:
+    return SMTPConfig(server="127.0.0.1", port=port, starttls=False, timeout_seconds=5.0)
+
+
+def mailer_config(**overrides) -> MailerConfig:
+    return MailerConfig(**{"workers": 1, "backoff_base_seconds": 0.01, "backoff_max_seconds": 0.05, **overrides})
+
+
+def messages(*recipients):
+    return [{"to_email": r, "subject": "Results", "body": f"Hello {r}"} for r in recipients]
+
+
+def deliver(mailer: Mailer, recipients):
+    async def run():
+        try:
+            job_id = await mailer.submit(messages(*recipients))
+            return await mailer.wait(job_id, timeout=10), mailer.stats()
+        finally:
+            await mailer.close()
+
+    return asyncio.run(run())
+
+
+def test_batch_reuses_one_session(stub):
+    mailer = Mailer(smtp_config(stub.port), mailer_config())
+    recipients = [f"user{i}@example.org" for i in range(10)]
+
+    status, stats = deliver(mailer, recipients)
+
+    assert status["status"] == "sent" and status["sent"] == 10
+    assert sorted(stub.delivered) == sorted(recipients)
+    assert stub.connections == 1
+    assert stats["sessions_opened"] == 1
+
+
+def test_transient_rejection_is_retried(stub):
+    stub.replies["busy@example.org"] = [451, 451]
+    mailer = Mailer(smtp_config(stub.port), mailer_config(max_retries=3))
+
+    status, stats = deliver(mailer, ["busy@example.org", "ok@example.org"])
+
+    assert status["status"] == "sent"
+    assert stub.rcpt_attempts["busy@example.org"] == 3
+    assert stats["retries"] == 2
+    assert sorted(stub.delivered) == ["busy@example.org", "ok@example.org"]
+
+
+def test_permanent_rejection_is_not_retried(stub):
+    stub.replies["gone@example.org"] = [550]
+    mailer = Mailer(smtp_config(stub.port), mailer_config(max_retries=3))
+
+    status, stats = deliver(mailer, ["gone@example.org", "ok@example.org"])
+
+    assert status["status"] == "partial"
+    assert status["errors"][0]["to_email"] == "gone@example.org"
+    assert stub.rcpt_attempts["gone@example.org"] == 1
+    assert stats["retries"] == 0
+    assert stub.delivered == ["ok@example.org"]
+
+
+def test_unreachable_server_stops_the_batch(monkeypatch):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    # Nothing listens on the port any more: every connect is refused.
+    mailer = Mailer(smtp_config(port), mailer_config(max_retries=0))
+    opened = []
+    real_open = email_queue.open_smtp
+
+    def counting_open(cfg):
+        opened.append(cfg.port)
+        return real_open(cfg)
+
+    monkeypatch.setattr(email_queue, "open_smtp", counting_open)
+    status, stats = deliver(mailer, [f"user{i}@example.org" for i in range(4)])
+
+    assert status["status"] == "failed" and status["failed"] == 4
+    # One connect per batch; the rest of each batch was deferred without using an attempt.
+    assert len(opened) == 4
+    assert stats["deferred"] == 3 + 2 + 1
+    assert stats["retries"] == 0
+
+
+def test_job_routes_report_status_transitions(stub, monkeypatch):
+    stub.replies["gone@example.org"] = [550]
+    monkeypatch.setattr(email_queue, "_mailer", Mailer(smtp_config(stub.port), mailer_config()))
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await email_queue.close_mailer()
+
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(email_router)
+
+    with TestClient(app) as client:
+        submitted = client.post("/email/jobs", json={"messages": messages("a@example.org", "gone@example.org")})
+        assert submitted.status_code == 200
+        job = submitted.json()
+        assert job["status"] == "queued" and job["pending"] == 2
+
+        deadline = time.monotonic() + 10
+        while job["pending"] and time.monotonic() < deadline:
+            time.sleep(0.02)
+            job = client.get(f"/email/jobs/{job['job_id']}").json()
+
+        assert job["status"] == "partial"
+        assert (job["sent"], job["failed"], job["pending"]) == (1, 1, 0)
+        assert job["finished_at"] is not None
+        assert client.get("/email/jobs/unknown").status_code == 404
@@ -0,0 +1,260 @@
+"""
+WebSearchService against a local stub of the DuckDuckGo instant answer API.
+"""
+
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+import pytest
+
+from tools.web_tool import DuckDuckGoClient, DuckDuckGoConfig, WebSearchService
+
+
+class StubDuckDuckGo:
+    """Answers every query with a canned payload after an optional delay, counting requests."""
+
+    def __init__(self):
+        self.delay = 0.0
+        self.status = 200
+        self.answer = "first"
+        self.hits = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.hits += 1
+                time.sleep(stub.delay)
+                query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+                body = json.dumps({
+                    "Answer": f"{stub.answer}: {query}",
+                    "RelatedTopics": [{"Text": f"topic {i}", "FirstURL": f"https://example.org/{i}"} for i in range(5)],
+                }).encode()
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubDuckDuckGo()
+    yield server
+    server.close()
+
+
+def make_service(stub, **overrides) -> WebSearchService:
+    cfg = DuckDuckGoConfig(endpoint=stub.url, timeout_seconds=5.0, **overrides)
+    # A fresh AsyncClient per test: each test runs its own event loop.
+    return WebSearchService(cfg, client=DuckDuckGoClient(cfg, ahttp=httpx.AsyncClient(timeout=5.0)))
+
+
+def test_identical_searches_are_coalesced(stub):
+    stub.delay = 0.2
+    service = make_service(stub)
+
+    async def run():
+        try:
+            return await asyncio.gather(*(service.asearch("insulin dosing") for _ in range(5)))
+        finally:
+            await service.aclose()
+
+    results = asyncio.run(run())
+    assert stub.hits == 1
+    assert len(set(results)) == 1 and "first: insulin dosing" in results[0]
+    stats = service.cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced"] == 4
+
+
+def test_num_results_limits_related_topics(stub):
+    service = make_service(stub)
+
+    async def run():
+        try:
+            return await service.asearch("metformin", num_results=2)
+        finally:
+            await service.aclose()
+
+    text = asyncio.run(run())
+    assert "2. topic 1" in text and "3. topic 2" not in text
+
+
+def test_stale_result_is_served_while_refreshing(stub):
+    service = make_service(stub, cache_ttl_seconds=0.05, cache_stale_seconds=60.0)
+
+    async def run():
+        try:
+            first = await service.asearch("warfarin")
+            await asyncio.sleep(0.1)
+            stub.answer = "second"
+            stale = await service.asearch("warfarin")
+            # The background refresh stores the new payload without blocking the stale reader.
+            for _ in range(50):
+                if service.cache.stats()["refreshes"]:
+                    break
+                await asyncio.sleep(0.02)
+            fresh = await service.asearch("warfarin")
+            return first, stale, fresh
+        finally:
+            await service.aclose()
+
+    first, stale, fresh = asyncio.run(run())
+    assert "first: warfarin" in first
+    assert stale == first
+    assert "second: warfarin" in fresh
+    assert stub.hits == 2
+    assert service.cache.stats()["stale_hits"] == 1
+
+
+def test_cancelled_leader_does_not_cancel_waiters(stub):
+    stub.delay = 0.3
+    service = make_service(stub)
+
+    async def run():
+        try:
+            leader = asyncio.create_task(service.asearch("statins"))
+            await asyncio.sleep(0.05)
+            waiter = asyncio.create_task(service.asearch("statins"))
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            result = await waiter
+            return leader, waiter, result
+        finally:
+            await service.aclose()
+
+    leader, waiter, result = asyncio.run(run())
+    assert leader.cancelled()
+    assert not waiter.cancelled()
+    assert "first: statins" in result
+
+
+def test_upstream_errors_raise_and_are_not_cached(stub):
+    stub.status = 503
+    service = make_service(stub)
+
+    async def run():
+        try:
+            with pytest.raises(httpx.HTTPStatusError):
+                await service.asearch("aspirin")
+            stub.status = 200
+            return await service.asearch("aspirin")
+        finally:
+            await service.aclose()
+
+    assert "first: aspirin" in asyncio.run(run())
+    assert stub.hits == 2
+
+
+class ScriptedClient:
+    """DuckDuckGoClient stand-in: canned payload (or exception) per query, counting fetches."""
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.fetched = []
+
+    def fetch(self, query, df=None):
+        self.fetched.append(query)
+        outcome = self.outcomes[query]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def afetch(self, query, df=None):
+        return self.fetch(query, df)
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+def topic(text, url=None):
+    return {"Text": text, "FirstURL": url} if url else {"Text": text}
+
+
+def search_many(outcomes, queries, mode, **kwargs):
+    client = ScriptedClient(outcomes)
+    service = WebSearchService(DuckDuckGoConfig(), client=client)
+    if mode == "sync":
+        return service.search_many(queries, **kwargs), client
+    return asyncio.run(service.asearch_many(queries, **kwargs)), client
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_many_merges_duplicates_by_url_and_text(mode):
+    outcomes = {
+        "warfarin": {
+            "Answer": "Anticoagulant",
+            "RelatedTopics": [topic("Warfarin - NHS", "https://nhs.uk/warfarin/"), topic("Vitamin K  interactions")],
+        },
+        "coumadin": {
+            "Answer": "anticoagulant",
+            "RelatedTopics": [
+                # Same page with a different label, and the same text without a URL.
+                {"Name": "Drugs", "Topics": [topic("Coumadin (warfarin)", "https://NHS.uk/warfarin")]},
+                topic("vitamin k interactions"),
+            ],
+        },
+    }
+
+    text, client = search_many(outcomes, ["warfarin", "coumadin", " Warfarin "], mode)
+
+    assert sorted(client.fetched) == ["coumadin", "warfarin"]
+    assert text.count("Answer:") == 1
+    assert text.count("nhs.uk/warfarin") == 1
+    assert "2. Vitamin K  interactions" in text and "3." not in text
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_many_ranks_topics_found_by_more_queries_first(mode):
+    outcomes = {
+        "a": {"RelatedTopics": [topic("only a, first", "https://x/a1"), topic("shared", "https://x/s")]},
+        "b": {"RelatedTopics": [topic("only b, first", "https://x/b1"), topic("only b, third", "https://x/b3"),
+                                topic("shared", "https://x/s")]},
+    }
+
+    text, _ = search_many(outcomes, ["a", "b"], mode)
+
+    ranked = [line.split(". ", 1)[1] for line in text.splitlines() if line[:1].isdigit()]
+    # Shared first, then by best DuckDuckGo position (ties keep query order).
+    assert ranked == ["shared", "only a, first", "only b, first", "only b, third"]
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_many_reports_a_failed_query_next_to_the_others(mode):
+    outcomes = {
+        "insulin": {"RelatedTopics": [topic("Insulin therapy", "https://x/insulin")]},
+        "metformin": httpx.ConnectError("connection refused"),
+    }
+
+    text, _ = search_many(outcomes, ["insulin", "metformin"], mode)
+
+    assert "1. Insulin therapy" in text
+    assert "Failed searches: metformin" in text
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_many_raises_when_every_query_fails(mode):
+    outcomes = {"insulin": httpx.ConnectError("down"), "metformin": httpx.ReadTimeout("slow")}
+
+    with pytest.raises((httpx.ConnectError, httpx.ReadTimeout)):
+        search_many(outcomes, ["insulin", "metformin"], mode)
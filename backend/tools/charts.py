@@ -0,0 +1,373 @@
+# tools/charts.py
+"""
+Chart specs and off-loop rendering for the templated queries.
+
+Query results are first reduced to a small JSON chart spec (chart_spec); that is
+cheap, needs no matplotlib and is all a client needs to draw the chart itself.
+Rendering a spec to PNG or SVG (render_spec) uses the object-oriented Figure
+API on the Agg/SVG canvases only, never pyplot's global state, so any number of
+renders can run side by side. The registry runs it in its process pool, whose
+workers import matplotlib and warm its font cache once at start (warm_up).
+
+Outputs (CHART_FORMATS):
+
+    "png"   base64 PNG string (the original format)
+    "svg"   SVG document as text
+    "spec"  the JSON chart spec, for client-side rendering
+    "url"   links to /charts/{id}.png|.svg|.json; the spec is kept in the
+            chart store and rendered when (and only if) a client fetches it,
+            so the image travels as raw bytes instead of base64
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import json
+import base64
+import hashlib
+import datetime
+import threading
+from collections import Counter, OrderedDict
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+CHART_FORMATS = ("png", "svg", "spec", "url")
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+FIGSIZE = (6, 4)
+HIST_BINS = 10
+
+
+def _value(v: Any) -> Any:
+    """JSON-safe scalar (Decimal, dates and numpy types come straight from the database)."""
+    if isinstance(v, Decimal):
+        return int(v) if v == v.to_integral_value() else float(v)
+    if isinstance(v, (datetime.date, datetime.datetime)):
+        return v.isoformat()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def _column(results: Sequence[Sequence[Any]], columns: List[str], name: str) -> List[Any]:
+    i = columns.index(name)
+    return [r[i] for r in results]
+
+
+def _spec(kind: str, title: str, labels: List[Any], series: List[Dict[str, Any]],
+          x_label: str = "", y_label: str = "", **options) -> Dict[str, Any]:
+    return {
+        "type": kind,
+        "title": title,
+        "x_label": x_label,
+        "y_label": y_label,
+        "labels": [_value(l) for l in labels],
+        "series": [{**s, "values": [_value(v) for v in s["values"]]} for s in series],
+        "options": options,
+    }
+
+
+def _histogram(values: List[Any], bins: int = HIST_BINS) -> Tuple[List[str], List[int]]:
+    """Bin labels and counts; numeric bins are labelled "lo–hi", date bins by their first day."""
+    values = [v for v in values if v is not None]
+    if not values:
+        return [], []
+    dates = isinstance(values[0], datetime.date)
+    data = np.array([v.toordinal() for v in values] if dates else [float(v) for v in values])
+    counts, edges = np.histogram(data, bins=bins)
+
+    def label(x):
+        if dates:
+            return datetime.date.fromordinal(int(round(x))).isoformat()
+        return f"{x:g}"
+
+    if dates:
+        return [label(lo) for lo in edges[:-1]], counts.tolist()
+    return [f"{label(lo)}\u2013{label(hi)}" for lo, hi in zip(edges[:-1], edges[1:])], counts.tolist()
+
+
+def _sorted(values) -> List[Any]:
+    try:
+        return sorted(values)
+    except TypeError:
+        return sorted(values, key=str)
+
+
+def _pivot(rows: List[Tuple[Any, Any, Any]]) -> Tuple[List[Any], List[Dict[str, Any]]]:
+    """(index, column, value) triples -> index labels and one series per column, missing cells 0."""
+    index, cols = _sorted({r[0] for r in rows}), _sorted({r[1] for r in rows})
+    cells: Dict[Tuple[Any, Any], float] = {}
+    for i, c, v in rows:
+        cells[(i, c)] = cells.get((i, c), 0) + v
+    return index, [{"name": str(c), "values": [cells.get((i, c), 0) for i in index]} for c in cols]
+
+
+def _month(v: Any) -> Any:
+    return v.strftime("%Y-%m") if isinstance(v, (datetime.date, datetime.datetime)) else v
+
+
+def chart_spec(chart_type: Optional[str], results: Sequence[Sequence[Any]], columns: List[str]) -> Dict[str, Any]:
+    """
+    Reduce query rows to the chart spec for chart_type. Rows are normally already
+    aggregated in SQL (bucket / count columns, see QUERIES[...]["chart_sql"]); raw
+    rows are still accepted and binned with numpy.
+    """
+    results = list(results)
+    if chart_type == "prescription_dates":
+        if "bucket_start" in columns:
+            labels, counts = _column(results, columns, "bucket_start"), _column(results, columns, "count")
+        else:
+            labels, counts = _histogram(_column(results, columns, "prescription_date"))
+        return _spec("bar", "Prescription Dates Distribution", labels, [{"name": "count", "values": counts}],
+                     "Date", "Count", rotate_labels=45)
+    if chart_type == "medication_types":
+        if "count" in columns:
+            names, counts = _column(results, columns, "name"), _column(results, columns, "count")
+        else:
+            # medications has generic_name/brand_name, not name.
+            tally = Counter(_column(results, columns, "name" if "name" in columns else "generic_name"))
+            names, counts = list(tally), list(tally.values())
+        return _spec("barh", "Medication Types", names, [{"name": "count", "values": counts}], "Count")
+    if chart_type == "age_distribution" and ("age_bucket" in columns or "age" in columns):
+        if "age_bucket" in columns:
+            labels = [f"{b}\u2013{b + 9}" for b in _column(results, columns, "age_bucket")]
+            counts = _column(results, columns, "count")
+        else:
+            labels, counts = _histogram(_column(results, columns, "age"))
+        return _spec("bar", "Patient Age Distribution", labels, [{"name": "count", "values": counts}],
+                     "Age", "Count", rotate_labels=45)
+    if chart_type == "recent_prescriptions":
+        dates = _column(results, columns, "created_at")
+        return _spec("line", "Recent Prescriptions Timeline", dates, [{"name": "index", "values": list(range(len(dates)))}],
+                     "Date", "Index", marker="o", rotate_labels=45)
+    if chart_type == "age_gender_stacked":
+        genders = _column(results, columns, "gender")
+        if "age_bucket" in columns:
+            rows = list(zip(_column(results, columns, "age_bucket"), genders, _column(results, columns, "count")))
+        else:
+            ages = np.array([float(a) if a is not None else np.nan for a in _column(results, columns, "age")])
+            keep = ~np.isnan(ages)
+            buckets = (np.floor_divide(ages[keep], 10) * 10).astype(int).tolist()
+            rows = list(zip(buckets, [g for g, k in zip(genders, keep) if k], [1] * len(buckets)))
+        index, series = _pivot(rows)
+        return _spec("stacked_bar", "Patient Age Distribution by Gender", index, series,
+                     "Age Bucket", "Count", colormap="coolwarm")
+    if chart_type == "category_pie":
+        return _spec("pie", "Top Prescribed Medication Categories", _column(results, columns, "category"),
+                     [{"name": "count", "values": _column(results, columns, "count")}],
+                     autopct="%1.1f%%", colormap="Pastel1")
+    if chart_type == "monthly_line":
+        return _spec("line", "Monthly Prescription Trends", [_month(m) for m in _column(results, columns, "month")],
+                     [{"name": "prescriptions", "values": _column(results, columns, "count")}],
+                     "Month", "Prescriptions", marker="o", color="navy", rotate_labels=45)
+    if chart_type == "doctor_bar":
+        return _spec("barh", "Top Doctors by Prescription Frequency", _column(results, columns, "doctor_name"),
+                     [{"name": "prescriptions", "values": _column(results, columns, "count")}],
+                     "Prescriptions", color="limegreen")
+    if chart_type == "dosage_grouped_bar":
+        rows = list(zip(_column(results, columns, "medication_name"), _column(results, columns, "dosage"),
+                        _column(results, columns, "count")))
+        index, series = _pivot(rows)
+        return _spec("grouped_bar", "Medication Dosage Patterns", index, series,
+                     "Medication Name", "Count", colormap="viridis", rotate_labels=90)
+    return _spec("text", "", [], [], text="No chart available")
+
+
+def spec_id(spec: Dict[str, Any]) -> str:
+    """Content hash of a spec; identical charts share one id (and one rendering)."""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+# ---- rendering (runs in the registry's process pool) ------------------------
+
+def _colors(name: Optional[str], n: int):
+    from matplotlib import colormaps
+
+    if not name or n == 0:
+        return None
+    cmap = colormaps[name]
+    if getattr(cmap, "colors", None) is not None and cmap.N >= n:
+        return list(cmap.colors[:n])
+    return [cmap(x) for x in np.linspace(0, 1, n)]
+
+
+def _draw(ax, spec: Dict[str, Any]) -> None:
+    kind, opts = spec["type"], spec.get("options", {})
+    labels = [str(l) for l in spec["labels"]]
+    series = spec["series"]
+    x = np.arange(len(labels))
+
+    if kind == "text":
+        ax.text(0.5, 0.5, opts.get("text", ""), ha="center")
+        return
+    if kind == "pie":
+        values = series[0]["values"] if series else []
+        ax.pie(values, labels=labels, autopct=opts.get("autopct"), colors=_colors(opts.get("colormap"), len(values)))
+    elif kind == "barh":
+        ax.barh(labels, series[0]["values"], color=opts.get("color"))
+    elif kind == "line":
+        ax.plot(labels, series[0]["values"], marker=opts.get("marker"), color=opts.get("color"))
+    elif kind == "bar":
+        ax.bar(x, series[0]["values"], width=1.0 if opts.get("rotate_labels") else 0.8, edgecolor="white")
+        ax.set_xticks(x, labels)
+    elif kind == "stacked_bar":
+        bottom = np.zeros(len(labels))
+        for s, color in zip(series, _colors(opts.get("colormap"), len(series)) or [None] * len(series)):
+            ax.bar(x, s["values"], bottom=bottom, label=s["name"], color=color)
+            bottom += np.asarray(s["values"], dtype=float)
+        ax.set_xticks(x, labels)
+        ax.legend()
+    elif kind == "grouped_bar":
+        width = 0.8 / max(len(series), 1)
+        for i, (s, color) in enumerate(zip(series, _colors(opts.get("colormap"), len(series)) or [None] * len(series))):
+            ax.bar(x - 0.4 + width * (i + 0.5), s["values"], width=width, label=s["name"], color=color)
+        ax.set_xticks(x, labels)
+        ax.legend()
+    if opts.get("rotate_labels"):
+        ax.tick_params(axis="x", labelrotation=opts["rotate_labels"])
+    ax.set_title(spec.get("title", ""))
+    if spec.get("x_label"):
+        ax.set_xlabel(spec["x_label"])
+    if spec.get("y_label"):
+        ax.set_ylabel(spec["y_label"])
+
+
+def render_spec(spec: Dict[str, Any], fmt: str = "png") -> bytes:
+    """PNG or SVG bytes for a chart spec; thread- and process-safe (no pyplot)."""
+    from matplotlib.figure import Figure
+
+    if fmt not in MEDIA_TYPES:
+        raise ValueError(f"Cannot render chart as {fmt!r}")
+    fig = Figure(figsize=FIGSIZE)
+    _draw(fig.subplots(), spec)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt)
+    return buf.getvalue()
+
+
+def warm_up() -> None:
+    """Process-pool initializer: import matplotlib on Agg and build its font cache before the first request."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    render_spec(_spec("bar", "warm-up", ["a"], [{"name": "n", "values": [1]}]))
+
+
+# ---- chart store (specs and rendered bytes behind /charts/{id}) -------------
+
+class ChartStore:
+    """Bounded LRU of specs by id, plus the images rendered from them."""
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._specs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._rendered: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {"stored": 0, "renders": 0, "render_hits": 0, "evictions": 0}
+
+    def put(self, spec: Dict[str, Any]) -> str:
+        chart_id = spec_id(spec)
+        with self._lock:
+            if chart_id not in self._specs:
+                self.counters["stored"] += 1
+            self._specs[chart_id] = spec
+            self._specs.move_to_end(chart_id)
+            while len(self._specs) > self.max_entries:
+                evicted, _ = self._specs.popitem(last=False)
+                self.counters["evictions"] += 1
+                for key in [k for k in self._rendered if k[0] == evicted]:
+                    del self._rendered[key]
+        return chart_id
+
+    def spec(self, chart_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._specs.get(chart_id)
+
+    def rendered(self, chart_id: str, fmt: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._rendered.get((chart_id, fmt))
+            if data is not None:
+                self._rendered.move_to_end((chart_id, fmt))
+                self.counters["render_hits"] += 1
+            return data
+
+    def put_rendered(self, chart_id: str, fmt: str, data: bytes) -> None:
+        with self._lock:
+            if chart_id not in self._specs:
+                return
+            self.counters["renders"] += 1
+            self._rendered[(chart_id, fmt)] = data
+            while len(self._rendered) > self.max_entries:
+                self._rendered.popitem(last=False)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "specs": len(self._specs),
+                "rendered": len(self._rendered),
+                "rendered_bytes": sum(len(b) for b in self._rendered.values()),
+                "capacity": self.max_entries,
+                **self.counters,
+            }
+
+
+_store: Optional[ChartStore] = None
+_store_lock = threading.Lock()
+
+
+def get_chart_store() -> ChartStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ChartStore(int(os.getenv("CHART_STORE_SIZE", "512")))
+        return _store
+
+
+def chart_store_stats() -> Optional[Dict[str, object]]:
+    with _store_lock:
+        store = _store
+    return store.stats() if store is not None else None
+
+
+def render_stored(spec: Dict[str, Any], fmt: str) -> bytes:
+    """render_spec in the calling thread, reusing an earlier rendering of the same spec."""
+    store = get_chart_store()
+    chart_id = store.put(spec)
+    data = store.rendered(chart_id, fmt)
+    if data is None:
+        data = render_spec(spec, fmt)
+        store.put_rendered(chart_id, fmt, data)
+    return data
+
+
+def chart_urls(spec: Dict[str, Any]) -> Dict[str, str]:
+    chart_id = get_chart_store().put(spec)
+    return {
+        "id": chart_id,
+        "png_url": f"/charts/{chart_id}.png",
+        "svg_url": f"/charts/{chart_id}.svg",
+        "spec_url": f"/charts/{chart_id}.json",
+    }
+
+
+def chart_output(spec: Optional[Dict[str, Any]], fmt: str = "png", rendered: Optional[bytes] = None):
+    """
+    The chart in the requested format. Async callers pass the "png"/"svg" bytes
+    rendered off the event loop (tools.registry.arender_chart); otherwise they are
+    rendered here. "spec" and "url" never render.
+    """
+    if spec is None:
+        return None
+    if fmt not in CHART_FORMATS:
+        raise ValueError(f"Unknown chart format: {fmt}")
+    if fmt == "spec":
+        return spec
+    if fmt == "url":
+        return chart_urls(spec)
+    if rendered is None:
+        rendered = render_stored(spec, fmt)
+    return base64.b64encode(rendered).decode("ascii") if fmt == "png" else rendered.decode("utf-8")
@@ -0,0 +1,360 @@
+# tools/email_queue.py
+"""
+Queued background email delivery.
+
+Messages are submitted as a job and get a job id whose status can be polled.
+A fixed set of async workers drain the queue; each owns one authenticated SMTP
+session that it keeps open across batches (up to max_messages_per_session, or
+until idle_seconds pass without use), so STARTTLS + login is paid once per
+session instead of once per message. smtplib is blocking, so each batch is
+sent on a worker thread. Transient failures (disconnects, 4xx replies) are
+retried with jittered exponential backoff; permanent 5xx rejections are not.
+A connection-level failure ends the batch: the rest of it is requeued after
+the same kind of backoff without using up a retry, so a dead server costs one
+connect timeout per batch rather than one per message.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import uuid
+import random
+import asyncio
+import logging
+import smtplib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from tools.email_tool import SMTPConfig, build_message, open_smtp
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MailerConfig:
+    # One pooled SMTP session per worker.
+    workers: int = 2
+    batch_size: int = 50
+    max_messages_per_session: int = 500
+    idle_seconds: float = 60.0
+    max_retries: int = 3
+    backoff_base_seconds: float = 1.0
+    backoff_max_seconds: float = 30.0
+    max_jobs_retained: int = 10_000
+
+    @classmethod
+    def from_env(cls) -> "MailerConfig":
+        return cls(
+            workers=int(os.getenv("EMAIL_QUEUE_WORKERS", cls.workers)),
+            batch_size=int(os.getenv("EMAIL_QUEUE_BATCH_SIZE", cls.batch_size)),
+            max_messages_per_session=int(os.getenv("EMAIL_QUEUE_MESSAGES_PER_SESSION", cls.max_messages_per_session)),
+            idle_seconds=float(os.getenv("EMAIL_QUEUE_IDLE_SECONDS", cls.idle_seconds)),
+            max_retries=int(os.getenv("EMAIL_QUEUE_MAX_RETRIES", cls.max_retries)),
+            backoff_base_seconds=float(os.getenv("EMAIL_QUEUE_BACKOFF_BASE_SECONDS", cls.backoff_base_seconds)),
+            backoff_max_seconds=float(os.getenv("EMAIL_QUEUE_BACKOFF_MAX_SECONDS", cls.backoff_max_seconds)),
+        )
+
+
+@dataclass
+class EmailJob:
+    id: str
+    total: int
+    sent: int = 0
+    failed: int = 0
+    errors: List[Dict[str, str]] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def status(self) -> str:
+        if self.sent + self.failed < self.total:
+            return "queued" if self.sent + self.failed == 0 else "sending"
+        if self.failed == 0:
+            return "sent"
+        return "failed" if self.sent == 0 else "partial"
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "pending": self.total - self.sent - self.failed,
+            "errors": self.errors[-20:],
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+@dataclass
+class OutgoingEmail:
+    job_id: str
+    to_email: str
+    subject: str
+    body: str
+    attempts: int = 0
+
+
+def is_permanent(exc: BaseException) -> bool:
+    """5xx replies (including 5xx recipient refusals) will not succeed on retry."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code >= 500
+    return False
+
+
+def session_broken(exc: BaseException) -> bool:
+    """Errors after which the connection cannot be reused (a refused recipient is not one)."""
+    # SMTPException subclasses OSError, so the protocol-level replies are checked first.
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code == 421
+    return isinstance(exc, (smtplib.SMTPServerDisconnected, OSError))
+
+
+class SMTPSession:
+    """One reusable SMTP connection; only ever used from one worker at a time."""
+
+    # Check an idle-but-not-expired session with NOOP before trusting it.
+    NOOP_AFTER_SECONDS = 15.0
+
+    def __init__(self, smtp: SMTPConfig, cfg: MailerConfig):
+        self.smtp = smtp
+        self.cfg = cfg
+        self._conn: Optional[smtplib.SMTP] = None
+        self._sent = 0
+        self._last_used = 0.0
+        self.opened = 0
+
+    def _connection(self) -> smtplib.SMTP:
+        idle = time.monotonic() - self._last_used
+        if self._conn is not None and (self._sent >= self.cfg.max_messages_per_session or idle > self.cfg.idle_seconds):
+            self.close()
+        if self._conn is not None and idle > self.NOOP_AFTER_SECONDS:
+            try:
+                if self._conn.noop()[0] != 250:
+                    self.close()
+            except smtplib.SMTPException:
+                self.close()
+        if self._conn is None:
+            self._conn = open_smtp(self.smtp)
+            self._sent = 0
+            self.opened += 1
+        return self._conn
+
+    def send(self, item: OutgoingEmail) -> None:
+        msg = build_message(self.smtp.from_email, item.to_email, item.subject, item.body)
+        try:
+            self._connection().sendmail(self.smtp.from_email, item.to_email, msg.as_string())
+        except Exception as e:
+            if session_broken(e):
+                # Reconnect for the next message.
+                self.close()
+            raise
+        finally:
+            self._last_used = time.monotonic()
+        self._sent += 1
+
+    def send_batch(
+        self, batch: List[OutgoingEmail]
+    ) -> Tuple[List[Tuple[OutgoingEmail, Optional[BaseException]]], List[OutgoingEmail]]:
+        """(item, error) for each message tried, and the messages left untried after a broken connection."""
+        results = []
+        for i, item in enumerate(batch):
+            try:
+                self.send(item)
+                results.append((item, None))
+            except Exception as e:
+                results.append((item, e))
+                if session_broken(e):
+                    return results, batch[i + 1:]
+        return results, []
+
+    def close(self) -> None:
+        if self._conn is None:
+            return
+        try:
+            self._conn.quit()
+        except Exception:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+
+class Mailer:
+    def __init__(self, smtp: Optional[SMTPConfig] = None, cfg: Optional[MailerConfig] = None):
+        self.smtp = smtp or SMTPConfig.from_env()
+        self.cfg = cfg or MailerConfig.from_env()
+        self._jobs: "OrderedDict[str, EmailJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._sessions: List[SMTPSession] = []
+        self._retry_handles: set = set()
+        self.counters: Dict[str, int] = {"submitted": 0, "sent": 0, "failed": 0, "retries": 0, "deferred": 0}
+
+    def _ensure_started(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._sessions = [SMTPSession(self.smtp, self.cfg) for _ in range(self.cfg.workers)]
+            self._workers = [
+                asyncio.get_running_loop().create_task(self._worker(session), name=f"mailer-{i}")
+                for i, session in enumerate(self._sessions)
+            ]
+        return self._queue
+
+    async def submit(self, messages: List[Dict[str, str]]) -> str:
+        """Queue messages ({"to_email", "subject", "body"}); returns the job id."""
+        queue = self._ensure_started()
+        job = EmailJob(id=uuid.uuid4().hex, total=len(messages))
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.cfg.max_jobs_retained:
+            self._jobs.popitem(last=False)
+        for m in messages:
+            queue.put_nowait(OutgoingEmail(job.id, m["to_email"], m["subject"], m["body"]))
+        self.counters["submitted"] += len(messages)
+        if not messages:
+            job.finished_at = time.time()
+            job.done.set()
+        return job.id
+
+    def status(self, job_id: str) -> Optional[Dict[str, object]]:
+        job = self._jobs.get(job_id)
+        return job.as_dict() if job is not None else None
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, object]]:
+        """Wait until the job has no pending messages (or the timeout passes); returns its status."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job.as_dict()
+
+    def _drain(self, first: OutgoingEmail) -> List[OutgoingEmail]:
+        batch = [first]
+        while len(batch) < self.cfg.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    def _backoff(self, attempts: int) -> float:
+        return random.uniform(0, min(self.cfg.backoff_max_seconds,
+                                     self.cfg.backoff_base_seconds * (2 ** (max(attempts, 1) - 1))))
+
+    def _requeue_later(self, items: List[OutgoingEmail], delay: float) -> None:
+        def requeue():
+            self._retry_handles.discard(handle)
+            for item in items:
+                self._queue.put_nowait(item)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retry_handles.add(handle)
+
+    def _record(self, item: OutgoingEmail, error: Optional[BaseException]) -> None:
+        job = self._jobs.get(item.job_id)
+        if error is None:
+            self.counters["sent"] += 1
+            if job is not None:
+                job.sent += 1
+        elif not is_permanent(error) and item.attempts <= self.cfg.max_retries:
+            LOG.warning("email to %s failed (%s); retry %d", item.to_email, error, item.attempts)
+            self.counters["retries"] += 1
+            self._requeue_later([item], self._backoff(item.attempts))
+            return
+        else:
+            self.counters["failed"] += 1
+            if job is not None:
+                job.failed += 1
+                job.errors.append({"to_email": item.to_email, "error": str(error) or type(error).__name__})
+        if job is not None and job.sent + job.failed >= job.total and not job.done.is_set():
+            job.finished_at = time.time()
+            job.done.set()
+
+    async def _worker(self, session: SMTPSession) -> None:
+        while True:
+            batch = self._drain(await self._queue.get())
+            try:
+                results, untried = await asyncio.to_thread(session.send_batch, batch)
+            except Exception as e:
+                results, untried = [(batch[0], e)], batch[1:]
+            for item, error in results:
+                item.attempts += 1
+                self._record(item, error)
+            if untried:
+                # The server is unreachable or dropped us: back off before the rest
+                # of the batch tries again, without charging them an attempt.
+                LOG.warning("SMTP connection failed; deferring %d untried message(s)", len(untried))
+                self.counters["deferred"] += len(untried)
+                self._requeue_later(untried, self._backoff(results[-1][0].attempts))
+            for _ in batch:
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "workers": len(self._workers),
+            "sessions_opened": sum(s.opened for s in self._sessions),
+            "jobs": len(self._jobs),
+            **self.counters,
+        }
+
+    async def close(self) -> None:
+        for handle in list(self._retry_handles):
+            handle.cancel()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for session in self._sessions:
+            await asyncio.to_thread(session.close)
+        self._workers, self._sessions, self._queue = [], [], None
+
+
+_mailer: Optional[Mailer] = None
+_mailer_lock = threading.Lock()
+
+
+def get_mailer() -> Mailer:
+    global _mailer
+    with _mailer_lock:
+        if _mailer is None:
+            _mailer = Mailer()
+        return _mailer
+
+
+async def send_email_async(to_email: str, subject: str, body: str, wait_seconds: float = 20.0) -> str:
+    """Agent-facing send: queue one message and report its delivery status."""
+    mailer = get_mailer()
+    job_id = await mailer.submit([{"to_email": to_email, "subject": subject, "body": body}])
+    status = await mailer.wait(job_id, wait_seconds)
+    if status["status"] == "sent":
+        return f"Email sent to {to_email}"
+    if status["status"] == "failed":
+        return f"[Email Error] {status['errors'][-1]['error']}"
+    return f"Email to {to_email} queued (job {job_id})"
+
+
+def email_queue_stats() -> Optional[Dict[str, object]]:
+    with _mailer_lock:
+        mailer = _mailer
+    return mailer.stats() if mailer is not None else None
+
+
+async def close_mailer() -> None:
+    global _mailer
+    with _mailer_lock:
+        mailer, _mailer = _mailer, None
+    if mailer is not None:
+        await mailer.close()
@@ -2,28 +2,64 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
+from dataclasses import dataclass
 
-def send_email(to_email: str, subject: str, body: str) -> str:
-    """
-    Simple email sending tool using SMTP. SMTP configuration is hardcoded in the tool.
-    """
-    from_email = "noreply@example.com"
-    smtp_server = "smtp.example.com"
-    smtp_port = 587
-    smtp_user = "smtp_user"
-    smtp_password = "smtp_password"
+@dataclass(frozen=True)
+class SMTPConfig:
+    server: str = "smtp.example.com"
+    port: int = 587
+    user: str = ""
+    password: str = ""
+    from_email: str = "noreply@example.com"
+    starttls: bool = True
+    timeout_seconds: float = 30.0
 
+    @classmethod
+    def from_env(cls) -> "SMTPConfig":
+        return cls(
+            server=os.getenv("SMTP_SERVER", cls.server),
+            port=int(os.getenv("SMTP_PORT", cls.port)),
+            user=os.getenv("SMTP_USER", cls.user),
+            password=os.getenv("SMTP_PASSWORD", cls.password),
+            from_email=os.getenv("EMAIL_FROM", cls.from_email),
+            starttls=os.getenv("SMTP_STARTTLS", "true").lower() not in ("0", "false", "no"),
+            timeout_seconds=float(os.getenv("SMTP_TIMEOUT_SECONDS", cls.timeout_seconds)),
+        )
+
+def build_message(from_email: str, to_email: str, subject: str, body: str) -> MIMEMultipart:
     msg = MIMEMultipart()
     msg["From"] = from_email
     msg["To"] = to_email
     msg["Subject"] = subject
     msg.attach(MIMEText(body, "plain"))
+    return msg
 
+def open_smtp(cfg: SMTPConfig) -> smtplib.SMTP:
+    """
+    Connected (and, if credentials are configured, authenticated) SMTP session.
+    """
+    server = smtplib.SMTP(cfg.server, cfg.port, timeout=cfg.timeout_seconds)
     try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
+        if cfg.starttls:
             server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.sendmail(from_email, to_email, msg.as_string())
+        if cfg.user:
+            server.login(cfg.user, cfg.password)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def send_email(to_email: str, subject: str, body: str) -> str:
+    """
+    Simple email sending tool using SMTP. SMTP settings come from SMTP_* / EMAIL_FROM.
+    For many messages use tools.email_queue, which reuses authenticated sessions.
+    """
+    cfg = SMTPConfig.from_env()
+    msg = build_message(cfg.from_email, to_email, subject, body)
+
+    try:
+        with open_smtp(cfg) as server:
+            server.sendmail(cfg.from_email, to_email, msg.as_string())
         return f"Email sent to {to_email}"
     except Exception as e:
         return f"[Email Error] {str(e)}"
@@ -0,0 +1,368 @@
+"""
+In-process patient vector search over a memory-mapped snapshot of patients.patient_case_embedding.
+
+A snapshot is a directory of versioned flat files:
+
+    vectors-<v>.f32     float32 matrix, one row per patient (N x dim)
+    ids-<v>.i64         patient id per row
+    stamps-<v>.i64      updated_at per row, microseconds since the epoch
+    offsets-<v>.i64     N + 1 byte offsets into summaries-<v>.bin
+    summaries-<v>.bin   UTF-8 patient_case_summary texts, concatenated
+    meta.json           current version, dimension, row count and the updated_at watermark
+
+Every uvicorn worker maps the same files read-only, so the OS page cache holds a single
+copy. Top-k is one matrix-vector product plus argpartition.
+
+A refresh streams rows from a server-side cursor straight into the new version's files.
+It re-reads rows updated within PATIENT_SNAPSHOT_OVERLAP_SECONDS before the watermark:
+updated_at is the writing transaction's start time, so a transaction that commits after
+a refresh can carry an updated_at behind the watermark. Re-read rows whose updated_at
+matches the snapshot are skipped. Snapshot rows whose id is no longer live (deleted,
+embedding cleared, or embedded by another model) are dropped. The new version is
+published by atomically swapping meta.json; readers pick it up.
+
+    python -m tools.mmap_vector_search --dir snapshots/patients          # build or refresh
+    python -m tools.mmap_vector_search --dir snapshots/patients --full   # rebuild from scratch
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import fcntl
+import logging
+import argparse
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from tools.rag_tool import RAGKernel
+
+LOG = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+LOCK_FILE = ".refresh.lock"
+SNAPSHOT_FILES = ("vectors", "ids", "stamps", "offsets", "summaries")
+
+# Kept rows are copied from the previous version this many at a time.
+COPY_CHUNK_ROWS = 65536
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _parse_vector(text: str) -> np.ndarray:
+    return np.array(text.strip("[]").split(","), dtype=np.float32)
+
+
+def _stamp(ts: datetime) -> int:
+    """updated_at as integer microseconds since the epoch (naive timestamps are UTC-agnostic)."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return (ts - _EPOCH) // timedelta(microseconds=1)
+
+
+@dataclass(frozen=True)
+class SnapshotMeta:
+    version: int
+    dim: int
+    count: int
+    model_tag: str
+    watermark_updated_at: Optional[str] = None
+
+    @classmethod
+    def load(cls, path: str) -> Optional["SnapshotMeta"]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        # Older snapshots also stored an id watermark; it is no longer used.
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in known})
+
+
+class VectorSnapshot:
+    """Read-only view of one snapshot version."""
+
+    def __init__(self, directory: str, meta: SnapshotMeta):
+        self.meta = meta
+        v = meta.version
+        if meta.count:
+            self.vectors = np.memmap(os.path.join(directory, f"vectors-{v}.f32"), dtype=np.float32,
+                                     mode="r", shape=(meta.count, meta.dim))
+            self.ids = np.memmap(os.path.join(directory, f"ids-{v}.i64"), dtype=np.int64, mode="r")
+            stamps = os.path.join(directory, f"stamps-{v}.i64")
+            # Snapshots written before stamps existed; the writer rebuilds them in full.
+            self.stamps = np.memmap(stamps, dtype=np.int64, mode="r") if os.path.exists(stamps) else None
+            self.offsets = np.memmap(os.path.join(directory, f"offsets-{v}.i64"), dtype=np.int64, mode="r")
+            self.summaries = np.memmap(os.path.join(directory, f"summaries-{v}.bin"), dtype=np.uint8, mode="r")
+        else:
+            self.vectors = np.zeros((0, meta.dim), dtype=np.float32)
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.stamps = np.zeros(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.summaries = np.zeros(0, dtype=np.uint8)
+
+    def summary(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self.summaries[start:end].tobytes().decode("utf-8")
+
+    def top_k(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows and inner-product scores of the k best matches for each query (best first)."""
+        n = self.vectors.shape[0]
+        k = min(k, n)
+        if k == 0:
+            empty = np.zeros((queries.shape[0], 0))
+            return empty.astype(np.int64), empty
+        scores = queries @ self.vectors.T
+        if k < n:
+            part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            part = np.tile(np.arange(n), (queries.shape[0], 1))
+        part_scores = np.take_along_axis(scores, part, axis=1)
+        order = np.argsort(-part_scores, axis=1)
+        return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+class SnapshotWriter:
+    """Builds and incrementally refreshes a snapshot directory from Postgres."""
+
+    def __init__(self, directory: str, model_tag: str, fetch_size: int = 5000, overlap_seconds: Optional[float] = None):
+        self.directory = directory
+        self.model_tag = model_tag
+        self.fetch_size = fetch_size
+        if overlap_seconds is None:
+            overlap_seconds = float(os.getenv("PATIENT_SNAPSHOT_OVERLAP_SECONDS", "300"))
+        # Longest a write transaction may stay open and still be picked up by the next refresh.
+        self.overlap_seconds = overlap_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    _WHERE = "patient_case_embedding IS NOT NULL AND patient_case_embedding_model = %(model)s"
+
+    def _live_ids(self, conn) -> np.ndarray:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT id FROM patients WHERE {self._WHERE};", {"model": self.model_tag})
+            return np.fromiter((r[0] for r in cur), dtype=np.int64)
+
+    def _fetch(self, conn, since: Optional[str]) -> Iterator[tuple]:
+        where = self._WHERE
+        params: Dict[str, Any] = {"model": self.model_tag}
+        if since:
+            where += " AND updated_at >= %(since)s::timestamp - %(overlap)s * interval '1 second'"
+            params.update(since=since, overlap=self.overlap_seconds)
+        with conn.cursor(name="patient_vector_snapshot") as cur:
+            cur.itersize = self.fetch_size
+            cur.execute(
+                f"SELECT id, patient_case_summary, patient_case_embedding::text, updated_at "
+                f"FROM patients WHERE {where} ORDER BY updated_at, id;",
+                params,
+            )
+            for row in cur:
+                yield row
+
+    def refresh(self, full: bool = False) -> SnapshotMeta:
+        from db import get_db_conn
+
+        lock_path = os.path.join(self.directory, LOCK_FILE)
+        with open(lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            current = SnapshotMeta.load(os.path.join(self.directory, META_FILE))
+            if current is not None and current.model_tag != self.model_tag:
+                full = True
+            base = None if (full or current is None) else VectorSnapshot(self.directory, current)
+            if base is not None and base.stamps is None:
+                base = None
+
+            conn = get_db_conn()
+            try:
+                # Live ids and changed rows from the same snapshot of the table.
+                conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+                live = self._live_ids(conn) if base is not None else None
+                since = current.watermark_updated_at if base is not None else None
+                return self._write(base, live, self._fetch(conn, since), current)
+            finally:
+                conn.close()
+
+    def _paths(self, version: int) -> Dict[str, str]:
+        ext = {"vectors": "f32", "ids": "i64", "stamps": "i64", "offsets": "i64", "summaries": "bin"}
+        return {name: os.path.join(self.directory, f"{name}-{version}.{ext[name]}") for name in SNAPSHOT_FILES}
+
+    def _write(self, base: Optional[VectorSnapshot], live: Optional[np.ndarray],
+               rows: Iterable[tuple], current: Optional[SnapshotMeta]) -> SnapshotMeta:
+        version = (current.version + 1) if current else 1
+        paths = self._paths(version)
+        watermark = current.watermark_updated_at if base is not None else None
+        top = _stamp(datetime.fromisoformat(watermark)) if watermark else None
+        has_base = base is not None and base.meta.count > 0
+
+        # Snapshot rows inside the overlap window, to recognise re-read rows that did not change.
+        recent: Dict[int, int] = {}
+        if has_base and top is not None:
+            mask = np.asarray(base.stamps) >= top - int(self.overlap_seconds * 1e6)
+            recent = dict(zip(base.ids[mask].tolist(), base.stamps[mask].tolist()))
+
+        dim = base.meta.dim if has_base else None
+        new_ids: List[int] = []
+        new_stamps: List[int] = []
+        new_lengths: List[int] = []
+        try:
+            with open(paths["vectors"], "wb") as fv, open(paths["summaries"], "wb") as fs:
+                # Changed rows first, streamed from the cursor.
+                for row_id, summary, vector_text, updated_at in rows:
+                    stamp = _stamp(updated_at)
+                    if top is None or stamp > top:
+                        top, watermark = stamp, updated_at.isoformat(sep=" ")
+                    if recent.get(row_id) == stamp:
+                        continue
+                    vec = _parse_vector(vector_text)
+                    if dim is None:
+                        dim = len(vec)
+                    elif len(vec) != dim:
+                        raise ValueError(f"patient {row_id} has a {len(vec)}-d embedding, snapshot is {dim}-d")
+                    text = (summary or "").encode("utf-8")
+                    fv.write(vec.tobytes())
+                    fs.write(text)
+                    new_ids.append(row_id)
+                    new_stamps.append(stamp)
+                    new_lengths.append(len(text))
+
+                changed_ids = np.array(new_ids, dtype=np.int64)
+                keep = np.zeros(0, dtype=bool)
+                if has_base:
+                    keep = np.isin(base.ids, live) & ~np.isin(base.ids, changed_ids)
+                    old_lengths = np.diff(base.offsets)
+                    if not new_ids and keep.all():
+                        keep = None
+                    else:
+                        # Then the surviving rows of the previous version, copied chunk by chunk.
+                        for lo in range(0, len(keep), COPY_CHUNK_ROWS):
+                            hi = min(lo + COPY_CHUNK_ROWS, len(keep))
+                            k = keep[lo:hi]
+                            fv.write(np.ascontiguousarray(base.vectors[lo:hi][k]).tobytes())
+                            text = np.asarray(base.summaries[int(base.offsets[lo]):int(base.offsets[hi])])
+                            fs.write(text[np.repeat(k, old_lengths[lo:hi])].tobytes())
+                elif base is not None and not new_ids:
+                    keep = None
+        except BaseException:
+            self._discard(paths)
+            raise
+
+        if keep is None:
+            # Nothing new and nothing removed: keep serving the current version.
+            self._discard(paths)
+            return current
+
+        ids = np.concatenate([changed_ids, np.asarray(base.ids[keep]) if len(keep) else changed_ids[:0]])
+        stamps = np.array(new_stamps, dtype=np.int64)
+        lengths = np.array(new_lengths, dtype=np.int64)
+        if len(keep):
+            stamps = np.concatenate([stamps, np.asarray(base.stamps[keep])])
+            lengths = np.concatenate([lengths, old_lengths[keep]])
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids.tofile(paths["ids"])
+        stamps.tofile(paths["stamps"])
+        offsets.tofile(paths["offsets"])
+
+        meta = SnapshotMeta(version=version, dim=int(dim or 0), count=int(len(ids)), model_tag=self.model_tag,
+                            watermark_updated_at=watermark)
+        tmp = os.path.join(self.directory, META_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta.__dict__, f)
+        os.replace(tmp, os.path.join(self.directory, META_FILE))
+
+        removed = int((~np.isin(base.ids, live)).sum()) if has_base else 0
+        self._prune(keep_versions={version, version - 1})
+        LOG.info("patient vector snapshot v%d: %d rows (%d changed, %d removed)",
+                 version, meta.count, len(new_ids), removed)
+        return meta
+
+    @staticmethod
+    def _discard(paths: Dict[str, str]) -> None:
+        for path in paths.values():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _prune(self, keep_versions) -> None:
+        # Keep the previous version so readers that have not reloaded yet stay valid.
+        for name in os.listdir(self.directory):
+            stem, _, ext = name.partition(".")
+            prefix, _, ver = stem.rpartition("-")
+            if prefix in SNAPSHOT_FILES and ver.isdigit():
+                if int(ver) not in keep_versions:
+                    os.remove(os.path.join(self.directory, name))
+
+
+class MmapPatientVectorSearch:
+    """Drop-in alternative to PatientVectorSearch that searches a memory-mapped snapshot."""
+
+    # How often run() checks meta.json for a newer snapshot version.
+    RELOAD_CHECK_SECONDS = 5.0
+
+    def __init__(self, rag: Optional[RAGKernel] = None, directory: Optional[str] = None):
+        self.rag = rag or RAGKernel()
+        self.directory = directory or os.getenv("PATIENT_VECTOR_SNAPSHOT_DIR", "snapshots/patients")
+        self._snapshot: Optional[VectorSnapshot] = None
+        self._checked_at = 0.0
+
+    @property
+    def snapshot(self) -> VectorSnapshot:
+        now = time.monotonic()
+        if self._snapshot is None or now - self._checked_at > self.RELOAD_CHECK_SECONDS:
+            self._checked_at = now
+            meta = SnapshotMeta.load(os.path.join(self.directory, META_FILE))
+            if meta is None:
+                raise FileNotFoundError(
+                    f"No patient vector snapshot in {self.directory}; run python -m tools.mmap_vector_search"
+                )
+            if self._snapshot is None or meta.version != self._snapshot.meta.version:
+                self._snapshot = VectorSnapshot(self.directory, meta)
+        return self._snapshot
+
+    def _results(self, snap: VectorSnapshot, rows: np.ndarray, scores: np.ndarray) -> List[Dict[str, Any]]:
+        # Report the negated inner product so values line up with pgvector's `<#>`.
+        return [
+            {"id": int(snap.ids[r]), "summary": snap.summary(int(r)), "similarity": float(-s)}
+            for r, s in zip(rows, scores)
+        ]
+
+    def run(self, query: str, k: int = 5):
+        vec = self.rag.embed(query)
+        snap = self.snapshot
+        rows, scores = snap.top_k(np.asarray([vec], dtype=np.float32), k)
+        return self._results(snap, rows[0], scores[0])
+
+    def run_many(self, queries: List[str], k: int = 5) -> List[List[Dict[str, Any]]]:
+        if not queries:
+            return []
+        vecs = np.asarray(self.rag.embed_many(queries), dtype=np.float32)
+        snap = self.snapshot
+        rows, scores = snap.top_k(vecs, k)
+        return [self._results(snap, r, s) for r, s in zip(rows, scores)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build or refresh the memory-mapped patient vector snapshot.")
+    parser.add_argument("--dir", default=os.getenv("PATIENT_VECTOR_SNAPSHOT_DIR", "snapshots/patients"))
+    parser.add_argument("--provider", default="qwen", choices=["qwen", "openai"])
+    parser.add_argument("--full", action="store_true", help="rebuild instead of applying changes past the watermark")
+    parser.add_argument("--overlap", type=float, default=None,
+                        help="seconds re-read behind the watermark (default PATIENT_SNAPSHOT_OVERLAP_SECONDS or 300)")
+    parser.add_argument("--interval", type=float, default=0.0, help="keep refreshing every N seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    writer = SnapshotWriter(args.dir, RAGKernel(provider=args.provider).model_tag, overlap_seconds=args.overlap)
+    writer.refresh(full=args.full)
+    while args.interval > 0:
+        time.sleep(args.interval)
+        writer.refresh()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# tools/query_cache.py
+"""
+Result cache for templated_query_tool.
+
+Entries are keyed on (query name, params, day) and hold the overview together
+with the chart spec (images rendered from a spec are kept by tools/charts.py,
+so a hit re-renders nothing either). Each entry remembers the table versions it was built
+from (utils.table_deps.table_versions, read before the query runs); a lookup
+serves it only while those versions are unchanged, so any committed write to
+an underlying table invalidates it immediately and nothing expires on a timer.
+
+Queries whose SQL depends on the current date (CURRENT_DATE, AGE(...)) include
+the date in the key, so "last 12 months" does not outlive the day it was run.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import datetime
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+Versions = Tuple[Tuple[str, int], ...]
+
+_DATE_DEPENDENT = re.compile(r"\b(?:CURRENT_DATE|CURRENT_TIMESTAMP|NOW\s*\(|AGE\s*\()", re.IGNORECASE)
+
+
+def date_dependent(sql: str) -> bool:
+    return bool(_DATE_DEPENDENT.search(sql))
+
+
+def cache_key(query_name: str, params: Optional[Dict[str, Any]], sql: str) -> str:
+    day = datetime.date.today().isoformat() if date_dependent(sql) else ""
+    return json.dumps([query_name, params or {}, day], sort_keys=True, default=str)
+
+
+@dataclass
+class QueryCacheEntry:
+    versions: Versions
+    overview: Dict[str, Any]
+    spec: Optional[Dict[str, Any]]
+    build_seconds: float
+
+
+class QueryResultCache:
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, QueryCacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+            "uncacheable": 0,
+            "stores": 0,
+            "evictions": 0,
+            "saved_seconds": 0.0,
+        }
+
+    def get(self, key: str, versions: Optional[Versions]) -> Optional[QueryCacheEntry]:
+        """The entry for key if it was built from exactly these table versions."""
+        with self._lock:
+            if versions is None:
+                self.counters["uncacheable"] += 1
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            if entry.versions != versions:
+                del self._entries[key]
+                self.counters["invalidations"] += 1
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            self.counters["saved_seconds"] += entry.build_seconds
+            return entry
+
+    def put(self, key: str, versions: Optional[Versions], overview: Dict[str, Any],
+            spec: Optional[Dict[str, Any]], build_seconds: float) -> None:
+        if versions is None:
+            return
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current.versions > versions:
+                # A newer result was stored while this one was being built.
+                return
+            self._entries[key] = QueryCacheEntry(versions, overview, spec, build_seconds)
+            self._entries.move_to_end(key)
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["misses"]
+        counters["saved_seconds"] = round(counters["saved_seconds"], 3)
+        return {
+            "entries": size,
+            "capacity": self.max_entries,
+            "hit_ratio": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+            **counters,
+        }
+
+
+_cache: Optional[QueryResultCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> Optional[QueryResultCache]:
+    """Process-wide cache; QUERY_CACHE_SIZE=0 disables it."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            size = int(os.getenv("QUERY_CACHE_SIZE", "256"))
+            if size <= 0:
+                return None
+            _cache = QueryResultCache(max_entries=size)
+        return _cache
+
+
+def query_cache_stats() -> Optional[Dict[str, object]]:
+    with _cache_lock:
+        cache = _cache
+    return cache.stats() if cache is not None else None
@@ -0,0 +1,152 @@
+# tools/query_stream.py
+"""
+Streaming execution of the templated queries (GET /queries/{name}/rows).
+
+Queries that declare a "keyset" (columns that are unique and non-null per row)
+are read page by page:
+
+    SELECT * FROM (<query without its ORDER BY>) AS q
+    WHERE (key) > (<last key sent>) ORDER BY key LIMIT <page_size>
+
+Each page is a short checkout from the async pool, so no transaction stays open
+while the client reads, and an interrupted download resumes with after=<key of
+the last row received>. Rows come in key order. Queries without a keyset are
+read through one server-side cursor in QUERY_FETCH_SIZE batches. Either way at
+most one page is held in memory, whatever the size of the result.
+
+``open_stream()`` checks the parameters and fetches the first page before the
+response starts, so bad input is a 400 rather than a short 200. A failure after
+that ends the body with an {"_error": ...} line instead of silently truncating it.
+"""
+
+from __future__ import annotations
+
+import re
+import json
+import uuid
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+from tools.templated_query_tool import QUERIES, QUERY_FETCH_SIZE, unordered
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+
+
+def keyset(query_name: str) -> Optional[List[str]]:
+    if query_name not in QUERIES:
+        raise ValueError(f"Unknown query name: {query_name}")
+    return QUERIES[query_name].get("keyset")
+
+
+def missing_params(sql: str, params: Dict[str, Any]) -> List[str]:
+    """Placeholders of ``sql`` with no (or a null) value in ``params``, in order of appearance."""
+    missing: List[str] = []
+    for name in _PLACEHOLDER.findall(sql):
+        if params.get(name) is None and name not in missing:
+            missing.append(name)
+    return missing
+
+
+def keyset_page_sql(sql: str, key: Sequence[str], first: bool) -> str:
+    cols = ", ".join(f"q.{k}" for k in key)
+    where = ""
+    if not first:
+        where = f" WHERE ({cols}) > ({', '.join(f'%(_after_{i})s' for i in range(len(key)))})"
+    return f"SELECT * FROM ({unordered(sql)}) AS q{where} ORDER BY {cols} LIMIT %(_page_size)s"
+
+
+def ndjson_line(columns: Sequence[str], row: Sequence[Any]) -> str:
+    return json.dumps(dict(zip(columns, row)), default=str) + "\n"
+
+
+async def _keyset_pages(sql: str, key: List[str], params: Dict[str, Any],
+                        after: Optional[List[Any]], page_size: int) -> AsyncIterator[str]:
+    from db import get_async_pool
+
+    pool = await get_async_pool()
+    while True:
+        page_params = {**params, "_page_size": page_size}
+        if after is not None:
+            page_params.update({f"_after_{i}": v for i, v in enumerate(after)})
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(keyset_page_sql(sql, key, after is None), page_params)
+                rows = await cur.fetchall()
+                columns = [d.name for d in cur.description]
+        for row in rows:
+            yield ndjson_line(columns, row)
+        if len(rows) < page_size:
+            return
+        positions = [columns.index(k) for k in key]
+        after = [rows[-1][i] for i in positions]
+
+
+async def _cursor_batches(sql: str, params: Dict[str, Any]) -> AsyncIterator[str]:
+    from db import get_async_pool
+
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        async with conn.cursor(name=f"tq_stream_{uuid.uuid4().hex}") as cur:
+            cur.itersize = QUERY_FETCH_SIZE
+            await cur.execute(sql, params)
+            columns = None
+            async for row in cur:
+                if columns is None:
+                    columns = [d.name for d in cur.description]
+                yield ndjson_line(columns, row)
+
+
+def stream_rows(query_name: str, params: Optional[Dict[str, Any]] = None, after: Optional[List[Any]] = None,
+                page_size: int = DEFAULT_PAGE_SIZE) -> AsyncIterator[str]:
+    """NDJSON lines (one JSON object per row) for the full result of a named query."""
+    key = keyset(query_name)
+    sql = QUERIES[query_name]["sql"]
+    params = params or {}
+    missing = missing_params(sql, params)
+    if missing:
+        raise ValueError(f"missing query parameter(s): {', '.join(missing)}")
+    if key:
+        if after is not None and len(after) != len(key):
+            raise ValueError(f"after must have {len(key)} value(s): {', '.join(key)}")
+        return _keyset_pages(sql, key, params, after, page_size)
+    if after is not None:
+        raise ValueError(f"{query_name} has no keyset; it can only be streamed from the start")
+    return _cursor_batches(sql, params)
+
+
+async def _empty() -> AsyncIterator[str]:
+    return
+    yield
+
+
+async def _resume(first: str, rows: AsyncIterator[str]) -> AsyncIterator[str]:
+    yield first
+    try:
+        async for line in rows:
+            yield line
+    except Exception as e:
+        # The status line is long gone; say so in the body rather than end it early.
+        LOG.warning("query stream aborted: %s", e)
+        yield json.dumps({"_error": f"stream aborted: {e}"}) + "\n"
+
+
+async def open_stream(query_name: str, params: Optional[Dict[str, Any]] = None, after: Optional[List[Any]] = None,
+                      page_size: int = DEFAULT_PAGE_SIZE) -> AsyncIterator[str]:
+    """
+    stream_rows() with the first page already fetched. Raises ValueError for a missing
+    parameter or one the database cannot convert (e.g. a non-numeric patient_id).
+    """
+    import psycopg
+
+    rows = stream_rows(query_name, params, after, page_size)
+    try:
+        first = await rows.__anext__()
+    except StopAsyncIteration:
+        return _empty()
+    except psycopg.errors.DataError as e:
+        raise ValueError(e.diag.message_primary or str(e).strip()) from None
+    return _resume(first, rows)
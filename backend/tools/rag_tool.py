@@ -2,181 +2,416 @@ from __future__ import annotations
 
 import os
 import json
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from typing import Optional, List
 import httpx
 
+from vector_index import PROVIDER_DIMENSIONS, knn_search
+from utils.embedding_cache import EmbeddingCache, cache_from_env
+from utils.tokenizer import TokenCounter, get_token_counter
+from utils.table_deps import record_tables
 
-class QwenEmbedder:
-    def __init__(self, base_url: Optional[str] = None, timeout: float = 60.0):
-        self.base_url = (base_url or os.getenv("QWEN_EMBEDDING_URL", "http://localhost:9977")).rstrip("/")
-        self.timeout = timeout
-        self.headers = {"Content-Type": "application/json"}
 
-    def _post(self, url: str, text: str):
-        payload = {"inputs": [text]}
-        with httpx.Client(timeout=self.timeout) as client:
-            resp = client.post(url, headers=self.headers, json=payload)
-            resp.raise_for_status()
-            return resp.json()
+class EmbeddingError(Exception):
+    """Base class for embedding failures."""
 
-    def embed(self, text: str) -> Optional[List[float]]:
-        try:
-            try:
-                result = self._post(self.base_url, text)
-            except httpx.HTTPStatusError:
-                result = self._post(f"{self.base_url}/embed", text)
 
-            if isinstance(result, dict) and "embeddings" in result:
-                return result["embeddings"][0] if result["embeddings"] else None
+class EmbeddingServiceError(EmbeddingError):
+    """The embedding server could not be reached or answered with an error status."""
 
-            if isinstance(result, list):
-                return result[0] if result and isinstance(result[0], list) else None
+    def __init__(self, message: str, url: Optional[str] = None, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.url = url
+        self.status_code = status_code
 
-            if isinstance(result, dict) and "data" in result and result["data"]:
-                item = result["data"][0]
-                return item.get("embedding") if isinstance(item, dict) else item
 
-        except Exception:
-            return None
+class EmbeddingResponseError(EmbeddingError):
+    """The embedding server answered, but not with a payload we can read vectors from."""
 
-        return None
 
+def parse_embeddings(result) -> List[List[float]]:
+    """Extract the list of vectors from a TEI, ``{"embeddings": ...}`` or OpenAI-style payload."""
+    if isinstance(result, dict) and "embeddings" in result:
+        vectors = result["embeddings"]
+    elif isinstance(result, dict) and "data" in result:
+        vectors = [item.get("embedding") if isinstance(item, dict) else item for item in result["data"]]
+    elif isinstance(result, list):
+        vectors = result
+    else:
+        raise EmbeddingResponseError(f"Unrecognized embedding payload of type {type(result).__name__}")
 
-class RAGService:
-    def __init__(self, embedder: Optional[QwenEmbedder] = None):
-        self.embedder = embedder or QwenEmbedder()
+    if not vectors or not all(isinstance(v, list) and v for v in vectors):
+        raise EmbeddingResponseError("Embedding payload contained no vectors")
+    return vectors
 
-    def embed_query(self, query: str) -> Optional[List[float]]:
-        return self.embedder.embed(query)
 
+class TEIClient:
+    """Keep-alive HTTP client for a text-embeddings-inference server.
 
-class PatientSemanticSearch:
-    def __init__(self, rag: Optional[RAGService] = None, db_conn=None):
-        self.rag = rag or RAGService()
-        self.db_conn = db_conn
+    The working route (base URL or ``/embed``) is discovered on the first request
+    and reused for the lifetime of the process.
+    """
 
-    def _get_conn(self):
-        if self.db_conn:
-            return self.db_conn
-        from db import get_db_conn
-        return get_db_conn()
+    ROUTES = ("", "/embed")
+
+    def __init__(self, base_url: str, timeout: float = 60.0, max_connections: int = 8):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.headers = {"Content-Type": "application/json"}
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._url: Optional[str] = None
+        self._client: Optional[httpx.Client] = None
+        self._aclient: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(timeout=self.timeout, limits=self.limits, headers=self.headers)
+        return self._client
+
+    @property
+    def aclient(self) -> httpx.AsyncClient:
+        # AsyncClient binds to the running loop on first use; create it lazily from async code.
+        if self._aclient is None:
+            self._aclient = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, headers=self.headers)
+        return self._aclient
+
+    def _candidates(self) -> List[str]:
+        if self._url:
+            return [self._url]
+        return [f"{self.base_url}{route}" for route in self.ROUTES]
+
+    @staticmethod
+    def _route_missing(resp: httpx.Response) -> bool:
+        return resp.status_code in (404, 405)
+
+    def _handle(self, url: str, resp: httpx.Response):
+        if resp.is_error:
+            raise EmbeddingServiceError(
+                f"Embedding server returned {resp.status_code}: {resp.text[:200]}",
+                url=url,
+                status_code=resp.status_code,
+            )
+        self._url = url
+        try:
+            return resp.json()
+        except ValueError as e:
+            raise EmbeddingResponseError(f"Embedding server returned non-JSON body from {url}") from e
 
-    def search(self, query: str, top_k: int = 5):
-        vector = self.rag.embed_query(query)
-        if not vector:
+    def post(self, payload: dict):
+        candidates = self._candidates()
+        for i, url in enumerate(candidates):
+            try:
+                resp = self.client.post(url, json=payload)
+            except httpx.HTTPError as e:
+                raise EmbeddingServiceError(f"Embedding request failed: {e}", url=url) from e
+            if self._route_missing(resp) and i + 1 < len(candidates):
+                continue
+            return self._handle(url, resp)
+
+    async def apost(self, payload: dict):
+        candidates = self._candidates()
+        for i, url in enumerate(candidates):
+            try:
+                resp = await self.aclient.post(url, json=payload)
+            except httpx.HTTPError as e:
+                raise EmbeddingServiceError(f"Embedding request failed: {e}", url=url) from e
+            if self._route_missing(resp) and i + 1 < len(candidates):
+                continue
+            return self._handle(url, resp)
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self) -> None:
+        self.close()
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
+
+
+QWEN_MODEL_ID = os.getenv("QWEN_EMBEDDING_MODEL", "Qwen/Qwen3-Embedding-0.6B")
+QWEN_MODEL_REVISION = os.getenv("QWEN_EMBEDDING_REVISION", "refs/pr/27")
+
+
+@dataclass(frozen=True)
+class BatchConfig:
+    """Client-side mirror of the TEI server limits in docker-compose.yml."""
+
+    max_batch_tokens: int = 2048
+    max_batch_size: int = 4
+    max_concurrent_requests: int = 4
+    overload_retries: int = 3
+    overload_backoff_seconds: float = 0.25
+
+    @classmethod
+    def from_env(cls) -> "BatchConfig":
+        return cls(
+            max_batch_tokens=int(os.getenv("QWEN_MAX_BATCH_TOKENS", cls.max_batch_tokens)),
+            max_batch_size=int(os.getenv("QWEN_MAX_BATCH_REQUESTS", cls.max_batch_size)),
+            max_concurrent_requests=int(os.getenv("QWEN_MAX_CONCURRENT_REQUESTS", cls.max_concurrent_requests)),
+        )
+
+
+class TEIBatcher:
+    """Packs texts into token-bounded micro-batches and embeds them concurrently."""
+
+    def __init__(
+        self,
+        http: TEIClient,
+        cfg: Optional[BatchConfig] = None,
+        counter: Optional[TokenCounter] = None,
+    ):
+        self.http = http
+        self.cfg = cfg or BatchConfig.from_env()
+        self.counter = counter or get_token_counter(QWEN_MODEL_ID, QWEN_MODEL_REVISION)
+
+    def pack(self, texts: List[str]) -> List[List[int]]:
+        """Greedy in-order packing; returns batches of indices into ``texts``.
+
+        A text larger than the whole budget goes alone (the server auto-truncates it).
+        """
+        batches: List[List[int]] = []
+        current: List[int] = []
+        current_tokens = 0
+        for i, n in enumerate(self.counter.count_many(texts)):
+            if current and (
+                current_tokens + n > self.cfg.max_batch_tokens or len(current) >= self.cfg.max_batch_size
+            ):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += n
+        if current:
+            batches.append(current)
+        return batches
+
+    def _overloaded(self, e: EmbeddingServiceError, attempt: int) -> bool:
+        return e.status_code in (429, 503) and attempt < self.cfg.overload_retries
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                vectors = parse_embeddings(self.http.post({"inputs": batch}))
+                break
+            except EmbeddingServiceError as e:
+                if not self._overloaded(e, attempt):
+                    raise
+                attempt += 1
+                time.sleep(self.cfg.overload_backoff_seconds * attempt)
+        if len(vectors) != len(batch):
+            raise EmbeddingResponseError(f"Expected {len(batch)} vectors, got {len(vectors)}")
+        return vectors
+
+    async def _aembed_batch(self, batch: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                vectors = parse_embeddings(await self.http.apost({"inputs": batch}))
+                break
+            except EmbeddingServiceError as e:
+                if not self._overloaded(e, attempt):
+                    raise
+                attempt += 1
+                await asyncio.sleep(self.cfg.overload_backoff_seconds * attempt)
+        if len(vectors) != len(batch):
+            raise EmbeddingResponseError(f"Expected {len(batch)} vectors, got {len(vectors)}")
+        return vectors
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
             return []
+        batches = self.pack(texts)
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        workers = min(self.cfg.max_concurrent_requests, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda idx: self._embed_batch([texts[i] for i in idx]), batches)
+            for idx, vectors in zip(batches, results):
+                for i, v in zip(idx, vectors):
+                    out[i] = v
+        return out
+
+    async def aembed_many(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # Tokenizing (and a first tokenizer load) is CPU/blocking work; keep it off the loop.
+        batches = await asyncio.to_thread(self.pack, texts)
+        sem = asyncio.Semaphore(self.cfg.max_concurrent_requests)
 
-        conn = self._get_conn()
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT
-                    id,
-                    patient_case_summary,
-                    patient_case_embedding <#> %s AS similarity
-                FROM patients
-                WHERE patient_case_embedding IS NOT NULL
-                ORDER BY similarity ASC
-                LIMIT %s;
-                """,
-                (vector, top_k),
-            )
-            rows = cur.fetchall()
+        async def run(idx: List[int]) -> List[List[float]]:
+            async with sem:
+                return await self._aembed_batch([texts[i] for i in idx])
 
-        return [
-            {
-                "id": r[0],
-                "summary": r[1],
-                "similarity": r[2],
-            }
-            for r in rows
-        ]
+        results = await asyncio.gather(*(run(idx) for idx in batches))
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        for idx, vectors in zip(batches, results):
+            for i, v in zip(idx, vectors):
+                out[i] = v
+        return out
 
 
-_rag_instance = RAGService()
-_search_instance = PatientSemanticSearch(_rag_instance)
+def preload_embedding_tokenizer() -> None:
+    """Load the Qwen tokenizer used for batch packing on a background thread (call at startup)."""
+    get_token_counter(QWEN_MODEL_ID, QWEN_MODEL_REVISION).preload()
 
 
-def rag_tool(query: str) -> Optional[List[float]]:
-    return _rag_instance.embed_query(query)
+class QwenEmbedder:
+    def __init__(self, base_url: Optional[str] = None, timeout: float = 60.0):
+        self.base_url = (base_url or os.getenv("QWEN_EMBEDDING_URL", "http://localhost:9977")).rstrip("/")
+        self.timeout = timeout
+        self.http = TEIClient(self.base_url, timeout=timeout)
+        self.batcher = TEIBatcher(self.http)
 
+    def embed(self, text: str) -> List[float]:
+        return parse_embeddings(self.http.post({"inputs": [text]}))[0]
 
-def semantic_search_patient_cases(query: str, k: int = 5):
-    return _search_instance.search(query, top_k=k)
+    async def aembed(self, text: str) -> List[float]:
+        return parse_embeddings(await self.http.apost({"inputs": [text]}))[0]
 
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        return self.batcher.embed_many(texts)
+
+    async def aembed_many(self, texts: List[str]) -> List[List[float]]:
+        return await self.batcher.aembed_many(texts)
+
+
+class RAGService:
+    def __init__(self, embedder: Optional[QwenEmbedder] = None, cache: Optional[EmbeddingCache] = None):
+        self.embedder = embedder or QwenEmbedder()
+        self.cache = cache if cache is not None else cache_from_env("qwen", QWEN_MODEL_ID, QWEN_MODEL_REVISION)
+
+    def embed_query(self, query: str) -> List[float]:
+        if self.cache is None:
+            return self.embedder.embed(query)
+        return self.cache.get_or_compute(query, self.embedder.embed)
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None:
+            return self.embedder.embed_many(texts)
+        return self.cache.get_or_compute_many(texts, self.embedder.embed_many)
+
+    async def aembed_many(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None:
+            return await self.embedder.aembed_many(texts)
+        return await self.cache.aget_or_compute_many(texts, self.embedder.aembed_many)
+
+    async def aembed_query(self, query: str) -> List[float]:
+        if self.cache is None:
+            return await self.embedder.aembed(query)
+        return await self.cache.aget_or_compute(query, self.embedder.aembed)
 
-from __future__ import annotations
 
-import os
-from typing import Optional, List
-import httpx
 import openai
 
 
 class VectorEncoder:
-    def encode(self, text: str) -> Optional[List[float]]:
+    def encode(self, text: str) -> List[float]:
         raise NotImplementedError
 
+    async def aencode(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self.encode, text)
 
-class QwenVectorEncoder(VectorEncoder):
-    def __init__(self, endpoint: Optional[str] = None):
-        self.endpoint = (endpoint or os.getenv("QWEN_EMBEDDING_URL", "http://localhost:9977")).rstrip("/")
-        self.headers = {"Content-Type": "application/json"}
+    def encode_many(self, texts: List[str]) -> List[List[float]]:
+        return [self.encode(t) for t in texts]
 
-    def _send(self, url: str, text: str):
-        with httpx.Client(timeout=60.0) as client:
-            res = client.post(url, headers=self.headers, json={"inputs": [text]})
-            res.raise_for_status()
-            return res.json()
+    async def aencode_many(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.encode_many, texts)
 
-    def encode(self, text: str) -> Optional[List[float]]:
-        try:
-            try:
-                data = self._send(self.endpoint, text)
-            except httpx.HTTPStatusError:
-                data = self._send(f"{self.endpoint}/embed", text)
 
-            if isinstance(data, dict) and "embeddings" in data:
-                return data["embeddings"][0]
+class QwenVectorEncoder(VectorEncoder):
+    def __init__(self, endpoint: Optional[str] = None):
+        self.endpoint = (endpoint or os.getenv("QWEN_EMBEDDING_URL", "http://localhost:9977")).rstrip("/")
+        self.http = TEIClient(self.endpoint)
+        self.batcher = TEIBatcher(self.http)
 
-            if isinstance(data, list):
-                return data[0]
+    def encode(self, text: str) -> List[float]:
+        return parse_embeddings(self.http.post({"inputs": [text]}))[0]
 
-            if isinstance(data, dict) and "data" in data:
-                item = data["data"][0]
-                return item.get("embedding") if isinstance(item, dict) else item
+    async def aencode(self, text: str) -> List[float]:
+        return parse_embeddings(await self.http.apost({"inputs": [text]}))[0]
 
-        except Exception:
-            return None
+    def encode_many(self, texts: List[str]) -> List[List[float]]:
+        return self.batcher.embed_many(texts)
 
-        return None
+    async def aencode_many(self, texts: List[str]) -> List[List[float]]:
+        return await self.batcher.aembed_many(texts)
 
 
 class OpenAIVectorEncoder(VectorEncoder):
-    def __init__(self, model: str = "text-embedding-3-large"):
+    MAX_INPUTS_PER_REQUEST = 2048
+
+    def __init__(self, model: str = "text-embedding-3-large", dimensions: int = PROVIDER_DIMENSIONS["openai"]):
         openai.api_key = os.getenv("OPENAI_API_KEY")
         self.model = model
+        self.dimensions = dimensions
 
-    def encode(self, text: str) -> Optional[List[float]]:
+    def encode(self, text: str) -> List[float]:
         try:
             res = openai.embeddings.create(
                 model=self.model,
-                input=text
+                input=text,
+                dimensions=self.dimensions,
             )
-            return res.data[0].embedding
-        except Exception:
-            return None
+        except Exception as e:
+            raise EmbeddingServiceError(f"OpenAI embedding request failed: {e}") from e
+        return res.data[0].embedding
+
+    def encode_many(self, texts: List[str]) -> List[List[float]]:
+        # The embeddings endpoint takes up to 2048 inputs per call and returns them indexed.
+        out: List[List[float]] = []
+        for start in range(0, len(texts), self.MAX_INPUTS_PER_REQUEST):
+            chunk = texts[start:start + self.MAX_INPUTS_PER_REQUEST]
+            try:
+                res = openai.embeddings.create(model=self.model, input=chunk, dimensions=self.dimensions)
+            except Exception as e:
+                raise EmbeddingServiceError(f"OpenAI embedding request failed: {e}") from e
+            out.extend(item.embedding for item in sorted(res.data, key=lambda d: d.index))
+        return out
 
 
 class RAGKernel:
-    def __init__(self, provider: str = "qwen"):
+    def __init__(self, provider: str = "qwen", cache: Optional[EmbeddingCache] = None):
+        self.provider = provider
         if provider == "openai":
             self.encoder = OpenAIVectorEncoder()
+            model, revision = self.encoder.model, f"{self.encoder.dimensions}d"
         else:
             self.encoder = QwenVectorEncoder()
+            model, revision = QWEN_MODEL_ID, QWEN_MODEL_REVISION
+        # Stored next to each vector so rows embedded by another model count as stale.
+        self.model_tag = f"{provider}:{model}@{revision}"
+        self.cache = cache if cache is not None else cache_from_env(provider, model, revision)
+
+    def embed(self, query: str) -> List[float]:
+        if self.cache is None:
+            return self.encoder.encode(query)
+        return self.cache.get_or_compute(query, self.encoder.encode)
 
-    def embed(self, query: str) -> Optional[List[float]]:
-        return self.encoder.encode(query)
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None:
+            return self.encoder.encode_many(texts)
+        return self.cache.get_or_compute_many(texts, self.encoder.encode_many)
+
+    async def aembed_many(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None:
+            return await self.encoder.aencode_many(texts)
+        return await self.cache.aget_or_compute_many(texts, self.encoder.aencode_many)
+
+    async def aembed(self, query: str) -> List[float]:
+        if self.cache is None:
+            return await self.encoder.aencode(query)
+        return await self.cache.aget_or_compute(query, self.encoder.aencode)
 
 
 class PatientVectorSearch:
@@ -184,38 +419,42 @@ class PatientVectorSearch:
         self.rag = rag or RAGKernel()
         self.conn = conn
 
+    @contextmanager
     def _conn(self):
         if self.conn:
-            return self.conn
-        from db import get_db_conn
-        return get_db_conn()
-
-    def run(self, query: str, k: int = 5):
+            yield self.conn
+            return
+        from db import get_pool
+        with get_pool().connection() as conn:
+            yield conn
+
+    def run_explained(
+        self,
+        query: str,
+        k: int = 5,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+    ):
+        """Run and report whether the ANN index served the query."""
+        vec = self.rag.embed(query)
+        with self._conn() as conn:
+            results, plan = knn_search(conn, vec, k, ef_search=ef_search, probes=probes, explain=True)
+        return {"results": results, "plan": plan}
+
+    def run(
+        self,
+        query: str,
+        k: int = 5,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+    ):
         vec = self.rag.embed(query)
         if not vec:
             return []
 
-        conn = self._conn()
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT
-                    id,
-                    patient_case_summary,
-                    patient_case_embedding <#> %s AS similarity
-                FROM patients
-                WHERE patient_case_embedding IS NOT NULL
-                ORDER BY similarity ASC
-                LIMIT %s;
-                """,
-                (vec, k)
-            )
-            rows = cur.fetchall()
-
-        return [
-            {"id": r[0], "summary": r[1], "similarity": r[2]}
-            for r in rows
-        ]
+        with self._conn() as conn:
+            results, _ = knn_search(conn, vec, k, ef_search=ef_search, probes=probes)
+        return results
 
 
 _rag_qwen = RAGKernel(provider="qwen")
@@ -225,10 +464,37 @@ _search_qwen = PatientVectorSearch(_rag_qwen)
 _search_openai = PatientVectorSearch(_rag_openai)
 
 
-def rag_tool(query: str, provider: str = "qwen") -> Optional[List[float]]:
+def rag_tool(query: str, provider: str = "qwen") -> List[float]:
     return (_rag_openai if provider == "openai" else _rag_qwen).embed(query)
 
 
-def semantic_search_patient_cases(query: str, k: int = 5, provider: str = "qwen"):
+_search_mmap = {}
+
+
+def _mmap_search(provider: str):
+    # Imported lazily: the snapshot backend needs numpy and imports this module.
+    from tools.mmap_vector_search import MmapPatientVectorSearch
+
+    if provider not in _search_mmap:
+        _search_mmap[provider] = MmapPatientVectorSearch(_rag_openai if provider == "openai" else _rag_qwen)
+    return _search_mmap[provider]
+
+
+def semantic_search_patient_cases(
+    query: str,
+    k: int = 5,
+    provider: str = "qwen",
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+    explain: bool = False,
+    backend: Optional[str] = None,
+):
+    """Top-k similar patient cases from pgvector ("pg") or the memory-mapped snapshot ("mmap")."""
+    record_tables("patients")
+    backend = backend or os.getenv("PATIENT_SEARCH_BACKEND", "pg")
+    if backend == "mmap":
+        return _mmap_search(provider).run(query, k)
     engine = _search_openai if provider == "openai" else _search_qwen
-    return engine.run(query, k)
+    if explain:
+        return engine.run_explained(query, k, ef_search=ef_search, probes=probes)
+    return engine.run(query, k, ef_search=ef_search, probes=probes)
@@ -0,0 +1,422 @@
+# tools/registry.py
+"""
+Tool registry and execution engine.
+
+Every tool declares how it runs:
+
+    "thread"   blocking I/O (HTTP, SMTP, Postgres) on a shared thread pool
+    "process"  CPU-bound work (chart rendering) on a process pool; the function
+               and its arguments must be picklable
+    "async"    a coroutine function awaited on the event loop
+
+and gets its own timeout, concurrency limit and circuit breaker. A concurrency
+slot is held until the underlying work really finishes, so a timed-out call on a
+hung upstream still counts against its tool and cannot pile up threads.
+Per-tool latency histograms are exposed through ``tool_stats()``.
+
+Limits can be overridden per tool with TOOL_<NAME>_TIMEOUT_SECONDS and
+TOOL_<NAME>_MAX_CONCURRENCY.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+import multiprocessing
+from bisect import bisect_left
+from dataclasses import dataclass, replace
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+
+EXECUTION_KINDS = ("thread", "process", "async")
+
+LATENCY_BUCKETS: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Raised for bad arguments from the model; they say nothing about the upstream's health.
+ARGUMENT_ERRORS = (TypeError, ValueError)
+
+
+class ToolError(Exception):
+    """A tool call could not be completed."""
+
+    def __init__(self, tool: str, message: str):
+        super().__init__(f"[{tool}] {message}")
+        self.tool = tool
+
+
+class ToolTimeout(ToolError):
+    pass
+
+
+class ToolUnavailable(ToolError):
+    """The tool's circuit breaker is open."""
+
+
+@dataclass(frozen=True)
+class ToolSpec:
+    name: str
+    fn: Callable[..., Any]
+    kind: str = "thread"
+    timeout_seconds: float = 30.0
+    max_concurrency: int = 4
+    # Circuit breaker: open after this many consecutive failures, retry after reset_seconds.
+    failure_threshold: int = 5
+    reset_seconds: float = 30.0
+
+    def with_env(self) -> "ToolSpec":
+        prefix = f"TOOL_{self.name.upper()}"
+        return replace(
+            self,
+            timeout_seconds=float(os.getenv(f"{prefix}_TIMEOUT_SECONDS", self.timeout_seconds)),
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", self.max_concurrency)),
+        )
+
+
+class CircuitBreaker:
+    """closed -> open after N consecutive failures -> half-open after a cool-down (one probe call)."""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self) -> None:
+        """End a call that proved nothing either way (cancelled, bad arguments); the next call probes."""
+        with self._lock:
+            self._probing = False
+
+
+class LatencyHistogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.counts[bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.total
+        n = sum(counts)
+        cumulative, running = {}, 0
+        for le, c in zip([*map(str, self.buckets), "+Inf"], counts):
+            running += c
+            cumulative[le] = running
+        return {"count": n, "sum_seconds": round(total, 3), "buckets": cumulative}
+
+
+class _Tool:
+    def __init__(self, spec: ToolSpec):
+        self.spec = spec
+        self.breaker = CircuitBreaker(spec.failure_threshold, spec.reset_seconds)
+        self.latency = LatencyHistogram()
+        # asyncio primitives bind to the loop that first uses them.
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._sem_loop = None
+        self.counters: Dict[str, int] = {
+            "calls": 0, "errors": 0, "timeouts": 0, "rejected": 0, "in_flight": 0,
+        }
+
+    def semaphore(self, loop) -> asyncio.Semaphore:
+        if self._sem is None or self._sem_loop is not loop:
+            self._sem = asyncio.Semaphore(self.spec.max_concurrency)
+            self._sem_loop = loop
+        return self._sem
+
+
+def _default_process_workers() -> int:
+    return min(os.cpu_count() or 2, 8)
+
+
+class ToolRegistry:
+    def __init__(
+        self,
+        thread_workers: Optional[int] = None,
+        process_workers: Optional[int] = None,
+        process_initializer: Optional[Callable[[], None]] = None,
+    ):
+        self.thread_workers = thread_workers or int(os.getenv("TOOL_THREAD_POOL_SIZE", "32"))
+        self.process_workers = process_workers or int(
+            os.getenv("TOOL_PROCESS_POOL_SIZE", _default_process_workers())
+        )
+        # Runs once in every worker process (must be a picklable module-level function).
+        self.process_initializer = process_initializer
+        self._tools: Dict[str, _Tool] = {}
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def register(self, spec: ToolSpec) -> ToolSpec:
+        if spec.kind not in EXECUTION_KINDS:
+            raise ValueError(f"Unknown execution kind for {spec.name}: {spec.kind}")
+        spec = spec.with_env()
+        self._tools[spec.name] = _Tool(spec)
+        return spec
+
+    def names(self) -> List[str]:
+        return list(self._tools)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def _executor(self, kind: str):
+        with self._lock:
+            if kind == "thread":
+                if self._threads is None:
+                    self._threads = ThreadPoolExecutor(self.thread_workers, thread_name_prefix="tool")
+                return self._threads
+            if self._processes is None:
+                # spawn: forking a process that runs threads and an event loop is unsafe.
+                self._processes = ProcessPoolExecutor(
+                    self.process_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.process_initializer,
+                )
+            return self._processes
+
+    def prewarm(self) -> None:
+        """Start the worker processes now (running the initializer) instead of on the first call."""
+        pool = self._executor("process")
+        for _ in range(self.process_workers):
+            pool.submit(os.getpid)
+
+    def _discard_pool(self, kind: str) -> None:
+        with self._lock:
+            pool = self._threads if kind == "thread" else self._processes
+            if kind == "thread":
+                self._threads = None
+            else:
+                self._processes = None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, tool: _Tool, kwargs: Dict[str, Any]):
+        spec = tool.spec
+        loop = asyncio.get_running_loop()
+        sem = tool.semaphore(loop)
+        await sem.acquire()
+        tool.counters["in_flight"] += 1
+
+        def release(_=None):
+            tool.counters["in_flight"] -= 1
+            sem.release()
+
+        if spec.kind == "async":
+            try:
+                return await spec.fn(**kwargs)
+            finally:
+                release()
+
+        def release_from_worker(_):
+            try:
+                loop.call_soon_threadsafe(release)
+            except RuntimeError:
+                pass  # loop already closed
+
+        try:
+            if spec.kind == "thread":
+                # Keep context variables (e.g. utils.table_deps recording) inside the tool.
+                ctx = contextvars.copy_context()
+                cf = self._executor("thread").submit(ctx.run, lambda: spec.fn(**kwargs))
+            else:
+                cf = self._executor("process").submit(spec.fn, **kwargs)
+        except BaseException:
+            release()
+            raise
+        # The slot frees when the work finishes, not when the caller stops waiting.
+        cf.add_done_callback(release_from_worker)
+        try:
+            return await asyncio.wrap_future(cf)
+        except BrokenExecutor:
+            # A worker died (e.g. OOM-killed); start a fresh pool for the next call.
+            self._discard_pool(spec.kind)
+            raise
+
+    async def call(self, name: str, **kwargs):
+        tool = self._tools.get(name)
+        if tool is None:
+            raise ToolError(name, "unknown tool")
+        if not tool.breaker.allow():
+            tool.counters["rejected"] += 1
+            raise ToolUnavailable(name, "circuit open after repeated failures")
+
+        tool.counters["calls"] += 1
+        started = time.perf_counter()
+        # Every exit settles the breaker; a half-open probe left pending would keep it open for good.
+        outcome = None
+        try:
+            result = await asyncio.wait_for(self._run(tool, kwargs), timeout=tool.spec.timeout_seconds)
+            outcome = "success"
+            return result
+        except asyncio.TimeoutError:
+            tool.counters["timeouts"] += 1
+            outcome = "failure"
+            raise ToolTimeout(name, f"timed out after {tool.spec.timeout_seconds}s") from None
+        except ARGUMENT_ERRORS:
+            tool.counters["errors"] += 1
+            raise
+        except Exception:
+            tool.counters["errors"] += 1
+            outcome = "failure"
+            raise
+        finally:
+            tool.latency.observe(time.perf_counter() - started)
+            if outcome == "success":
+                tool.breaker.record_success()
+            elif outcome == "failure":
+                tool.breaker.record_failure()
+            else:
+                # Cancelled or bad arguments: the upstream was never really exercised.
+                tool.breaker.release()
+
+    def call_sync(self, name: str, **kwargs):
+        """Run a tool from synchronous code (scripts, tests); not for use inside an event loop."""
+        return asyncio.run(self.call(name, **kwargs))
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        return {
+            name: {
+                "kind": t.spec.kind,
+                "timeout_seconds": t.spec.timeout_seconds,
+                "max_concurrency": t.spec.max_concurrency,
+                "breaker": t.breaker.state,
+                **t.counters,
+                "latency": t.latency.snapshot(),
+            }
+            for name, t in self._tools.items()
+        }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for pool in (self._threads, self._processes):
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            self._threads = self._processes = None
+
+
+# ---- built-in tools ---------------------------------------------------
+
+async def _web_search(**kwargs):
+    from tools.web_tool import aweb_search_tool
+    return await aweb_search_tool(**kwargs)
+
+
+async def _web_search_many(**kwargs):
+    from tools.web_tool import aweb_search_many
+    return await aweb_search_many(**kwargs)
+
+
+async def _send_email(**kwargs):
+    # Delivered through the pooled background mailer instead of a fresh SMTP login per message.
+    from tools.email_queue import send_email_async
+    return await send_email_async(**kwargs)
+
+
+def _patient_search(query: str, k: int = 5, **kwargs):
+    # rag_tool is described to the model as "fetch similar patient cases", so return cases.
+    from tools.rag_tool import semantic_search_patient_cases
+    return semantic_search_patient_cases(query, k=k, **kwargs)
+
+
+def _warm_chart_worker():
+    from tools.charts import warm_up
+    warm_up()
+
+
+def _render_chart(spec, fmt="png"):
+    from tools.charts import render_spec
+    return render_spec(spec, fmt)
+
+
+def _fetch_templated(query_name, params=None):
+    from tools.templated_query_tool import run_templated_query
+    return run_templated_query(query_name, params)
+
+
+async def arender_chart(spec, fmt="png") -> bytes:
+    """PNG/SVG bytes for a chart spec, rendered in a worker process unless already rendered."""
+    from tools.charts import get_chart_store
+    store = get_chart_store()
+    chart_id = store.put(spec)
+    data = store.rendered(chart_id, fmt)
+    if data is None:
+        data = await registry.call("render_chart", spec=spec, fmt=fmt)
+        store.put_rendered(chart_id, fmt, data)
+    return data
+
+
+async def _templated_query(query_name, params=None, chart_format="png"):
+    # The query and the reduction to a chart spec run on the I/O thread pool, the
+    # matplotlib render in a worker process; only the small spec crosses over.
+    from tools.charts import MEDIA_TYPES, chart_output
+    fetched = await registry.call("templated_query_fetch", query_name=query_name, params=params)
+    spec, rendered = fetched["spec"], None
+    if spec is not None and chart_format in MEDIA_TYPES:
+        rendered = await arender_chart(spec, chart_format)
+    return {"overview": fetched["overview"], "chart": chart_output(spec, chart_format, rendered)}
+
+
+registry = ToolRegistry(process_initializer=_warm_chart_worker)
+registry.register(ToolSpec("web_search_tool", _web_search, "async", timeout_seconds=15.0, max_concurrency=8))
+registry.register(ToolSpec("web_search_many", _web_search_many, "async", timeout_seconds=25.0, max_concurrency=4))
+registry.register(ToolSpec("send_email", _send_email, "async", timeout_seconds=30.0, max_concurrency=8))
+registry.register(ToolSpec("rag_tool", _patient_search, "thread", timeout_seconds=20.0, max_concurrency=8))
+registry.register(ToolSpec("templated_query_fetch", _fetch_templated, "thread", timeout_seconds=30.0, max_concurrency=8))
+registry.register(
+    ToolSpec("render_chart", _render_chart, "process", timeout_seconds=30.0, max_concurrency=registry.process_workers)
+)
+registry.register(ToolSpec("templated_query_tool", _templated_query, "async", timeout_seconds=60.0, max_concurrency=8))
+
+# Tools the agent may call; the others are building blocks of these.
+AGENT_TOOL_NAMES = ["web_search_tool", "web_search_many", "send_email", "templated_query_tool", "rag_tool"]
+# Tools that act on the outside world; an answer from a run that called one must not be replayed.
+SIDE_EFFECT_TOOLS = frozenset({"send_email"})
+
+
+def tool_stats() -> Dict[str, Dict[str, object]]:
+    return registry.stats()
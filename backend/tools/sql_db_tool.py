@@ -1,16 +1,22 @@
 from __future__ import annotations
 
 import os
+import re
 import json
 import logging
+from dataclasses import replace
 from datetime import datetime
-from typing import Any, Dict, List, Optional, AsyncGenerator, Callable
+from typing import Any, Awaitable, Dict, List, Optional, AsyncGenerator, Callable, Tuple
 
 from dotenv import load_dotenv
 
 from llm.open_router_llm import make_openrouter_call
 from utils.connection_manager import async_connect, async_disconnect
 from utils.schema_inspector import get_full_database_schema
+from utils.schema_catalog import SchemaCatalog, SchemaSnapshot, get_schema_catalog, render_table_ddl
+from utils.table_router import RouteDecision, TableRouter, get_table_router
+from utils.sql_guard import GuardedResult, SQLGuard, SQLGuardError, get_sql_guard
+from utils.sql_templates import SQLTemplateCache, get_sql_template_cache
 
 
 # Load env
@@ -18,46 +24,23 @@ load_dotenv(os.path.join(os.path.dirname(__file__), "..", ".env"))
 
 logger = logging.getLogger(__name__)
 
+_SQL_FENCE = re.compile(r"```(?:sql)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
 
-class SchemaFormatter:
-    """Turns schema inspector output into text context for LLM prompts."""
-
-    def to_text(self, schema_items: List[Dict[str, Any]]) -> str:
-        blocks: List[str] = []
-
-        for item in schema_items:
-            t = item["table"]
-            table_name = f"{t['schema']}.{t['name']}"
-
-            col_lines: List[str] = []
-            for col in t["columns"]:
-                line = f"  {col['name']} {col['type']}"
-                if not col.get("nullable", True):
-                    line += " NOT NULL"
-                if col.get("is_primary_key"):
-                    line += " PRIMARY KEY"
-                if "foreign_key" in col:
-                    line += f" REFERENCES {col['foreign_key']['references']}"
-                col_lines.append(line)
 
-            ddl = f"CREATE TABLE {table_name} (\n" + ",\n".join(col_lines) + "\n);"
+def extract_sql(reply: str) -> str:
+    m = _SQL_FENCE.search(reply)
+    return (m.group(1) if m else reply).strip()
 
-            if t.get("description"):
-                ddl = f"-- {t['description']}\n{ddl}"
 
-            ddl += f"\n-- Row count: {t.get('row_count')}"
-
-            # Index hints (non-primary)
-            idx_lines: List[str] = []
-            for idx in (t.get("indexes") or []):
-                if not idx.get("is_primary"):
-                    idx_lines.append(f"-- Index: {idx['name']} on {', '.join(idx['columns'])}")
-            if idx_lines:
-                ddl += "\n" + "\n".join(idx_lines)
+class SchemaFormatter:
+    """Turns schema inspector output into text context for LLM prompts."""
 
-            blocks.append(ddl)
+    def table_ddl(self, item: Dict[str, Any]) -> str:
+        # Items from the schema catalog carry their fragment pre-rendered.
+        return item.get("ddl") or render_table_ddl(item["table"])
 
-        return "\n\n".join(blocks)
+    def to_text(self, schema_items: List[Dict[str, Any]]) -> str:
+        return "\n\n".join(self.table_ddl(item) for item in schema_items)
 
     def table_names(self, schema_items: List[Dict[str, Any]]) -> List[str]:
         return [item["table"]["name"] for item in schema_items]
@@ -66,12 +49,101 @@ class SchemaFormatter:
 class SchemaReducer:
     """Filters schema inspector output to only specific tables."""
 
+    def __init__(self, catalog: Optional[SchemaCatalog] = None):
+        self.catalog = catalog or get_schema_catalog()
+
     def filter_by_tables(self, schema_items: List[Dict[str, Any]], tables: List[str]) -> List[Dict[str, Any]]:
         if not tables:
             return schema_items
         wanted = {t.lower() for t in tables}
         return [item for item in schema_items if item["table"]["name"].lower() in wanted]
 
+    def schema_text(self, tables: List[str]) -> str:
+        """Prompt context for the selected tables, stitched from cached per-table fragments."""
+        return self.catalog.snapshot().text(tables)
+
+
+class TableSelector:
+    """Picks the tables for a question: the local router first, the LLM only when it is unsure."""
+
+    def __init__(self, prompts: "PromptFactory", llm_call: Callable[[str], Awaitable[str]],
+                 router: Optional[TableRouter] = None):
+        self.prompts = prompts
+        self.llm_call = llm_call
+        self.router = router or get_table_router()
+
+    async def select(self, user_query: str, snapshot: SchemaSnapshot) -> RouteDecision:
+        """The router's decision; when it is unsure, ``tables`` is the LLM's pick instead."""
+        decision = await self.router.aroute(user_query, snapshot)
+        if decision.confident:
+            logger.info("table router picked %s (confidence %.3f, gap %.3f)",
+                        decision.tables, decision.confidence, decision.gap)
+            return decision
+
+        raw = await self.llm_call(self.prompts.table_selection_prompt(user_query, snapshot.items))
+        try:
+            tables = json.loads(raw.strip().strip("`").removeprefix("json"))["tables"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("unparseable table selection %r; using the router's pick", raw)
+            return decision
+        known = {item["table"]["name"].lower() for item in snapshot.items}
+        picked = [t for t in tables if isinstance(t, str) and t.lower() in known]
+        return replace(decision, tables=picked) if picked else decision
+
+
+class GuardedSQLRunner:
+    """Generates SQL and runs it through the guard; refused plans go back to the model as feedback."""
+
+    def __init__(self, prompts: "PromptFactory", llm_call: Callable[[str], Awaitable[str]],
+                 guard: Optional[SQLGuard] = None, templates: Optional[SQLTemplateCache] = None,
+                 max_attempts: int = 3):
+        self.prompts = prompts
+        self.llm_call = llm_call
+        self.guard = guard or get_sql_guard()
+        self.templates = templates if templates is not None else get_sql_template_cache()
+        self.max_attempts = max_attempts
+
+    async def run(self, user_query: str, snapshot: SchemaSnapshot, tables: List[str],
+                  candidates: Optional[List[str]] = None) -> Tuple[str, GuardedResult]:
+        """
+        SQL for the question over ``tables``. If the model names a relation or column
+        those tables do not have, the schema is widened once to ``candidates`` (the
+        router's wider set), or to every table when that adds nothing, before the next attempt.
+        """
+        if self.templates is not None:
+            match = self.templates.match(user_query, snapshot.version)
+            if match is not None:
+                try:
+                    return match.sql, await self.guard.arun(match.param_sql, match.params)
+                except SQLGuardError as e:
+                    logger.warning("template for %r failed (%s); asking the model", match.template.shape, e)
+                    self.templates.reject(match)
+
+        schema_text = snapshot.text(tables)
+        chosen = {t.lower() for t in tables}
+        wider = [t for t in candidates or () if t.lower() not in chosen]
+        if not wider:
+            wider = [item["table"]["name"] for item in snapshot.items if item["table"]["name"].lower() not in chosen]
+        previous_sql = previous_error = explain_json = None
+        for _ in range(self.max_attempts):
+            sql = extract_sql(await self.llm_call(self.prompts.sql_generation_prompt(
+                user_query, schema_text, previous_sql, previous_error, explain_json,
+            )))
+            try:
+                result = await self.guard.arun(sql)
+            except SQLGuardError as e:
+                logger.info("generated SQL refused: %s", e)
+                previous_sql, previous_error, explain_json = sql, str(e), e.explain_json
+                if e.unknown_name and wider:
+                    # The narrowed schema probably left out a table the question needs.
+                    logger.info("widening the schema with %s", wider)
+                    schema_text, wider = snapshot.text([*tables, *wider]), []
+                continue
+            if self.templates is not None:
+                self.templates.learn(user_query, sql, snapshot.version)
+            return sql, result
+        raise SQLGuardError(f"no acceptable SQL after {self.max_attempts} attempts: {previous_error}", explain_json)
+
 
 class PromptFactory:
     """Builds the two prompts used in the pipeline."""
@@ -2,35 +2,68 @@
 # tools/templated_query_tool.py
 """
 Provides templated SQL queries for common database operations and generates charts based on query results.
+Rows are reduced to a chart spec and rendered by tools/charts.py; overviews and specs are cached
+(tools/query_cache.py) until a table the query reads changes.
+
+Charts are fed by small aggregated result sets: a query's "chart_sql" (same parameters)
+groups into buckets in Postgres, so chart cost does not grow with the table.
+
+Rows that are only summarized (row count + sample) are never pulled in full: the
+sample is read through a server-side cursor and the count comes from a separate
+COUNT(*) or the planner's estimate. Full results stream from GET /queries/{name}/rows
+(tools/query_stream.py), paged by each query's "keyset" columns where it has one.
 """
 
-import matplotlib.pyplot as plt
-import io
-import base64
+import os
+import re
+import json
+import time
+import uuid
+from tools.charts import chart_output, chart_spec
+
+# Batch size for server-side cursors; "exact" counts with COUNT(*), "estimate" uses EXPLAIN.
+QUERY_FETCH_SIZE = int(os.getenv("QUERY_FETCH_SIZE", "1000"))
+QUERY_COUNT_MODE = os.getenv("QUERY_COUNT_MODE", "exact")
+SAMPLE_ROWS = 3
 
 QUERIES = {
 	"get_patient_by_id": {
 		"sql": "SELECT * FROM patients WHERE id = %(patient_id)s;",
-		"chart": None  
+		"chart": None,
+		"keyset": ["id"]
 	},
 	"get_prescriptions_for_patient": {
 		"sql": "SELECT * FROM prescriptions WHERE patient_id = %(patient_id)s ORDER BY prescription_date DESC;",
-		"chart": "prescription_dates"
+		"chart": "prescription_dates",
+		"keyset": ["id"],
+		# Up to 10 equal-width date bins over the patient's range, empty bins included.
+		"chart_sql": (
+			"WITH d AS (SELECT prescription_date AS rx_date FROM prescriptions WHERE patient_id = %(patient_id)s AND prescription_date IS NOT NULL), "
+			"r AS (SELECT MIN(rx_date) AS lo, MAX(rx_date) - MIN(rx_date) + 1 AS span FROM d), "
+			"n AS (SELECT LEAST(10, r.span) AS bins FROM r) "
+			"SELECT r.lo + (b.i - 1) * r.span / n.bins AS bucket_start, COUNT(d.rx_date) AS count "
+			"FROM r CROSS JOIN n CROSS JOIN generate_series(1, n.bins) AS b(i) "
+			"LEFT JOIN d ON width_bucket(d.rx_date - r.lo, 0, r.span, n.bins) = b.i "
+			"WHERE r.lo IS NOT NULL GROUP BY b.i, r.lo, r.span, n.bins ORDER BY b.i;"
+		)
 	},
 	"get_medications_for_prescription": {
 		"sql": "SELECT m.* FROM prescription_medications pm JOIN medications m ON pm.medication_id = m.id WHERE pm.prescription_id = %(prescription_id)s;",
-		"chart": "medication_types"
+		"chart": "medication_types",
+		"chart_sql": "SELECT m.generic_name AS name, COUNT(*) AS count FROM prescription_medications pm JOIN medications m ON pm.medication_id = m.id WHERE pm.prescription_id = %(prescription_id)s GROUP BY m.generic_name ORDER BY count DESC;"
 	},
 	"search_patients_by_name": {
 		"sql": "SELECT * FROM patients WHERE full_name ILIKE %(name)s;",
-		"chart": "age_distribution"
+		"chart": "age_distribution",
+		"keyset": ["id"],
+		"chart_sql": "SELECT (date_part('year', AGE(date_of_birth))::int / 10) * 10 AS age_bucket, COUNT(*) AS count FROM patients WHERE full_name ILIKE %(name)s AND date_of_birth IS NOT NULL GROUP BY age_bucket ORDER BY age_bucket;"
 	},
 	"get_recent_prescriptions": {
 		"sql": "SELECT * FROM prescriptions ORDER BY created_at DESC LIMIT 10;",
 		"chart": "recent_prescriptions"
 	},
 	"patient_age_distribution_by_gender": {
-		"sql": "SELECT gender, EXTRACT(YEAR FROM AGE(date_of_birth)) AS age FROM patients;",
+		"sql": "SELECT gender, (date_part('year', AGE(date_of_birth))::int / 10) * 10 AS age_bucket, COUNT(*) AS count FROM patients WHERE date_of_birth IS NOT NULL GROUP BY gender, age_bucket ORDER BY age_bucket, gender;",
 		"chart": "age_gender_stacked"
 	},
 	"top_prescribed_medication_categories": {
@@ -38,8 +71,9 @@ QUERIES = {
 		"chart": "category_pie"
 	},
 	"monthly_prescription_trends": {
-		"sql": "SELECT TO_CHAR(prescription_date, 'YYYY-MM') AS month, COUNT(*) FROM prescriptions WHERE prescription_date > CURRENT_DATE - INTERVAL '1 year' GROUP BY month ORDER BY month;",
-		"chart": "monthly_line"
+		"sql": "SELECT date_trunc('month', prescription_date)::date AS month, COUNT(*) AS count FROM prescriptions WHERE prescription_date > CURRENT_DATE - INTERVAL '1 year' GROUP BY month ORDER BY month;",
+		"chart": "monthly_line",
+		"keyset": ["month"]
 	},
 	"doctor_prescription_frequency": {
 		"sql": "SELECT doctor_name, COUNT(*) AS count FROM prescriptions GROUP BY doctor_name ORDER BY count DESC LIMIT 10;",
@@ -47,97 +81,143 @@ QUERIES = {
 	},
 	"medication_dosage_patterns": {
 		"sql": "SELECT medication_name, dosage, COUNT(*) AS count FROM prescription_medications GROUP BY medication_name, dosage ORDER BY count DESC;",
-		"chart": "dosage_grouped_bar"
+		"chart": "dosage_grouped_bar",
+		"keyset": ["medication_name", "dosage"]
 	}
 }
 
-def execute_query_and_chart(query_name, db_conn, params):
+def query_sql(query_name):
+	"""Every statement a named query runs (its SQL, plus chart_sql if it has one)."""
 	if query_name not in QUERIES:
 		raise ValueError(f"Unknown query name: {query_name}")
-	sql = QUERIES[query_name]["sql"]
-	chart_type = QUERIES[query_name]["chart"]
+	q = QUERIES[query_name]
+	return [q["sql"]] + ([q["chart_sql"]] if q.get("chart_sql") else [])
+
+_TRAILING_ORDER_BY = re.compile(r"\s+ORDER\s+BY\s+(?:(?!\bLIMIT\b)[^()])*$", re.IGNORECASE)
+
+def _statement(sql):
+	return sql.strip().rstrip(";")
+
+def unordered(sql):
+	"""The statement without its trailing ORDER BY (kept when a LIMIT depends on it)."""
+	return _TRAILING_ORDER_BY.sub("", _statement(sql))
+
+def count_rows(db_conn, sql, params, count_mode=None):
+	"""(row count, estimated) for a query, without transferring its rows."""
+	count_mode = count_mode or QUERY_COUNT_MODE
 	with db_conn.cursor() as cur:
+		if count_mode == "estimate":
+			cur.execute(f"EXPLAIN (FORMAT JSON) {_statement(sql)}", params)
+			plan = cur.fetchone()[0]
+			plan = json.loads(plan) if isinstance(plan, str) else plan
+			return int(plan[0]["Plan"]["Plan Rows"]), True
+		cur.execute(f"SELECT COUNT(*) FROM ({unordered(sql)}) AS q", params)
+		return cur.fetchone()[0], False
+
+def summarize_query(db_conn, sql, params, count_mode=None):
+	"""
+	Overview (row_count, columns, sample) of a query. The sample is read through a
+	server-side cursor, so only SAMPLE_ROWS rows ever leave the server.
+	"""
+	with db_conn.cursor(name=f"tq_{uuid.uuid4().hex}") as cur:
+		cur.itersize = QUERY_FETCH_SIZE
 		cur.execute(sql, params)
-		results = cur.fetchall()
+		sample = cur.fetchmany(SAMPLE_ROWS)
 		columns = [desc[0] for desc in cur.description]
-	overview = {
-		"row_count": len(results),
-		"columns": columns,
-		"sample": results[:3]
-	}
+	overview = {"row_count": len(sample), "columns": columns, "sample": sample}
+	if len(sample) == SAMPLE_ROWS:
+		overview["row_count"], estimated = count_rows(db_conn, sql, params, count_mode)
+		if estimated:
+			overview["row_count_estimated"] = True
+	return overview
+
+def fetch_query(query_name, db_conn, params, count_mode=None):
+	"""
+	Run a named query. Returns (overview, chart_rows, chart_columns, chart_type); the chart
+	rows come from the query's chart_sql when it has one, otherwise from the query itself.
+	"""
+	if query_name not in QUERIES:
+		raise ValueError(f"Unknown query name: {query_name}")
+	sql = QUERIES[query_name]["sql"]
+	chart_type = QUERIES[query_name]["chart"]
+	chart_sql = QUERIES[query_name].get("chart_sql")
+	if chart_type and not chart_sql:
+		# The chart is drawn from this query's own rows (aggregates or LIMITed lists).
+		with db_conn.cursor() as cur:
+			cur.execute(sql, params)
+			results = cur.fetchall()
+			columns = [desc[0] for desc in cur.description]
+		overview = {
+			"row_count": len(results),
+			"columns": columns,
+			"sample": results[:SAMPLE_ROWS]
+		}
+		return overview, results, columns, chart_type
+	overview = summarize_query(db_conn, sql, params, count_mode)
+	chart_rows, chart_columns = None, None
+	if chart_type:
+		with db_conn.cursor() as cur:
+			cur.execute(chart_sql, params)
+			chart_rows = cur.fetchall()
+			chart_columns = [desc[0] for desc in cur.description]
+	return overview, chart_rows, chart_columns, chart_type
+
+def execute_query_and_chart(query_name, db_conn, params, chart_format="png"):
+	overview, results, columns, chart_type = fetch_query(query_name, db_conn, params)
 	chart_img = None
 	if chart_type:
-		chart_img = generate_chart(chart_type, results, columns)
+		chart_img = chart_output(chart_spec(chart_type, results, columns), chart_format)
 	return overview, chart_img
 
+def _record_query_tables(query_name):
+	from utils.table_deps import record_tables, tables_in_sql
+	if query_name in QUERIES:
+		for sql in query_sql(query_name):
+			record_tables(*tables_in_sql(sql))
+
+def _cache_lookup(query_name, params, conn):
+	"""
+	(cache, key, versions, entry) for a named query; entry is the cached result
+	when none of the query's tables has changed since it was stored.
+	"""
+	from tools.query_cache import cache_key, get_query_cache
+	from utils.table_deps import table_versions, tables_in_sql
+	statements = query_sql(query_name)
+	cache = get_query_cache()
+	if cache is None:
+		return None, None, None, None
+	key = cache_key(query_name, params, " ".join(statements))
+	# Read before the query runs: a write that commits meanwhile leaves the entry stale, never wrong.
+	versions = table_versions(set().union(*(tables_in_sql(sql) for sql in statements)), conn)
+	return cache, key, versions, cache.get(key, versions)
+
+def templated_query_tool(query_name, params=None, chart_format="png"):
+	"""
+	Run a named query on a pooled connection and return the overview plus the chart.
+	chart_format: "png" (base64), "svg", "spec" (JSON chart spec) or "url" (links under /charts).
+	"""
+	result = run_templated_query(query_name, params)
+	return {"overview": result["overview"], "chart": chart_output(result["spec"], chart_format)}
+
+def run_templated_query(query_name, params=None):
+	"""
+	Run a named query on a pooled connection and reduce its rows to a chart spec, without rendering.
+	Returns {"overview", "spec"}, from the cache while none of the query's tables has changed.
+	"""
+	from db import get_pool
+	started = time.perf_counter()
+	params = params or {}
+	_record_query_tables(query_name)
+	with get_pool().connection() as conn:
+		cache, key, versions, entry = _cache_lookup(query_name, params, conn)
+		if entry is not None:
+			return {"overview": entry.overview, "spec": entry.spec}
+		overview, results, columns, chart_type = fetch_query(query_name, conn, params)
+	spec = chart_spec(chart_type, results, columns) if chart_type else None
+	if cache is not None:
+		cache.put(key, versions, overview, spec, time.perf_counter() - started)
+	return {"overview": overview, "spec": spec}
+
 def generate_chart(chart_type, results, columns):
-	plt.figure(figsize=(6,4))
-	if chart_type == "prescription_dates":
-		dates = [r[columns.index("prescription_date")] for r in results]
-		plt.hist(dates, bins=10)
-		plt.title("Prescription Dates Distribution")
-		plt.xlabel("Date")
-		plt.ylabel("Count")
-	elif chart_type == "medication_types":
-		meds = [r[columns.index("name")] for r in results]
-		plt.barh(list(set(meds)), [meds.count(m) for m in set(meds)])
-		plt.title("Medication Types")
-		plt.xlabel("Count")
-	elif chart_type == "age_distribution":
-		if "age" in columns:
-			ages = [r[columns.index("age")] for r in results]
-			plt.hist(ages, bins=10)
-			plt.title("Patient Age Distribution")
-			plt.xlabel("Age")
-			plt.ylabel("Count")
-	elif chart_type == "recent_prescriptions":
-		dates = [r[columns.index("created_at")] for r in results]
-		plt.plot(dates, range(len(dates)), marker='o')
-		plt.title("Recent Prescriptions Timeline")
-		plt.xlabel("Date")
-		plt.ylabel("Index")
-	elif chart_type == "age_gender_stacked":
-		import pandas as pd
-		df = pd.DataFrame(results, columns=columns)
-		df['age_bucket'] = (df['age']//10)*10
-		pivot = df.pivot_table(index='age_bucket', columns='gender', aggfunc='size', fill_value=0)
-		pivot.plot(kind='bar', stacked=True, colormap='coolwarm')
-		plt.title("Patient Age Distribution by Gender")
-		plt.xlabel("Age Bucket")
-		plt.ylabel("Count")
-	elif chart_type == "category_pie":
-		cats = [r[columns.index("category")] for r in results]
-		counts = [r[columns.index("count")] for r in results]
-		plt.pie(counts, labels=cats, autopct='%1.1f%%', colors=plt.cm.Pastel1.colors)
-		plt.title("Top Prescribed Medication Categories")
-	elif chart_type == "monthly_line":
-		months = [r[columns.index("month")] for r in results]
-		counts = [r[1] for r in results]
-		plt.plot(months, counts, marker='o', color='navy')
-		plt.xticks(rotation=45)
-		plt.title("Monthly Prescription Trends")
-		plt.xlabel("Month")
-		plt.ylabel("Prescriptions")
-	elif chart_type == "doctor_bar":
-		doctors = [r[columns.index("doctor_name")] for r in results]
-		counts = [r[columns.index("count")] for r in results]
-		plt.barh(doctors, counts, color='limegreen')
-		plt.title("Top Doctors by Prescription Frequency")
-		plt.xlabel("Prescriptions")
-	elif chart_type == "dosage_grouped_bar":
-		import pandas as pd
-		df = pd.DataFrame(results, columns=columns)
-		pivot = df.pivot_table(index='medication_name', columns='dosage', values='count', fill_value=0)
-		pivot.plot(kind='bar', colormap='viridis')
-		plt.title("Medication Dosage Patterns")
-		plt.xlabel("Medication Name")
-		plt.ylabel("Count")
-	else:
-		plt.text(0.5, 0.5, "No chart available", ha='center')
-	buf = io.BytesIO()
-	plt.tight_layout()
-	plt.savefig(buf, format='png')
-	plt.close()
-	buf.seek(0)
-	img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-	return img_base64
+	"""Base64 PNG of the chart for query rows."""
+	return chart_output(chart_spec(chart_type, results, columns), "png")
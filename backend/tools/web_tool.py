@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+import time
+import asyncio
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import date, datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import httpx
 
@@ -17,6 +22,13 @@ class DuckDuckGoConfig:
     timeout_seconds: float = 10.0
     max_related_topics: int = 3
     date_formats: tuple[str, ...] = ("%Y_%m_%d", "%Y-%m-%d")
+    # Results younger than cache_ttl_seconds are served as-is; older ones up to
+    # cache_stale_seconds are served immediately while a refresh runs in the background.
+    cache_ttl_seconds: float = 600.0
+    cache_stale_seconds: float = 3600.0
+    cache_max_entries: int = 512
+    # web_search_many: how many queries are in flight at once.
+    max_parallel_queries: int = 4
 
 
 class DateWindow:
@@ -63,11 +75,23 @@ class DateWindow:
 
 
 class DuckDuckGoClient:
-    def __init__(self, cfg: DuckDuckGoConfig, http: Optional[httpx.Client] = None):
+    def __init__(
+        self,
+        cfg: DuckDuckGoConfig,
+        http: Optional[httpx.Client] = None,
+        ahttp: Optional[httpx.AsyncClient] = None,
+    ):
         self.cfg = cfg
         self.http = http or httpx.Client(timeout=self.cfg.timeout_seconds)
+        self._ahttp = ahttp
 
-    def fetch(self, query: str, df: Optional[str] = None) -> Dict[str, Any]:
+    @property
+    def ahttp(self) -> httpx.AsyncClient:
+        if self._ahttp is None:
+            self._ahttp = httpx.AsyncClient(timeout=self.cfg.timeout_seconds)
+        return self._ahttp
+
+    def _params(self, query: str, df: Optional[str]) -> Dict[str, str]:
         params = {
             "q": query,
             "format": "json",
@@ -76,7 +100,15 @@ class DuckDuckGoClient:
         }
         if df:
             params["df"] = df
-        resp = self.http.get(self.cfg.endpoint, params=params)
+        return params
+
+    def fetch(self, query: str, df: Optional[str] = None) -> Dict[str, Any]:
+        resp = self.http.get(self.cfg.endpoint, params=self._params(query, df))
+        resp.raise_for_status()
+        return resp.json()
+
+    async def afetch(self, query: str, df: Optional[str] = None) -> Dict[str, Any]:
+        resp = await self.ahttp.get(self.cfg.endpoint, params=self._params(query, df))
         resp.raise_for_status()
         return resp.json()
 
@@ -86,12 +118,184 @@ class DuckDuckGoClient:
         except Exception:
             pass
 
+    async def aclose(self) -> None:
+        if self._ahttp is not None:
+            try:
+                await self._ahttp.aclose()
+            except Exception:
+                pass
+            self._ahttp = None
+
+
+CacheKey = Tuple[str, Optional[str]]
+
+
+class _LeaderCancelled(Exception):
+    """The coalescing leader was cancelled before it produced a result."""
+
+
+class SearchResultCache:
+    """
+    TTL cache of raw DuckDuckGo payloads keyed on (normalized query, df window),
+    with stale-while-revalidate and coalescing of identical in-flight fetches.
+    """
+
+    def __init__(self, cfg: DuckDuckGoConfig):
+        self.cfg = cfg
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights: Dict[CacheKey, threading.Event] = {}
+        self._aflights: Dict[CacheKey, asyncio.Future] = {}
+        self._refreshing: set = set()
+        self.counters: Dict[str, int] = {
+            "hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "refreshes": 0, "evictions": 0,
+        }
+
+    @staticmethod
+    def key(query: str, df: Optional[str]) -> CacheKey:
+        return (" ".join(query.split()).casefold(), df)
+
+    def _lookup(self, key: CacheKey) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """(payload, needs_refresh); caller holds self._lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        age = time.monotonic() - entry[0]
+        if age > self.cfg.cache_stale_seconds:
+            del self._entries[key]
+            return None, False
+        self._entries.move_to_end(key)
+        if age <= self.cfg.cache_ttl_seconds:
+            self.counters["hits"] += 1
+            return entry[1], False
+        self.counters["stale_hits"] += 1
+        needs_refresh = key not in self._refreshing
+        if needs_refresh:
+            self._refreshing.add(key)
+        return entry[1], needs_refresh
+
+    def _store(self, key: CacheKey, payload: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.cfg.cache_max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def _refresh_done(self, key: CacheKey) -> None:
+        with self._lock:
+            self._refreshing.discard(key)
+            self.counters["refreshes"] += 1
+
+    def get_or_fetch(self, key: CacheKey, fetch: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        with self._lock:
+            payload, needs_refresh = self._lookup(key)
+            if payload is None:
+                event = self._flights.get(key)
+                leader = event is None
+                if leader:
+                    event = self._flights[key] = threading.Event()
+                    self.counters["misses"] += 1
+                else:
+                    self.counters["coalesced"] += 1
+
+        if payload is not None:
+            if needs_refresh:
+                threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+            return payload
+
+        if not leader:
+            event.wait(self.cfg.timeout_seconds * 2)
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return entry[1]
+            # The leader failed; try ourselves so the caller sees the real error.
+            return fetch()
+
+        try:
+            payload = fetch()
+            self._store(key, payload)
+            return payload
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            event.set()
+
+    def _refresh(self, key: CacheKey, fetch: Callable[[], Dict[str, Any]]) -> None:
+        try:
+            self._store(key, fetch())
+        except Exception as e:
+            LOG.warning("background web search refresh failed: %s", e)
+        finally:
+            self._refresh_done(key)
+
+    async def aget_or_fetch(self, key: CacheKey, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        with self._lock:
+            payload, needs_refresh = self._lookup(key)
+            if payload is None:
+                future = self._aflights.get(key)
+                leader = future is None
+                if leader:
+                    future = self._aflights[key] = asyncio.get_running_loop().create_future()
+                    self.counters["misses"] += 1
+                else:
+                    self.counters["coalesced"] += 1
+
+        if payload is not None:
+            if needs_refresh:
+                asyncio.get_running_loop().create_task(self._arefresh(key, fetch))
+            return payload
+
+        if not leader:
+            try:
+                # shield(): one waiter giving up must not cancel the shared fetch.
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                # Only the leader's caller went away; fetch again (or lead the next flight).
+                return await self.aget_or_fetch(key, fetch)
+
+        try:
+            payload = await fetch()
+        except BaseException as e:
+            future.set_exception(_LeaderCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            future.exception()  # mark retrieved when nobody else is waiting
+            raise
+        else:
+            self._store(key, payload)
+            future.set_result(payload)
+            return payload
+        finally:
+            with self._lock:
+                self._aflights.pop(key, None)
+
+    async def _arefresh(self, key: CacheKey, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> None:
+        try:
+            self._store(key, await fetch())
+        except Exception as e:
+            LOG.warning("background web search refresh failed: %s", e)
+        finally:
+            self._refresh_done(key)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["stale_hits"] + counters["misses"] + counters["coalesced"]
+        served = lookups - counters["misses"]
+        return {
+            "entries": size,
+            "hit_ratio": round(served / lookups, 4) if lookups else 0.0,
+            **counters,
+        }
+
 
 class DuckDuckGoFormatter:
     def __init__(self, cfg: DuckDuckGoConfig):
         self.cfg = cfg
 
-    def format(self, query: str, payload: Dict[str, Any]) -> str:
+    def format(self, query: str, payload: Dict[str, Any], num_results: Optional[int] = None) -> str:
+        limit = self.cfg.max_related_topics if num_results is None else max(int(num_results), 0)
         lines: List[str] = []
 
         if payload.get("Answer"):
@@ -105,7 +309,7 @@ class DuckDuckGoFormatter:
         topics = payload.get("RelatedTopics") or []
         count = 0
         for topic in topics:
-            if count >= self.cfg.max_related_topics:
+            if count >= limit:
                 break
             if isinstance(topic, dict) and topic.get("Text"):
                 count += 1
@@ -118,6 +322,72 @@ class DuckDuckGoFormatter:
 
         return f"Web search results for '{query}':\n" + "\n".join(lines)
 
+    @staticmethod
+    def _flatten(topics: List[Any]) -> List[Dict[str, Any]]:
+        # RelatedTopics may hold groups ({"Name": ..., "Topics": [...]}) next to plain topics.
+        flat: List[Dict[str, Any]] = []
+        for topic in topics or []:
+            if not isinstance(topic, dict):
+                continue
+            if topic.get("Text"):
+                flat.append(topic)
+            elif isinstance(topic.get("Topics"), list):
+                flat.extend(t for t in topic["Topics"] if isinstance(t, dict) and t.get("Text"))
+        return flat
+
+    @staticmethod
+    def _dedupe_key(text: str, url: Optional[str]) -> str:
+        return (url or "").rstrip("/").lower() or " ".join(text.split()).casefold()
+
+    def format_many(
+        self,
+        queries: List[str],
+        payloads: List[Optional[Dict[str, Any]]],
+        num_results: Optional[int] = None,
+    ) -> str:
+        """
+        One block for several searches. Answers, summaries and related topics are
+        de-duplicated by URL (or text); topics returned by more queries rank first,
+        then those ranked higher by DuckDuckGo.
+        """
+        limit = self.cfg.max_related_topics if num_results is None else max(int(num_results), 0)
+        answers: Dict[str, str] = {}
+        summaries: Dict[str, Tuple[str, Optional[str]]] = {}
+        topics: Dict[str, Dict[str, Any]] = {}
+
+        for payload in payloads:
+            if not payload:
+                continue
+            if payload.get("Answer"):
+                answers.setdefault(" ".join(str(payload["Answer"]).split()).casefold(), str(payload["Answer"]))
+            if payload.get("AbstractText"):
+                key = self._dedupe_key(payload["AbstractText"], payload.get("AbstractURL"))
+                summaries.setdefault(key, (payload["AbstractText"], payload.get("AbstractURL")))
+            for position, topic in enumerate(self._flatten(payload.get("RelatedTopics"))):
+                key = self._dedupe_key(topic["Text"], topic.get("FirstURL"))
+                entry = topics.setdefault(key, {"topic": topic, "queries": 0, "best": position})
+                entry["queries"] += 1
+                entry["best"] = min(entry["best"], position)
+
+        lines: List[str] = [f"Answer: {a}" for a in answers.values()]
+        for text, url in summaries.values():
+            lines.append(f"Summary: {text}")
+            if url:
+                lines.append(f"Source: {url}")
+        ranked = sorted(topics.values(), key=lambda e: (-e["queries"], e["best"]))
+        for count, entry in enumerate(ranked[:limit], start=1):
+            lines.append(f"{count}. {entry['topic']['Text']}")
+            if entry["topic"].get("FirstURL"):
+                lines.append(f"   URL: {entry['topic']['FirstURL']}")
+        failed = [q for q, p in zip(queries, payloads) if p is None]
+        if failed:
+            lines.append("Failed searches: " + "; ".join(failed))
+
+        joined = "; ".join(f"'{q}'" for q in queries)
+        if not any(not line.startswith("Failed searches") for line in lines):
+            return f"No web search results found for: {joined}"
+        return f"Web search results for {joined}:\n" + "\n".join(lines)
+
 
 class WebSearchService:
     def __init__(
@@ -126,11 +396,13 @@ class WebSearchService:
         client: Optional[DuckDuckGoClient] = None,
         formatter: Optional[DuckDuckGoFormatter] = None,
         window: Optional[DateWindow] = None,
+        cache: Optional[SearchResultCache] = None,
     ):
         self.cfg = cfg or DuckDuckGoConfig()
         self.window = window or DateWindow(self.cfg)
         self.client = client or DuckDuckGoClient(self.cfg)
         self.formatter = formatter or DuckDuckGoFormatter(self.cfg)
+        self.cache = cache or SearchResultCache(self.cfg)
 
     def search(
         self,
@@ -139,16 +411,92 @@ class WebSearchService:
         from_date: Optional[str] = None,
         to_date: Optional[str] = None,
     ) -> str:
-        try:
-            df = self.window.build_df(from_date, to_date)
-            payload = self.client.fetch(query, df=df)
-            return self.formatter.format(query, payload)
-        except Exception as e:
-            return f"[Web Search Error] {str(e)}"
+        df = self.window.build_df(from_date, to_date)
+        payload = self.cache.get_or_fetch(self.cache.key(query, df), lambda: self.client.fetch(query, df=df))
+        return self.formatter.format(query, payload, num_results)
+
+    async def asearch(
+        self,
+        query: str,
+        num_results: int = 10,
+        from_date: Optional[str] = None,
+        to_date: Optional[str] = None,
+    ) -> str:
+        df = self.window.build_df(from_date, to_date)
+        payload = await self.cache.aget_or_fetch(self.cache.key(query, df), lambda: self.client.afetch(query, df=df))
+        return self.formatter.format(query, payload, num_results)
+
+    def _fetch_cached(self, query: str, df: Optional[str]) -> Dict[str, Any]:
+        return self.cache.get_or_fetch(self.cache.key(query, df), lambda: self.client.fetch(query, df=df))
+
+    async def _afetch_cached(self, query: str, df: Optional[str], sem: asyncio.Semaphore) -> Dict[str, Any]:
+        async with sem:
+            return await self.cache.aget_or_fetch(self.cache.key(query, df), lambda: self.client.afetch(query, df=df))
+
+    @staticmethod
+    def _partial(queries: List[str], outcomes: List[Any]) -> List[Optional[Dict[str, Any]]]:
+        """Failed searches become None; if every search failed, raise the first error."""
+        errors = [o for o in outcomes if isinstance(o, BaseException)]
+        if errors and len(errors) == len(outcomes):
+            raise errors[0]
+        for q, o in zip(queries, outcomes):
+            if isinstance(o, BaseException):
+                if not isinstance(o, Exception):
+                    raise o
+                LOG.warning("web search for %r failed: %s", q, o)
+        return [None if isinstance(o, BaseException) else o for o in outcomes]
+
+    @staticmethod
+    def _unique(queries: List[str]) -> List[str]:
+        seen, unique = set(), []
+        for q in queries:
+            key = " ".join(q.split()).casefold()
+            if key and key not in seen:
+                seen.add(key)
+                unique.append(q)
+        return unique
+
+    def search_many(
+        self,
+        queries: List[str],
+        num_results: int = 10,
+        from_date: Optional[str] = None,
+        to_date: Optional[str] = None,
+    ) -> str:
+        """Run several searches concurrently and merge them into one result block."""
+        queries = self._unique(queries)
+        df = self.window.build_df(from_date, to_date)
+
+        def fetch(q: str):
+            try:
+                return self._fetch_cached(q, df)
+            except Exception as e:
+                return e
+
+        workers = max(1, min(self.cfg.max_parallel_queries, len(queries)))
+        with ThreadPoolExecutor(workers, thread_name_prefix="web-search") as pool:
+            outcomes = list(pool.map(fetch, queries))
+        return self.formatter.format_many(queries, self._partial(queries, outcomes), num_results)
+
+    async def asearch_many(
+        self,
+        queries: List[str],
+        num_results: int = 10,
+        from_date: Optional[str] = None,
+        to_date: Optional[str] = None,
+    ) -> str:
+        queries = self._unique(queries)
+        df = self.window.build_df(from_date, to_date)
+        sem = asyncio.Semaphore(self.cfg.max_parallel_queries)
+        outcomes = await asyncio.gather(*(self._afetch_cached(q, df, sem) for q in queries), return_exceptions=True)
+        return self.formatter.format_many(queries, self._partial(queries, list(outcomes)), num_results)
 
     def close(self) -> None:
         self.client.close()
 
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
 
 _default_search = WebSearchService()
 
@@ -159,9 +507,66 @@ def web_search_tool(
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
 ) -> str:
-    return _default_search.search(
+    try:
+        return _default_search.search(
+            query=query,
+            num_results=num_results,
+            from_date=from_date,
+            to_date=to_date,
+        )
+    except Exception as e:
+        return f"[Web Search Error] {str(e)}"
+
+
+async def aweb_search_tool(
+    query: str,
+    num_results: int = 10,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+) -> str:
+    # Registry path: errors propagate so the tool's circuit breaker sees them; the agent formats them.
+    return await _default_search.asearch(
         query=query,
         num_results=num_results,
         from_date=from_date,
         to_date=to_date,
     )
+
+
+def web_search_many(
+    queries: List[str],
+    num_results: int = 10,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+) -> str:
+    try:
+        return _default_search.search_many(
+            queries=queries,
+            num_results=num_results,
+            from_date=from_date,
+            to_date=to_date,
+        )
+    except Exception as e:
+        return f"[Web Search Error] {str(e)}"
+
+
+async def aweb_search_many(
+    queries: List[str],
+    num_results: int = 10,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+) -> str:
+    return await _default_search.asearch_many(
+        queries=queries,
+        num_results=num_results,
+        from_date=from_date,
+        to_date=to_date,
+    )
+
+
+def web_search_stats() -> Dict[str, object]:
+    return _default_search.cache.stats()
+
+
+async def close_web_search() -> None:
+    await _default_search.aclose()
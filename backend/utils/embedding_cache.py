@@ -0,0 +1,403 @@
+# utils/embedding_cache.py
+"""
+Two-tier cache for text embeddings.
+
+Tier 1 is a bounded in-process LRU. Tier 2 is an optional SQLite file holding
+float32 vectors, so warm entries survive restarts and are shared by workers on
+the same host. Keys are derived from (provider, model, revision, normalized text);
+opening a store for a new revision drops the rows of the old one.
+
+The async paths run SQLite reads and writes on a worker thread, one batch per
+call. A store error (locked or full database) is logged and counted; the
+lookup is treated as a miss and the vectors are computed as if uncached.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import time
+import array
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return _WS.sub(" ", unicodedata.normalize("NFKC", text)).strip().casefold()
+
+
+def _pack(vector: List[float]) -> bytes:
+    return array.array("f", vector).tobytes()
+
+
+def _unpack(blob: bytes) -> List[float]:
+    arr = array.array("f")
+    arr.frombytes(blob)
+    return arr.tolist()
+
+
+class SQLiteVectorStore:
+    """Persistent key -> float32 vector store with least-recently-used trimming."""
+
+    # Trimming scans the table, so only do it every N inserts.
+    TRIM_EVERY = 256
+    # Keys per statement, under SQLite's bound-parameter limit.
+    BATCH = 500
+
+    def __init__(self, path: str, max_entries: int = 200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._puts = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_namespace ON embeddings(namespace)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings(last_access)")
+
+    def get(self, key: str) -> Optional[List[float]]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for lo in range(0, len(keys), self.BATCH):
+                chunk = keys[lo:lo + self.BATCH]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                if rows:
+                    self._db.execute(
+                        f"UPDATE embeddings SET last_access = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        (time.time(), *(r[0] for r in rows)),
+                    )
+                found.update((key, _unpack(blob)) for key, blob in rows)
+        return found
+
+    def put(self, key: str, namespace: str, vector: List[float]) -> int:
+        """Store a vector; returns how many old rows were trimmed."""
+        return self.put_many(namespace, [(key, vector)])
+
+    def put_many(self, namespace: str, items: List[Tuple[str, List[float]]]) -> int:
+        """Store vectors in one transaction; returns how many old rows were trimmed."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, namespace, vector, last_access) VALUES (?, ?, ?, ?)",
+                    [(key, namespace, _pack(vector), now) for key, vector in items],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+            before = self._puts
+            self._puts += len(items)
+            if self._puts // self.TRIM_EVERY == before // self.TRIM_EVERY:
+                return 0
+            return self._trim()
+
+    def _trim(self) -> int:
+        (count,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+        self._db.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+            (excess,),
+        )
+        return excess
+
+    def drop_namespace(self, namespace: str) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM embeddings WHERE namespace = ?", (namespace,)).rowcount
+
+    def drop_other_revisions(self, prefix: str, keep: str) -> int:
+        with self._lock:
+            return self._db.execute(
+                "DELETE FROM embeddings WHERE substr(namespace, 1, ?) = ? AND namespace <> ?",
+                (len(prefix), prefix, keep),
+            ).rowcount
+
+    def count(self, namespace: str) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM embeddings WHERE namespace = ?", (namespace,)
+            ).fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        revision: str = "",
+        max_entries: int = 4096,
+        store: Optional[SQLiteVectorStore] = None,
+    ):
+        self.provider = provider
+        self.model = model
+        self.revision = revision
+        self.max_entries = max_entries
+        self.store = store
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+            "disk_errors": 0,
+        }
+        if self.store is not None:
+            try:
+                dropped = self.store.drop_other_revisions(self._namespace_prefix, self.namespace)
+            except sqlite3.Error as e:
+                self._store_error("cleanup", e)
+                dropped = 0
+            if dropped:
+                LOG.info("embedding cache dropped %d vectors from older %s revisions", dropped, model)
+        _register(self)
+
+    @property
+    def _namespace_prefix(self) -> str:
+        return f"{self.provider}:{self.model}@"
+
+    @property
+    def namespace(self) -> str:
+        return f"{self._namespace_prefix}{self.revision}"
+
+    def key(self, text: str) -> str:
+        raw = f"{self.namespace}\0{normalize_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def _store_error(self, action: str, e: Exception) -> None:
+        LOG.warning("embedding cache store %s failed, continuing without it: %s", action, e)
+        with self._lock:
+            self.counters["disk_errors"] += 1
+
+    def _memory_lookup(self, keys: List[str]) -> List[Optional[List[float]]]:
+        found: List[Optional[List[float]]] = []
+        with self._lock:
+            for key in keys:
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                found.append(vector)
+        return found
+
+    def _disk_lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        if self.store is None or not keys:
+            return {}
+        try:
+            return self.store.get_many(keys)
+        except sqlite3.Error as e:
+            self._store_error("read", e)
+            return {}
+
+    def _disk_store(self, items: List[Tuple[str, List[float]]]) -> None:
+        if self.store is None or not items:
+            return
+        try:
+            trimmed = self.store.put_many(self.namespace, items)
+        except sqlite3.Error as e:
+            self._store_error("write", e)
+            return
+        if trimmed:
+            with self._lock:
+                self.counters["disk_evictions"] += trimmed
+
+    def _merge(self, keys: List[str], cached: List[Optional[List[float]]],
+               found: Dict[str, List[float]]) -> List[Optional[List[float]]]:
+        disk_hits = misses = 0
+        for i, key in enumerate(keys):
+            if cached[i] is not None:
+                continue
+            vector = found.get(key)
+            if vector is None:
+                misses += 1
+                continue
+            cached[i] = vector
+            self._remember(key, vector)
+            disk_hits += 1
+        with self._lock:
+            self.counters["disk_hits"] += disk_hits
+            self.counters["misses"] += misses
+        return cached
+
+    def _remember_many(self, texts: List[str], vectors: List[List[float]]) -> List[Tuple[str, List[float]]]:
+        items = [(self.key(t), v) for t, v in zip(texts, vectors)]
+        for key, vector in items:
+            self._remember(key, vector)
+        return items
+
+    def get(self, text: str) -> Optional[List[float]]:
+        return self.get_many([text])[0]
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [self.key(t) for t in texts]
+        cached = self._memory_lookup(keys)
+        return self._merge(keys, cached, self._disk_lookup([k for k, v in zip(keys, cached) if v is None]))
+
+    async def aget_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [self.key(t) for t in texts]
+        cached = self._memory_lookup(keys)
+        missing = [k for k, v in zip(keys, cached) if v is None]
+        found = await asyncio.to_thread(self._disk_lookup, missing) if missing and self.store is not None else {}
+        return self._merge(keys, cached, found)
+
+    def put(self, text: str, vector: List[float]) -> None:
+        self.put_many([text], [vector])
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]) -> None:
+        self._disk_store(self._remember_many(texts, vectors))
+
+    async def aput_many(self, texts: List[str], vectors: List[List[float]]) -> None:
+        items = self._remember_many(texts, vectors)
+        if self.store is not None:
+            await asyncio.to_thread(self._disk_store, items)
+
+    def get_or_compute(self, text: str, compute: Callable[[str], List[float]]) -> List[float]:
+        vector = self.get(text)
+        if vector is None:
+            vector = compute(text)
+            self.put(text, vector)
+        return vector
+
+    async def aget_or_compute(self, text: str, compute: Callable[[str], Awaitable[List[float]]]) -> List[float]:
+        vector = (await self.aget_many([text]))[0]
+        if vector is None:
+            vector = await compute(text)
+            await self.aput_many([text], [vector])
+        return vector
+
+    def get_or_compute_many(
+        self, texts: List[str], compute_many: Callable[[List[str]], List[List[float]]]
+    ) -> List[List[float]]:
+        cached = self.get_many(texts)
+        missing = [i for i, v in enumerate(cached) if v is None]
+        if not missing:
+            return cached
+        vectors = compute_many([texts[i] for i in missing])
+        for i, v in zip(missing, vectors):
+            cached[i] = v
+        self.put_many([texts[i] for i in missing], vectors)
+        return cached
+
+    async def aget_or_compute_many(
+        self, texts: List[str], compute_many: Callable[[List[str]], Awaitable[List[List[float]]]]
+    ) -> List[List[float]]:
+        cached = await self.aget_many(texts)
+        missing = [i for i, v in enumerate(cached) if v is None]
+        if not missing:
+            return cached
+        vectors = await compute_many([texts[i] for i in missing])
+        for i, v in zip(missing, vectors):
+            cached[i] = v
+        await self.aput_many([texts[i] for i in missing], vectors)
+        return cached
+
+    def invalidate(self, revision: Optional[str] = None) -> None:
+        """Drop every cached vector; optionally switch to a new model revision."""
+        with self._lock:
+            self._lru.clear()
+        if self.store is not None:
+            try:
+                self.store.drop_namespace(self.namespace)
+            except sqlite3.Error as e:
+                self._store_error("invalidate", e)
+        if revision is not None:
+            self.revision = revision
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._lru)
+        lookups = counters["memory_hits"] + counters["disk_hits"] + counters["misses"]
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        return {
+            "namespace": self.namespace,
+            "memory_entries": size,
+            "memory_capacity": self.max_entries,
+            "persistent": self.store is not None,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            **counters,
+        }
+
+
+_caches: List[EmbeddingCache] = []
+_stores: Dict[str, SQLiteVectorStore] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(cache: EmbeddingCache) -> None:
+    with _registry_lock:
+        _caches.append(cache)
+
+
+def get_store(path: str) -> SQLiteVectorStore:
+    """One store per file, shared by every cache in the process."""
+    with _registry_lock:
+        if path not in _stores:
+            max_entries = int(os.getenv("EMBEDDING_CACHE_DISK_MAX_ENTRIES", "200000"))
+            _stores[path] = SQLiteVectorStore(path, max_entries=max_entries)
+        return _stores[path]
+
+
+def cache_from_env(provider: str, model: str, revision: str = "") -> Optional[EmbeddingCache]:
+    """Build a cache from EMBEDDING_CACHE_* settings; EMBEDDING_CACHE_SIZE=0 disables it."""
+    size = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+    if size <= 0:
+        return None
+    path = os.getenv("EMBEDDING_CACHE_PATH")
+    store = None
+    if path:
+        try:
+            store = get_store(path)
+        except Exception as e:
+            LOG.warning("embedding cache store %s unavailable, memory only: %s", path, e)
+    return EmbeddingCache(provider, model, revision, max_entries=size, store=store)
+
+
+def embedding_cache_stats() -> List[Dict[str, object]]:
+    with _registry_lock:
+        caches = list(_caches)
+    return [c.stats() for c in caches]
@@ -1,18 +1,21 @@
 # utils/prompt.py
 
+import os
+import re
+from functools import lru_cache
+
 from utils.tools_prompts import tools_prompts
+from utils.tokenizer import get_token_counter
 
-def build_agent_prompt(enabled_tools=None):
-	"""
-	Build the main agent prompt, injecting enabled tool descriptions.
-	enabled_tools: list of tool names to enable (default: all)
-	"""
-	if enabled_tools is None:
-		enabled_tools = list(tools_prompts.keys())
-	tool_descriptions = "\n\n".join([
-		f"- {name}: {tools_prompts[name]}" for name in enabled_tools if name in tools_prompts
-	])
-	return f"""
+# Tokenizer used for prompt budgeting; falls back to an estimate if it cannot be loaded.
+# The default is an ungated copy of the Command R tokenizer (the CohereForAI repos need a
+# token); a path to a vendored tokenizer.json works too.
+PROMPT_TOKENIZER_ID = os.getenv("PROMPT_TOKENIZER_ID", "Xenova/c4ai-command-r-v01-tokenizer")
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4000"))
+
+AGENT_SYSTEM_PROMPT = "You are a helpful AI Agentic Medical Assistant"
+
+AGENT_PROMPT_HEADER = """
 You are a medical assistant agent. Your job is to help users with medical queries, patient data, and healthcare tasks by reasoning step by step and using available tools when necessary.
 
 Instructions:
@@ -20,21 +23,147 @@ Instructions:
 - When you need information or an action, use one of the provided tools.
 - After using a tool, continue reasoning until you reach a final answer.
 - Format your output clearly for the user.
+- To call tools, set "actions" to a list of {"tool": "<name>", "input": {...}}. Calls that do not depend on each other's results can go in the same step; they run in parallel.
+- Set "finalized" to true only together with the final "response".
 - Your output must always follow this JSON schema:
 
-{{
+{
 	"type": "object",
-	"properties": {{
-		"tool_name": {{"type": "string", "description": "Name of the tool called (if any)"}},
-		"finalized": {{"type": "boolean", "description": "True if reasoning is complete and a final answer is given"}},
-		"thought": {{"type": "string", "description": "Agent's reasoning or explanation"}},
-		"action": {{"type": "string", "description": "Action taken (if any)"}},
-		"observation": {{"type": "string", "description": "Result or output from tool (if any)"}},
-		"response": {{"type": "string", "description": "Final answer to the user (if reasoning is done)"}}
-	}},
+	"properties": {
+		"tool_name": {"type": "string", "description": "Name of the tool called (if any)"},
+		"finalized": {"type": "boolean", "description": "True if reasoning is complete and a final answer is given"},
+		"thought": {"type": "string", "description": "Agent's reasoning or explanation"},
+		"action": {"type": "string", "description": "Action taken (if any)"},
+		"actions": {"type": "array", "description": "Tool calls for this step: [{\"tool\": name, \"input\": {...}}]"},
+		"observation": {"type": "string", "description": "Result or output from tool (if any)"},
+		"response": {"type": "string", "description": "Final answer to the user (if reasoning is done)"}
+	},
 	"required": ["thought", "finalized"]
-}}
+}
 
 Available tools:
-{tool_descriptions}
 """
+
+# Keyword rules for the tool router. A tool is offered when any of its stems
+# starts a word in the query; if nothing matches, every enabled tool is offered.
+TOOL_KEYWORDS = {
+	"web_search_tool": (
+		"search", "web", "internet", "online", "news", "latest", "research", "study", "studies",
+		"article", "guideline", "fda", "who", "cdc", "trial", "http",
+	),
+	"web_search_many": (
+		"search", "web", "online", "latest", "research", "guideline", "interaction", "compare", "versus",
+	),
+	"send_email": ("email", "e-mail", "mail", "send", "notify", "inform", "forward"),
+	"templated_query_tool": (
+		"prescription", "prescribed", "medication", "dosage", "dose", "doctor", "trend", "monthly",
+		"chart", "count", "how many", "distribution", "statistic", "report", "age", "gender", "top",
+	),
+	"rag_tool": (
+		"patient", "case", "similar", "symptom", "diagnos", "condition", "history", "disease",
+		"diabet", "hypertens", "cancer", "treatment",
+	),
+}
+
+_KEYWORD_PATTERNS = {
+	name: re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + r")", re.IGNORECASE)
+	for name, keywords in TOOL_KEYWORDS.items()
+}
+
+
+def _tool_line(name):
+	return f"- {name}: {tools_prompts[name]}"
+
+
+@lru_cache(maxsize=64)
+def _render(enabled_tools):
+	return AGENT_PROMPT_HEADER + "\n\n".join(_tool_line(name) for name in enabled_tools) + "\n"
+
+
+def build_agent_prompt(enabled_tools=None):
+	"""
+	Build the main agent prompt, injecting enabled tool descriptions.
+	enabled_tools: list of tool names to enable (default: all)
+	The rendered prompt is cached per tool set.
+	"""
+	if enabled_tools is None:
+		enabled_tools = list(tools_prompts.keys())
+	return _render(tuple(name for name in enabled_tools if name in tools_prompts))
+
+
+def route_tools(query, enabled_tools=None):
+	"""
+	Tools whose keywords appear in the query, most matches first.
+	Falls back to every enabled tool when the query matches none.
+	"""
+	if enabled_tools is None:
+		enabled_tools = list(tools_prompts.keys())
+	enabled_tools = [name for name in enabled_tools if name in tools_prompts]
+	scores = {}
+	for name in enabled_tools:
+		pattern = _KEYWORD_PATTERNS.get(name)
+		hits = len(pattern.findall(query)) if pattern else 0
+		if hits:
+			scores[name] = hits
+	if not scores:
+		return enabled_tools
+	return sorted(scores, key=lambda name: (-scores[name], enabled_tools.index(name)))
+
+
+def _counter():
+	return get_token_counter(PROMPT_TOKENIZER_ID)
+
+
+def preload_prompt_tokenizer():
+	"""Load the budgeting tokenizer on a background thread (call at startup)."""
+	_counter().preload()
+
+
+# Keyed on exactness so estimates made while the tokenizer loads are not kept.
+@lru_cache(maxsize=2)
+def _header_tokens(exact):
+	return _counter().count(AGENT_PROMPT_HEADER)
+
+
+@lru_cache(maxsize=128)
+def _tool_tokens(name, exact):
+	return _counter().count(_tool_line(name))
+
+
+def build_agent_messages(user_query, history=None, enabled_tools=None, budget=None, system_prompt=AGENT_SYSTEM_PROMPT):
+	"""
+	Chat messages for one agent turn, kept within a token budget.
+
+	Only the tools routed for the query are described. When the budget is tight,
+	the least relevant tool descriptions go first, then the oldest history turns,
+	and finally the user query itself is truncated.
+	history: earlier {"role", "content"} messages, oldest first.
+	"""
+	budget = budget or PROMPT_TOKEN_BUDGET
+	counter = _counter()
+	exact = counter.exact
+	tools = route_tools(user_query, enabled_tools)
+
+	fixed = counter.count(system_prompt) + _header_tokens(exact)
+	query_tokens = counter.count(user_query)
+	while tools and fixed + query_tokens + sum(_tool_tokens(t, exact) for t in tools) > budget:
+		tools.pop()
+	if fixed + query_tokens > budget:
+		user_query = counter.truncate(user_query, max(budget - fixed, 0))
+		query_tokens = counter.count(user_query)
+	remaining = budget - fixed - query_tokens - sum(_tool_tokens(t, exact) for t in tools)
+
+	kept = []
+	history = history or []
+	for message, tokens in zip(reversed(history), reversed(counter.count_many([m["content"] for m in history]))):
+		if tokens > remaining:
+			break
+		kept.append(message)
+		remaining -= tokens
+	kept.reverse()
+
+	return [
+		{"role": "system", "content": system_prompt},
+		*kept,
+		{"role": "user", "content": f"{build_agent_prompt(tools)}\n\n{user_query}"},
+	]
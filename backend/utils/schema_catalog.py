@@ -0,0 +1,253 @@
+# utils/schema_catalog.py
+"""
+Cached schema catalog for the NL2SQL pipeline.
+
+Building the prompt context means introspecting pg_catalog and rendering a
+CREATE TABLE block per table. The schema almost never changes, so the catalog
+keeps the inspector output together with each table's rendered DDL fragment
+("ddl" on every item) and prompts only join cached strings.
+
+The cache is keyed on a schema version. The ``bump_schema_version`` event
+triggers (database/init.sql) increment schema_version.version after DDL on the
+catalogued schema, so checking for changes is one single-row read, done at most
+once per SCHEMA_VERSION_MAX_AGE seconds. On databases without the event triggers
+(they need a superuser), or whose schema_version tracks another schema, the
+version is a hash over the schema's pg_catalog rows. A failed schema_version read
+affects only that check: it keeps the cached version if it came from
+schema_version, and otherwise hashes and tries the table again after
+SCHEMA_VERSION_RETRY_SECONDS.
+
+Row counts are the planner's pg_class.reltuples estimates. They are refreshed
+every SCHEMA_ROW_COUNT_TTL seconds without re-reading the schema, and only the
+fragments of tables whose count moved are re-rendered.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+from utils.schema_inspector import get_full_database_schema, get_row_counts
+
+LOG = logging.getLogger(__name__)
+
+# A DDL change becomes visible to prompts at most this long after it commits.
+SCHEMA_VERSION_MAX_AGE = 1.0
+# After a failed schema_version read, hash pg_catalog for this long before trying again.
+SCHEMA_VERSION_RETRY_SECONDS = 60.0
+
+_FINGERPRINT_SQL = """
+SELECT md5(string_agg(x, ',' ORDER BY x)) FROM (
+    SELECT 'c' || c.oid || ':' || c.xmin
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %(schema)s
+    UNION ALL
+    SELECT 'a' || a.attrelid || '.' || a.attnum || ':' || a.xmin
+    FROM pg_attribute a JOIN pg_class c ON c.oid = a.attrelid JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %(schema)s AND a.attnum > 0
+    UNION ALL
+    SELECT 'k' || con.oid || ':' || con.xmin
+    FROM pg_constraint con JOIN pg_namespace n ON n.oid = con.connamespace
+    WHERE n.nspname = %(schema)s
+    UNION ALL
+    SELECT 'd' || d.objoid || '.' || d.objsubid || ':' || d.xmin
+    FROM pg_description d JOIN pg_class c ON c.oid = d.objoid JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE d.classoid = 'pg_class'::regclass AND n.nspname = %(schema)s
+) AS s(x);
+"""
+
+
+def render_table_ddl(t: Dict[str, Any]) -> str:
+    """Prompt fragment for one table: CREATE TABLE, row count and non-primary index hints."""
+    table_name = f"{t['schema']}.{t['name']}"
+
+    col_lines: List[str] = []
+    for col in t["columns"]:
+        line = f"  {col['name']} {col['type']}"
+        if not col.get("nullable", True):
+            line += " NOT NULL"
+        if col.get("is_primary_key"):
+            line += " PRIMARY KEY"
+        if "foreign_key" in col:
+            line += f" REFERENCES {col['foreign_key']['references']}"
+        col_lines.append(line)
+
+    ddl = f"CREATE TABLE {table_name} (\n" + ",\n".join(col_lines) + "\n);"
+
+    if t.get("description"):
+        ddl = f"-- {t['description']}\n{ddl}"
+
+    ddl += f"\n-- Row count: {t.get('row_count')}"
+
+    # Index hints (non-primary)
+    idx_lines: List[str] = []
+    for idx in (t.get("indexes") or []):
+        if not idx.get("is_primary"):
+            idx_lines.append(f"-- Index: {idx['name']} on {', '.join(idx['columns'])}")
+    if idx_lines:
+        ddl += "\n" + "\n".join(idx_lines)
+
+    return ddl
+
+
+def _with_ddl(table: Dict[str, Any]) -> Dict[str, Any]:
+    return {"table": table, "ddl": render_table_ddl(table)}
+
+
+@dataclass(frozen=True)
+class SchemaSnapshot:
+    """One consistent view of the catalog; never mutated once handed out."""
+    version: str
+    items: List[Dict[str, Any]]
+    by_name: Dict[str, Dict[str, Any]] = field(repr=False)
+
+    def filter(self, tables: Optional[Iterable[str]]) -> List[Dict[str, Any]]:
+        if not tables:
+            return self.items
+        wanted = {t.lower() for t in tables}
+        return [item for item in self.items if item["table"]["name"].lower() in wanted]
+
+    def text(self, tables: Optional[Iterable[str]] = None) -> str:
+        return "\n\n".join(item["ddl"] for item in self.filter(tables))
+
+
+class SchemaCatalog:
+    def __init__(self, schema: str = "public", row_count_ttl: float = 300.0):
+        self.schema = schema
+        self.row_count_ttl = row_count_ttl
+        self._snapshot: Optional[SchemaSnapshot] = None
+        self._checked_at = 0.0
+        self._counts_at = 0.0
+        self._use_fingerprint = False
+        self._retry_version_at = 0.0
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {
+            "hits": 0,
+            "rebuilds": 0,
+            "row_count_refreshes": 0,
+            "fragments_rendered": 0,
+            "version_checks": 0,
+            "build_seconds": 0.0,
+        }
+
+    def _read_version(self, conn) -> str:
+        if not self._use_fingerprint and time.monotonic() >= self._retry_version_at:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT version FROM schema_version WHERE schema_name = %s;", (self.schema,))
+                    row = cur.fetchone()
+                if row is not None:
+                    return f"v{row[0]}"
+                # The event triggers track another schema: hash this one from now on.
+                self._use_fingerprint = True
+            except Exception as e:
+                conn.rollback()
+                cached = self._snapshot.version if self._snapshot is not None else ""
+                if cached.startswith("v"):
+                    # Transient error: treat this check as unchanged and read the table next time.
+                    LOG.warning("could not read schema_version, keeping %s: %s", cached, e)
+                    return cached
+                # Database created before schema_version existed: hash for now, retry later.
+                LOG.warning("could not read schema_version, hashing pg_catalog for %.0fs: %s",
+                            SCHEMA_VERSION_RETRY_SECONDS, e)
+                self._retry_version_at = time.monotonic() + SCHEMA_VERSION_RETRY_SECONDS
+        with conn.cursor() as cur:
+            cur.execute(_FINGERPRINT_SQL, {"schema": self.schema})
+            return f"h{cur.fetchone()[0]}"
+
+    def _rebuild(self, conn, version: str) -> None:
+        start = time.perf_counter()
+        items = [_with_ddl(item["table"]) for item in get_full_database_schema(conn, self.schema)]
+        self._snapshot = SchemaSnapshot(version, items, {i["table"]["name"].lower(): i for i in items})
+        self._counts_at = time.monotonic()
+        self.counters["rebuilds"] += 1
+        self.counters["fragments_rendered"] += len(items)
+        self.counters["build_seconds"] += time.perf_counter() - start
+
+    def _refresh_row_counts(self, conn) -> None:
+        counts = get_row_counts(conn, self.schema)
+        snap = self._snapshot
+        items = []
+        for item in snap.items:
+            t = item["table"]
+            count = counts.get(t["name"], t.get("row_count"))
+            if count != t.get("row_count"):
+                item = _with_ddl({**t, "row_count": count})
+                self.counters["fragments_rendered"] += 1
+            items.append(item)
+        self._snapshot = SchemaSnapshot(snap.version, items, {i["table"]["name"].lower(): i for i in items})
+        self._counts_at = time.monotonic()
+        self.counters["row_count_refreshes"] += 1
+
+    def snapshot(self, conn=None) -> SchemaSnapshot:
+        """The current catalog, rebuilt first if the schema changed since it was cached."""
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is not None and now - self._checked_at <= SCHEMA_VERSION_MAX_AGE \
+                    and now - self._counts_at <= self.row_count_ttl:
+                self.counters["hits"] += 1
+                return self._snapshot
+            if conn is None:
+                from db import get_pool
+
+                with get_pool().connection() as conn:
+                    return self._refresh(conn)
+            return self._refresh(conn)
+
+    def _refresh(self, conn) -> SchemaSnapshot:
+        version = self._read_version(conn)
+        self.counters["version_checks"] += 1
+        self._checked_at = time.monotonic()
+        if self._snapshot is None or self._snapshot.version != version:
+            self._rebuild(conn, version)
+        elif time.monotonic() - self._counts_at > self.row_count_ttl:
+            self._refresh_row_counts(conn)
+        else:
+            self.counters["hits"] += 1
+        return self._snapshot
+
+    async def asnapshot(self) -> SchemaSnapshot:
+        return await asyncio.to_thread(self.snapshot)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = None
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            snap = self._snapshot
+            counters = dict(self.counters)
+            fingerprint = self._use_fingerprint or time.monotonic() < self._retry_version_at
+        counters["build_seconds"] = round(counters["build_seconds"], 3)
+        return {
+            "version": snap.version if snap is not None else None,
+            "version_source": "catalog_hash" if fingerprint else "event_trigger",
+            "tables": len(snap.items) if snap is not None else 0,
+            **counters,
+        }
+
+
+_catalog: Optional[SchemaCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_schema_catalog() -> SchemaCatalog:
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = SchemaCatalog(
+                schema=os.getenv("SCHEMA_CATALOG_SCHEMA", "public"),
+                row_count_ttl=float(os.getenv("SCHEMA_ROW_COUNT_TTL", "300")),
+            )
+        return _catalog
+
+
+def schema_catalog_stats() -> Optional[Dict[str, object]]:
+    with _catalog_lock:
+        catalog = _catalog
+    return catalog.stats() if catalog is not None else None
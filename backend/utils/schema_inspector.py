@@ -0,0 +1,139 @@
+# utils/schema_inspector.py
+"""
+Catalog introspection for the NL2SQL pipeline.
+
+``get_full_database_schema()`` describes every table of a schema in the form
+SchemaFormatter (tools/sql_db_tool.py) renders:
+
+    {"table": {"schema", "name", "description", "row_count",
+               "columns": [{"name", "type", "nullable", "is_primary_key",
+                            "foreign_key": {"references": "schema.table(column)"}}],
+               "indexes": [{"name", "columns", "is_primary"}]}}
+
+It reads pg_catalog with four bulk queries (tables, columns, constraints,
+indexes), whatever the number of tables, and takes row counts from the
+planner's pg_class.reltuples instead of COUNT(*), which would scan every table.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, List, Optional
+
+# Bookkeeping tables maintained by the backend itself, not data to answer questions from.
+INTERNAL_TABLES = frozenset({"table_versions", "table_version_log", "schema_version", "embedding_backfill_checkpoints"})
+
+_TABLES_SQL = """
+SELECT c.oid, c.relname, obj_description(c.oid, 'pg_class'), c.reltuples
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+ORDER BY c.relname;
+"""
+
+_COLUMNS_SQL = """
+SELECT a.attrelid, a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull
+FROM pg_attribute a
+WHERE a.attrelid = ANY(%(oids)s) AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attrelid, a.attnum;
+"""
+
+_CONSTRAINTS_SQL = """
+SELECT con.conrelid, con.contype, a.attname, fn.nspname, fc.relname, fa.attname
+FROM pg_constraint con
+CROSS JOIN LATERAL unnest(con.conkey) WITH ORDINALITY AS k(attnum, ord)
+JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+LEFT JOIN pg_class fc ON fc.oid = con.confrelid
+LEFT JOIN pg_namespace fn ON fn.oid = fc.relnamespace
+LEFT JOIN pg_attribute fa ON fa.attrelid = con.confrelid AND fa.attnum = con.confkey[k.ord]
+WHERE con.conrelid = ANY(%(oids)s) AND con.contype IN ('p', 'f');
+"""
+
+_INDEXES_SQL = """
+SELECT i.indrelid, ic.relname, i.indisprimary,
+       ARRAY(SELECT pg_get_indexdef(i.indexrelid, k, true)
+             FROM generate_series(1, i.indnkeyatts) AS k ORDER BY k)
+FROM pg_index i
+JOIN pg_class ic ON ic.oid = i.indexrelid
+WHERE i.indrelid = ANY(%(oids)s)
+ORDER BY i.indrelid, ic.relname;
+"""
+
+# Row counts alone, for refreshing a cached schema without re-reading it.
+_ROW_COUNTS_SQL = """
+SELECT c.relname, c.reltuples
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p') AND NOT c.relispartition;
+"""
+
+
+def _row_count(reltuples: float) -> Optional[int]:
+    # -1 until the table is first vacuumed or analyzed: unknown, not empty.
+    return int(reltuples) if reltuples >= 0 else None
+
+
+def _read_schema(conn, schema: str, exclude: Iterable[str]) -> List[Dict[str, Any]]:
+    excluded = {t.lower() for t in exclude}
+    with conn.cursor() as cur:
+        cur.execute(_TABLES_SQL, {"schema": schema})
+        tables = {}
+        for oid, name, description, reltuples in cur.fetchall():
+            if name.lower() in excluded:
+                continue
+            tables[oid] = {
+                "schema": schema,
+                "name": name,
+                "description": description,
+                "columns": [],
+                "row_count": _row_count(reltuples),
+                "indexes": [],
+            }
+        if not tables:
+            return []
+        oids = list(tables)
+
+        cur.execute(_COLUMNS_SQL, {"oids": oids})
+        columns: Dict[Any, Dict[str, Dict[str, Any]]] = {oid: {} for oid in oids}
+        for oid, name, type_name, not_null in cur.fetchall():
+            col = {"name": name, "type": type_name, "nullable": not not_null, "is_primary_key": False}
+            columns[oid][name] = col
+            tables[oid]["columns"].append(col)
+
+        cur.execute(_CONSTRAINTS_SQL, {"oids": oids})
+        for oid, kind, column, ref_schema, ref_table, ref_column in cur.fetchall():
+            col = columns[oid].get(column)
+            if col is None:
+                continue
+            if kind == "p":
+                col["is_primary_key"] = True
+            elif "foreign_key" not in col:
+                col["foreign_key"] = {"references": f"{ref_schema}.{ref_table}({ref_column})"}
+
+        cur.execute(_INDEXES_SQL, {"oids": oids})
+        for oid, name, is_primary, index_columns in cur.fetchall():
+            tables[oid]["indexes"].append({"name": name, "columns": list(index_columns), "is_primary": is_primary})
+
+    return [{"table": t} for t in tables.values()]
+
+
+def get_full_database_schema(conn=None, schema: str = "public",
+                             exclude: Iterable[str] = INTERNAL_TABLES) -> List[Dict[str, Any]]:
+    """Schema inspector output for every table in ``schema``, ordered by table name."""
+    if conn is None:
+        from db import get_pool
+
+        with get_pool().connection() as conn:
+            return _read_schema(conn, schema, exclude)
+    return _read_schema(conn, schema, exclude)
+
+
+def get_row_counts(conn=None, schema: str = "public") -> Dict[str, Optional[int]]:
+    """Planner row estimates (pg_class.reltuples) per table; None if never analyzed."""
+    if conn is None:
+        from db import get_pool
+
+        with get_pool().connection() as conn:
+            return get_row_counts(conn, schema)
+    with conn.cursor() as cur:
+        cur.execute(_ROW_COUNTS_SQL, {"schema": schema})
+        return {name: _row_count(reltuples) for name, reltuples in cur.fetchall()}
@@ -0,0 +1,242 @@
+# utils/semantic_cache.py
+"""
+Semantic answer cache for the agent entry points.
+
+Questions are embedded with the Qwen embedder (through RAGService, so repeated
+questions also hit the embedding cache) and kept in a small in-memory matrix of
+unit vectors. A lookup returns the stored answer of the nearest earlier question
+in the same scope when its cosine similarity clears the threshold, the entry is
+within its TTL, and none of the tables the answer was built from has changed.
+
+Two questions that differ in any literal never match, however close their
+embeddings are: numbers ("patient 12" vs "patient 13"), names ("Warfarin" vs
+"Heparin"), emails, dates and quoted strings, as pulled out by the NL2SQL
+template slots (utils.sql_templates.extract_slots).
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.sql_templates import extract_slots
+from utils.table_deps import table_marks, unchanged_since
+
+LOG = logging.getLogger(__name__)
+
+# Digits anywhere, including inside words ("patient12"), which template slots skip.
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def literals_in(text: str) -> Tuple[str, ...]:
+    values = {value.casefold() for _, _, _, value in extract_slots(text)}
+    return tuple(sorted(values.union(_NUMBER.findall(text))))
+
+
+@dataclass
+class SemanticEntry:
+    scope: str
+    question: str
+    answer: str
+    literals: Tuple[str, ...]
+    created_at: float
+    marks: Tuple[Tuple[str, int], ...] = field(default_factory=tuple)
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        rag=None,
+        threshold: float = 0.92,
+        max_entries: int = 2048,
+        ttl_seconds: float = 3600.0,
+    ):
+        if rag is None:
+            from tools.rag_tool import RAGService
+            rag = RAGService()
+        self.rag = rag
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: List[SemanticEntry] = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "stale": 0,
+            "stores": 0,
+            "evictions": 0,
+            "errors": 0,
+        }
+
+    @staticmethod
+    def cacheable(question: str) -> bool:
+        # Structured tool calls ({"action": ...}) must match exactly, not by meaning.
+        q = question.strip()
+        return bool(q) and not q.startswith("{")
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm else v
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def _drop(self, keep: np.ndarray) -> None:
+        # Caller holds self._lock.
+        self._entries = [e for e, k in zip(self._entries, keep) if k]
+        self._vectors = self._vectors[keep]
+
+    def _nearest(self, scope: str, question: str, vec: np.ndarray) -> Optional[SemanticEntry]:
+        now = time.time()
+        literals = literals_in(question)
+        with self._lock:
+            if not self._entries:
+                return None
+            fresh = np.array([now - e.created_at < self.ttl_seconds for e in self._entries])
+            if not fresh.all():
+                self._drop(fresh)
+                if not self._entries:
+                    return None
+            if self._vectors.shape[1] != vec.shape[0]:
+                return None
+            sims = self._vectors @ vec
+            for i in np.argsort(-sims):
+                if sims[i] < self.threshold:
+                    break
+                e = self._entries[i]
+                if e.scope == scope and e.literals == literals:
+                    return e
+        return None
+
+    def _finish_lookup(self, entry: Optional[SemanticEntry], fresh: bool) -> Optional[str]:
+        if entry is None:
+            self._count("misses")
+            return None
+        if not fresh:
+            with self._lock:
+                if any(e is entry for e in self._entries):
+                    self._drop(np.array([e is not entry for e in self._entries]))
+                self.counters["stale"] += 1
+                self.counters["misses"] += 1
+            return None
+        self._count("hits")
+        return entry.answer
+
+    def lookup(self, question: str, scope: str = "default") -> Optional[str]:
+        if not self.cacheable(question):
+            return None
+        try:
+            vec = self._unit(self.rag.embed_query(question))
+        except Exception as e:
+            LOG.warning("semantic cache lookup skipped: %s", e)
+            self._count("errors")
+            return None
+        entry = self._nearest(scope, question, vec)
+        return self._finish_lookup(entry, entry is not None and unchanged_since(entry.marks))
+
+    async def alookup(self, question: str, scope: str = "default") -> Optional[str]:
+        if not self.cacheable(question):
+            return None
+        try:
+            vec = self._unit(await self.rag.aembed_query(question))
+        except Exception as e:
+            LOG.warning("semantic cache lookup skipped: %s", e)
+            self._count("errors")
+            return None
+        entry = self._nearest(scope, question, vec)
+        fresh = entry is not None and await asyncio.to_thread(unchanged_since, entry.marks)
+        return self._finish_lookup(entry, fresh)
+
+    def _add(self, scope: str, question: str, answer: str, vec: np.ndarray, marks) -> None:
+        entry = SemanticEntry(scope, question, answer, literals_in(question), time.time(), marks)
+        with self._lock:
+            if self._vectors.shape[0] == 0 or self._vectors.shape[1] != vec.shape[0]:
+                self._entries, self._vectors = [], np.zeros((0, vec.shape[0]), dtype=np.float32)
+            self._entries.append(entry)
+            self._vectors = np.vstack([self._vectors, vec[None, :]])
+            excess = len(self._entries) - self.max_entries
+            if excess > 0:
+                self._entries = self._entries[excess:]
+                self._vectors = self._vectors[excess:]
+                self.counters["evictions"] += excess
+            self.counters["stores"] += 1
+
+    def store(self, question: str, answer: str, scope: str = "default", tables: Iterable[str] = ()) -> None:
+        if not self.cacheable(question) or not answer:
+            return
+        try:
+            vec = self._unit(self.rag.embed_query(question))
+        except Exception as e:
+            LOG.warning("semantic cache store skipped: %s", e)
+            self._count("errors")
+            return
+        self._add(scope, question, answer, vec, table_marks(tables))
+
+    async def astore(self, question: str, answer: str, scope: str = "default", tables: Iterable[str] = ()) -> None:
+        if not self.cacheable(question) or not answer:
+            return
+        try:
+            vec = self._unit(await self.rag.aembed_query(question))
+        except Exception as e:
+            LOG.warning("semantic cache store skipped: %s", e)
+            self._count("errors")
+            return
+        self._add(scope, question, answer, vec, await asyncio.to_thread(table_marks, tables))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = []
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "entries": size,
+            "capacity": self.max_entries,
+            "threshold": self.threshold,
+            "ttl_seconds": self.ttl_seconds,
+            "hit_ratio": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+            **counters,
+        }
+
+
+_cache: Optional[SemanticAnswerCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> Optional[SemanticAnswerCache]:
+    """Process-wide cache from SEMANTIC_CACHE_* settings; SEMANTIC_CACHE_SIZE=0 disables it."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            size = int(os.getenv("SEMANTIC_CACHE_SIZE", "2048"))
+            if size <= 0:
+                return None
+            _cache = SemanticAnswerCache(
+                threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+                max_entries=size,
+                ttl_seconds=float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600")),
+            )
+        return _cache
+
+
+def semantic_cache_stats() -> Optional[Dict[str, object]]:
+    with _cache_lock:
+        cache = _cache
+    return cache.stats() if cache is not None else None
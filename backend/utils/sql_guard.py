@@ -0,0 +1,226 @@
+# utils/sql_guard.py
+"""
+Pre-execution guard for LLM-generated SQL.
+
+Every generated statement is run as:
+
+    BEGIN; SET TRANSACTION READ ONLY; SET LOCAL statement_timeout = <ms>;
+    EXPLAIN (FORMAT JSON) SELECT * FROM (<sql>) AS guarded LIMIT <row_limit + 1>;
+    -- only if the plan is within limits:
+    SELECT * FROM (<sql>) AS guarded LIMIT <row_limit + 1>;
+    END;
+
+The injected LIMIT caps what is fetched (one extra row tells whether the
+result was truncated). The plan is rejected when its total cost exceeds
+SQL_GUARD_MAX_COST or any node expects more than SQL_GUARD_MAX_ROWS rows,
+which is what a forgotten join condition looks like. A rejected plan, a
+timeout or a database error raises SQLGuardError carrying a compact
+``explain_json``, to be passed back to PromptFactory.sql_generation_prompt
+with the failed SQL and the error. Whatever gets through, statement_timeout
+bounds how long it can hold a backend.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import asyncio
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+import psycopg2
+from psycopg2 import errorcodes, errors
+
+_READ_QUERY = re.compile(r"^[\s(]*(?:SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+_STRIP = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+# Plan keys worth showing the model; the rest is noise for rewriting a query.
+_PLAN_KEYS = ("Node Type", "Join Type", "Relation Name", "Alias", "Index Name", "Total Cost", "Plan Rows",
+              "Hash Cond", "Merge Cond", "Join Filter", "Filter", "Index Cond", "Group Key", "Sort Key")
+
+
+class SQLGuardError(Exception):
+    """Generated SQL refused or failed; feed the message and explain_json back to the model."""
+
+    def __init__(self, message: str, explain_json: Optional[str] = None, pgcode: Optional[str] = None):
+        super().__init__(message)
+        self.explain_json = explain_json
+        self.pgcode = pgcode
+
+    @property
+    def unknown_name(self) -> bool:
+        """The SQL named a relation or column that does not exist, e.g. one left out of the prompt schema."""
+        return self.pgcode in (errorcodes.UNDEFINED_TABLE, errorcodes.UNDEFINED_COLUMN)
+
+
+@dataclass(frozen=True)
+class GuardConfig:
+    max_cost: float = 1_000_000.0
+    max_rows: float = 10_000_000.0
+    row_limit: int = 1000
+    statement_timeout_ms: int = 5000
+
+    @classmethod
+    def from_env(cls) -> "GuardConfig":
+        return cls(
+            max_cost=float(os.getenv("SQL_GUARD_MAX_COST", cls.max_cost)),
+            max_rows=float(os.getenv("SQL_GUARD_MAX_ROWS", cls.max_rows)),
+            row_limit=int(os.getenv("SQL_GUARD_ROW_LIMIT", cls.row_limit)),
+            statement_timeout_ms=int(os.getenv("SQL_GUARD_STATEMENT_TIMEOUT_MS", cls.statement_timeout_ms)),
+        )
+
+
+@dataclass
+class GuardedResult:
+    columns: List[str]
+    rows: List[tuple]
+    truncated: bool
+    plan_cost: float
+    plan_rows: float
+    sql: str
+
+
+def single_statement(sql: str) -> str:
+    """The statement without its trailing semicolon; refuses anything that chains statements."""
+    body = sql.strip().rstrip(";").strip()
+    if not body:
+        raise SQLGuardError("empty SQL")
+    stripped = _STRIP.sub(" ", body)
+    if ";" in stripped:
+        raise SQLGuardError("only a single SELECT statement is allowed")
+    if not _READ_QUERY.match(stripped):
+        # Writes would fail in the read-only transaction anyway; say why up front.
+        raise SQLGuardError("only read queries (SELECT / WITH) are allowed")
+    return body
+
+
+def limited(sql: str, row_limit: int) -> str:
+    # Wrapping keeps the query's own ORDER BY / LIMIT and caps whatever it returns.
+    return f"SELECT * FROM (\n{single_statement(sql)}\n) AS guarded LIMIT {int(row_limit) + 1}"
+
+
+def plan_nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", ()):
+        yield from plan_nodes(child)
+
+
+def plan_summary(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """The plan tree reduced to the keys that explain its cost."""
+    node = {k: plan[k] for k in _PLAN_KEYS if k in plan}
+    if plan.get("Plans"):
+        node["Plans"] = [plan_summary(p) for p in plan["Plans"]]
+    return node
+
+
+class SQLGuard:
+    def __init__(self, cfg: Optional[GuardConfig] = None):
+        self.cfg = cfg or GuardConfig.from_env()
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "checked": 0,
+            "executed": 0,
+            "rejected_cost": 0,
+            "rejected_rows": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "truncated": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def check_plan(self, plan: Dict[str, Any]) -> None:
+        """Raise SQLGuardError if the estimated plan exceeds the configured limits."""
+        explain_json = json.dumps(plan_summary(plan))
+        cost = float(plan.get("Total Cost", 0.0))
+        if cost > self.cfg.max_cost:
+            self._count("rejected_cost")
+            raise SQLGuardError(
+                f"estimated cost {cost:,.0f} exceeds the limit of {self.cfg.max_cost:,.0f}; "
+                "add selective filters or join conditions",
+                explain_json,
+            )
+        widest = max(plan_nodes(plan), key=lambda n: float(n.get("Plan Rows", 0)))
+        rows = float(widest.get("Plan Rows", 0))
+        if rows > self.cfg.max_rows:
+            self._count("rejected_rows")
+            raise SQLGuardError(
+                f"{widest.get('Node Type', 'a plan node')} is estimated to produce {rows:,.0f} rows "
+                f"(limit {self.cfg.max_rows:,.0f}); check for a missing join condition",
+                explain_json,
+            )
+
+    def _run(self, conn, sql: str, params: Optional[Dict[str, Any]]) -> GuardedResult:
+        guarded = limited(sql, self.cfg.row_limit)
+        explain_json = None
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION READ ONLY;")
+            cur.execute("SET LOCAL statement_timeout = %s;", (self.cfg.statement_timeout_ms,))
+            try:
+                cur.execute(f"EXPLAIN (FORMAT JSON) {guarded}", params)
+                plan = cur.fetchone()[0]
+                plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+                self._count("checked")
+                self.check_plan(plan)
+                explain_json = json.dumps(plan_summary(plan))
+
+                cur.execute(guarded, params)
+                rows = cur.fetchall()
+                columns = [d[0] for d in cur.description]
+            except errors.QueryCanceled:
+                self._count("timeouts")
+                raise SQLGuardError(
+                    f"query cancelled after the {self.cfg.statement_timeout_ms} ms statement timeout", explain_json
+                )
+            except psycopg2.Error as e:
+                self._count("errors")
+                raise SQLGuardError(str(e).strip(), explain_json, e.pgcode)
+        self._count("executed")
+        truncated = len(rows) > self.cfg.row_limit
+        if truncated:
+            self._count("truncated")
+        return GuardedResult(columns, rows[: self.cfg.row_limit], truncated,
+                             float(plan.get("Total Cost", 0.0)), float(plan.get("Plan Rows", 0)), guarded)
+
+    def run(self, sql: str, params: Optional[Dict[str, Any]] = None) -> GuardedResult:
+        """Check and execute generated SQL in its own read-only, time-limited transaction."""
+        from db import get_pool
+
+        with get_pool().connection() as conn:
+            return self._run(conn, sql, params)
+
+    async def arun(self, sql: str, params: Optional[Dict[str, Any]] = None) -> GuardedResult:
+        return await asyncio.to_thread(self.run, sql, params)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "max_cost": self.cfg.max_cost,
+            "max_rows": self.cfg.max_rows,
+            "row_limit": self.cfg.row_limit,
+            "statement_timeout_ms": self.cfg.statement_timeout_ms,
+            **counters,
+        }
+
+
+_guard: Optional[SQLGuard] = None
+_guard_lock = threading.Lock()
+
+
+def get_sql_guard() -> SQLGuard:
+    global _guard
+    with _guard_lock:
+        if _guard is None:
+            _guard = SQLGuard()
+        return _guard
+
+
+def sql_guard_stats() -> Optional[Dict[str, object]]:
+    with _guard_lock:
+        guard = _guard
+    return guard.stats() if guard is not None else None
@@ -0,0 +1,358 @@
+# utils/sql_templates.py
+"""
+Question-shape template cache for the NL2SQL pipeline.
+
+Most questions repeat a known shape with a different literal ("Show all
+prescriptions for patient id 14" / "... id 15"). After an NL->SQL pair has
+been validated (it ran successfully), ``learn()`` turns it into a template:
+
+- slots are pulled from the question: quoted strings, emails, dates, numbers,
+  and capitalized names not at the start ("Warfarin", "Dr Ahmad Saeed"); a run
+  of capitalized words is split at connectives ("Warfarin Or Aspirin" is two
+  slots around "Or"), which stay part of the shape;
+- a slot becomes a bind parameter only if its value occurs exactly once among
+  the SQL literals (a bare number, or inside a string literal such as
+  '%Warfarin%' or '1995-12-31'); slots that do not map stay part of the shape;
+- the shape key is the question with the mapped slots replaced by
+  placeholders, so "Patients prescribed Warfarin" and "Patients prescribed
+  Insulin" share one template.
+
+``match()`` fills a template from a new question of a known shape, skipping
+the LLM. A template is only served once it is trusted: a later LLM answer for
+the same shape must have matched the filled template (``TEMPLATE_MIN_CONFIDENCE``
+confirmations). A mismatch replaces it and an execution failure (``reject()``)
+drops it. Every template is tied to the schema version it was learned under
+(utils.schema_catalog); a DDL change empties the cache.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+_QUOTED = re.compile(r"'([^']+)'|\"([^\"]+)\"")
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_DATE = re.compile(r"\b\d{4}-\d{2}-\d{2}\b")
+_NUMBER = re.compile(r"(?<![\w.])\d+(?:\.\d+)?(?![\w.])")
+_NAME = re.compile(r"\b[A-Z][\w'-]*(?:\s+[A-Z][\w'-]*)*")
+_NAME_WORD = re.compile(r"[\w'-]+")
+_TITLES = ("dr", "dr.", "doctor", "mr", "mr.", "mrs", "mrs.", "ms", "ms.")
+# Words that change what a question asks for; never part of a name slot.
+_CONNECTIVES = frozenset({"and", "or", "nor", "vs", "versus", "plus", "not", "but", "except", "with", "without"})
+
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r"(?<![\w.$])\d+(?:\.\d+)?(?![\w.])")
+_WS = re.compile(r"\s+")
+
+# Lookups try every subset of a question's slots; questions rarely have more than a few.
+MAX_SLOTS = 6
+
+
+def normalize_sql(sql: str) -> str:
+    """Loose normalization for comparing generated SQL (as in eval/eval_nl2sql.py)."""
+    return _WS.sub(" ", sql.strip().rstrip(";")).lower()
+
+
+def extract_slots(question: str) -> List[Tuple[int, int, str, str]]:
+    """Non-overlapping (start, end, kind, value) candidates, in question order."""
+    found: List[Tuple[int, int, str, str]] = []
+
+    def add(start: int, end: int, kind: str, value: str) -> None:
+        if all(end <= s or start >= e for s, e, _, _ in found):
+            found.append((start, end, kind, value))
+
+    for m in _QUOTED.finditer(question):
+        g = 1 if m.group(1) is not None else 2
+        add(m.start(g), m.end(g), "s", m.group(g))
+    for m in _EMAIL.finditer(question):
+        add(m.start(), m.end(), "s", m.group())
+    for m in _DATE.finditer(question):
+        add(m.start(), m.end(), "s", m.group())
+    for m in _NUMBER.finditer(question):
+        add(m.start(), m.end(), "n", m.group())
+    for m in _NAME.finditer(question):
+        for start, end in _name_runs(question, m):
+            add(start, end, "s", question[start:end])
+    return sorted(found)
+
+
+def _name_runs(question: str, m: "re.Match[str]") -> List[Tuple[int, int]]:
+    """(start, end) of each name in a run of capitalized words, split at connectives."""
+    runs: List[Tuple[int, int]] = []
+    group: List["re.Match[str]"] = []
+    for w in [*_NAME_WORD.finditer(question, m.start(), m.end()), None]:
+        if w is not None and w.group().lower() not in _CONNECTIVES:
+            group.append(w)
+            continue
+        if group and group[0].start() == len(question) - len(question.lstrip()):
+            group = []  # sentence-initial capital
+        if group and group[0].group().lower() in _TITLES:
+            # "Dr Ahmad Saeed": the title is part of the shape, the name is the slot.
+            group = group[1:]
+        if group:
+            runs.append((group[0].start(), group[-1].end()))
+        group = []
+    return runs
+
+
+def _occurrences(text: str, value: str) -> List[int]:
+    """Case-insensitive positions of value in text, not inside a longer word or number."""
+    out, low, v = [], text.lower(), value.lower()
+    i = low.find(v)
+    while i >= 0:
+        before = low[i - 1] if i > 0 else " "
+        after = low[i + len(v)] if i + len(v) < len(low) else " "
+        if not (before.isalnum() and v[0].isalnum()) and not (after.isalnum() and v[-1].isalnum()):
+            out.append(i)
+        i = low.find(v, i + 1)
+    return out
+
+
+# Template SQL: text pieces and bind pieces. A bind is a list of string parts
+# (literal text or slot index) for a string literal, or a slot index for a number.
+Bind = Union[int, List[Union[str, int]]]
+
+
+@dataclass
+class SQLTemplate:
+    shape: str
+    pieces: List[Union[str, Tuple[Bind]]]
+    kinds: List[str]
+    schema_version: str
+    confidence: int = 0
+    served: int = 0
+    # Slot values it was learned or confirmed with; asking the same question
+    # again says nothing about whether the literals were parameterized right.
+    seen: Set[Tuple[str, ...]] = field(default_factory=set)
+
+    def _bind_value(self, bind: Bind, values: List[str]) -> Union[str, int, float]:
+        if isinstance(bind, int):
+            v = values[bind]
+            return int(v) if v.isdigit() else float(v)
+        return "".join(values[p] if isinstance(p, int) else p for p in bind)
+
+    def fill(self, values: List[str]) -> Tuple[str, str, Dict[str, Any]]:
+        """(literal SQL, pyformat SQL, params) for the given slot values."""
+        literal, bound, params = [], [], {}
+        for piece in self.pieces:
+            if isinstance(piece, str):
+                literal.append(piece)
+                bound.append(piece.replace("%", "%%"))
+                continue
+            name = f"p{len(params)}"
+            value = self._bind_value(piece[0], values)
+            params[name] = value
+            literal.append(str(value) if not isinstance(value, str) else "'" + value.replace("'", "''") + "'")
+            bound.append(f"%({name})s")
+        return "".join(literal), "".join(bound), params
+
+
+@dataclass
+class TemplateMatch:
+    template: SQLTemplate
+    sql: str
+    param_sql: str
+    params: Dict[str, Any]
+
+
+def _shape(question: str, slots: List[Tuple[int, int, str, str]]) -> str:
+    out, pos = [], 0
+    for i, (start, end, kind, _) in enumerate(slots):
+        out.append(question[pos:start].lower())
+        out.append(f"{{{kind}{i}}}")
+        pos = end
+    out.append(question[pos:].lower())
+    return _WS.sub(" ", "".join(out)).strip().rstrip("?.! ")
+
+
+def parameterize(question: str, sql: str, schema_version: str) -> Optional[SQLTemplate]:
+    """Template for a validated pair, or None if filling it back would not reproduce sql."""
+    sql = sql.strip()
+    literals = []  # (start, end, kind, body)
+    for m in _SQL_STRING.finditer(sql):
+        literals.append((m.start(), m.end(), "s", m.group()[1:-1]))
+    strings = [(s, e) for s, e, _, _ in literals]
+    for m in _SQL_NUMBER.finditer(sql):
+        if not any(s <= m.start() < e for s, e in strings):
+            literals.append((m.start(), m.end(), "n", m.group()))
+    literals.sort()
+
+    mapped: List[Tuple[int, int, str, str]] = []
+    # literal index -> list of (offset in body, length, slot index)
+    uses: Dict[int, List[Tuple[int, int, int]]] = {}
+    for start, end, kind, value in extract_slots(question):
+        hits = [(li, off) for li, (_, _, lkind, body) in enumerate(literals)
+                for off in (_occurrences(body, value) if lkind == "s" else ([0] if kind == "n" and body == value else []))]
+        if len(hits) != 1:
+            continue
+        li, off = hits[0]
+        if any(not (off + len(value) <= o or off >= o + n) for o, n, _ in uses.get(li, [])):
+            continue
+        uses.setdefault(li, []).append((off, len(value), len(mapped)))
+        mapped.append((start, end, kind, value))
+
+    if not mapped:
+        return None
+
+    pieces: List[Union[str, Tuple[Bind]]] = []
+    pos = 0
+    for li, (start, end, lkind, body) in enumerate(literals):
+        if li not in uses:
+            continue
+        pieces.append(sql[pos:start])
+        if lkind == "n":
+            pieces.append((uses[li][0][2],))
+        else:
+            parts: List[Union[str, int]] = []
+            cur = 0
+            for off, n, slot in sorted(uses[li]):
+                parts.append(body[cur:off].replace("''", "'"))
+                parts.append(slot)
+                cur = off + n
+            parts.append(body[cur:].replace("''", "'"))
+            pieces.append(([p for p in parts if p != ""],))
+        pos = end
+    pieces.append(sql[pos:])
+
+    values = [v for _, _, _, v in mapped]
+    template = SQLTemplate(_shape(question, mapped), pieces, [k for _, _, k, _ in mapped], schema_version,
+                           seen={tuple(values)})
+    if normalize_sql(template.fill(values)[0]) != normalize_sql(sql):
+        return None
+    return template
+
+
+class SQLTemplateCache:
+    def __init__(self, max_entries: int = 1024, min_confidence: int = 1):
+        self.max_entries = max_entries
+        self.min_confidence = min_confidence
+        self.schema_version: Optional[str] = None
+        self._templates: "OrderedDict[str, SQLTemplate]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "untrusted": 0,
+            "stores": 0,
+            "confirmations": 0,
+            "mismatches": 0,
+            "rejections": 0,
+            "unparameterizable": 0,
+            "evictions": 0,
+            "schema_evictions": 0,
+        }
+
+    def _check_schema(self, schema_version: str) -> None:
+        # Caller holds self._lock.
+        if self.schema_version != schema_version:
+            if self._templates:
+                self.counters["schema_evictions"] += len(self._templates)
+                self._templates.clear()
+            self.schema_version = schema_version
+
+    def _lookup(self, question: str) -> Optional[Tuple[SQLTemplate, List[str]]]:
+        # Caller holds self._lock. Only some question slots may be mapped in
+        # the template, so try the full shape first and then each candidate
+        # subset the stored templates could have been built from.
+        slots = extract_slots(question)[:MAX_SLOTS]
+        n = len(slots)
+        for mask in range((1 << n) - 1, 0, -1):
+            chosen = [s for i, s in enumerate(slots) if mask >> i & 1]
+            template = self._templates.get(_shape(question, chosen))
+            if template is not None and template.kinds == [k for _, _, k, _ in chosen]:
+                return template, [v for _, _, _, v in chosen]
+        return None
+
+    def match(self, question: str, schema_version: str) -> Optional[TemplateMatch]:
+        """A filled SQL for a question of a known, trusted shape, or None (ask the LLM)."""
+        with self._lock:
+            self._check_schema(schema_version)
+            found = self._lookup(question)
+            if found is None:
+                self.counters["misses"] += 1
+                return None
+            template, values = found
+            if template.confidence < self.min_confidence:
+                self.counters["untrusted"] += 1
+                return None
+            self._templates.move_to_end(template.shape)
+            template.served += 1
+            self.counters["hits"] += 1
+        sql, param_sql, params = template.fill(values)
+        return TemplateMatch(template, sql, param_sql, params)
+
+    def learn(self, question: str, sql: str, schema_version: str) -> Optional[SQLTemplate]:
+        """Record an LLM-generated pair that executed successfully."""
+        template = parameterize(question, sql, schema_version)
+        with self._lock:
+            self._check_schema(schema_version)
+            if template is None:
+                self.counters["unparameterizable"] += 1
+                return None
+            current = self._templates.get(template.shape)
+            if current is not None:
+                found = self._lookup(question)
+                values = found[1] if found and found[0] is current else None
+                if values is not None and normalize_sql(current.fill(values)[0]) == normalize_sql(sql):
+                    if tuple(values) not in current.seen:
+                        current.seen.add(tuple(values))
+                        current.confidence += 1
+                        self.counters["confirmations"] += 1
+                    self._templates.move_to_end(current.shape)
+                    return current
+                self.counters["mismatches"] += 1
+            self._templates[template.shape] = template
+            self._templates.move_to_end(template.shape)
+            self.counters["stores"] += 1
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+                self.counters["evictions"] += 1
+            return template
+
+    def reject(self, match: TemplateMatch) -> None:
+        """Drop a served template whose SQL failed to validate or execute."""
+        with self._lock:
+            if self._templates.get(match.template.shape) is match.template:
+                del self._templates[match.template.shape]
+                self.counters["rejections"] += 1
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._templates)
+            trusted = sum(t.confidence >= self.min_confidence for t in self._templates.values())
+        lookups = counters["hits"] + counters["misses"] + counters["untrusted"]
+        return {
+            "templates": size,
+            "trusted": trusted,
+            "capacity": self.max_entries,
+            "schema_version": self.schema_version,
+            "hit_ratio": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+            **counters,
+        }
+
+
+_cache: Optional[SQLTemplateCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_sql_template_cache() -> Optional[SQLTemplateCache]:
+    """Process-wide cache; SQL_TEMPLATE_CACHE_SIZE=0 disables it."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            size = int(os.getenv("SQL_TEMPLATE_CACHE_SIZE", "1024"))
+            if size <= 0:
+                return None
+            _cache = SQLTemplateCache(max_entries=size, min_confidence=int(os.getenv("TEMPLATE_MIN_CONFIDENCE", "1")))
+        return _cache
+
+
+def sql_template_cache_stats() -> Optional[Dict[str, object]]:
+    with _cache_lock:
+        cache = _cache
+    return cache.stats() if cache is not None else None
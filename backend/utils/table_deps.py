@@ -0,0 +1,137 @@
+# utils/table_deps.py
+"""
+Which tables an answer was built from, and whether they have changed since.
+
+Tools call ``record_tables()`` with the tables they read; a caller that wants to
+know what a request touched wraps it in ``collect_tables()``. ``table_marks()``
+returns a per-table change counter from pg_stat_user_tables (inserts + updates +
+deletes), which is cheap, needs no triggers and is shared by every process
+connected to the database. Any change in the counters means the data changed.
+
+The statistics counters are flushed asynchronously, so they can trail a commit
+slightly. Caches that must never serve a result from before a write use
+``table_versions()`` instead: per-table versions advanced by the
+``bump_table_version`` trigger (database/init.sql) inside the writing
+transaction, visible exactly when the write is. A version is the folded
+table_versions.version plus the table's not yet folded table_version_log rows.
+"""
+
+from __future__ import annotations
+
+import re
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+LOG = logging.getLogger(__name__)
+
+_collected: contextvars.ContextVar[Optional[Set[str]]] = contextvars.ContextVar("table_deps", default=None)
+
+_TABLE_REF = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+([A-Za-z_][\w.]*)\b(?!\s*\()", re.IGNORECASE)
+_CTE_NAME = re.compile(r"(?:\bWITH(?:\s+RECURSIVE)?|,)\s+([A-Za-z_]\w*)\s+AS\s*\(", re.IGNORECASE)
+
+
+def tables_in_sql(sql: str) -> Set[str]:
+    """Best-effort list of tables a SQL statement reads or writes (CTE names excluded)."""
+    ctes = {m.group(1).lower() for m in _CTE_NAME.finditer(sql)}
+    return {m.group(1).split(".")[-1].lower() for m in _TABLE_REF.finditer(sql)} - ctes
+
+
+def record_tables(*tables: str) -> None:
+    deps = _collected.get()
+    if deps is not None:
+        deps.update(t.lower() for t in tables)
+
+
+@contextmanager
+def collect_tables() -> Iterator[Set[str]]:
+    """Collect every table recorded inside the block (including from worker threads it awaits)."""
+    deps: Set[str] = set()
+    token = _collected.set(deps)
+    try:
+        yield deps
+    finally:
+        _collected.reset(token)
+
+
+# Counters move on every write, so re-reading them more often than this buys nothing.
+MARKS_MAX_AGE = 1.0
+
+_marks: Dict[str, int] = {}
+_marks_at = 0.0
+_marks_lock = threading.Lock()
+
+
+def _read_marks() -> Dict[str, int]:
+    from db import get_pool
+
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT relname, n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables;"
+        )
+        return {name.lower(): int(count) for name, count in cur.fetchall()}
+
+
+def table_marks(tables: Iterable[str]) -> Tuple[Tuple[str, int], ...]:
+    """Sorted (table, change counter) pairs; unknown tables map to -1."""
+    global _marks, _marks_at
+    tables = sorted(set(tables))
+    if not tables:
+        return ()
+    with _marks_lock:
+        if time.monotonic() - _marks_at > MARKS_MAX_AGE:
+            try:
+                _marks = _read_marks()
+            except Exception as e:
+                # Without counters nothing can be proven fresh; callers treat -2 as changed.
+                LOG.warning("could not read table change counters: %s", e)
+                return tuple((t, -2) for t in tables)
+            _marks_at = time.monotonic()
+        marks = _marks
+    return tuple((t, marks.get(t, -1)) for t in tables)
+
+
+def unchanged_since(marks: Tuple[Tuple[str, int], ...]) -> bool:
+    if not marks:
+        return True
+    if any(m == -2 for _, m in marks):
+        return False
+    return table_marks(t for t, _ in marks) == marks
+
+
+_versions_missing_logged = False
+
+
+def table_versions(tables: Iterable[str], conn=None) -> Optional[Tuple[Tuple[str, int], ...]]:
+    """Sorted (table, version) pairs from table_versions, or None if any table is not tracked."""
+    global _versions_missing_logged
+    tables = sorted(set(tables))
+    if not tables:
+        return ()
+    if conn is None:
+        from db import get_pool
+
+        with get_pool().connection() as conn:
+            return table_versions(tables, conn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT v.table_name, v.version + "
+                "(SELECT count(*) FROM table_version_log l WHERE l.table_name = v.table_name) "
+                "FROM table_versions v WHERE v.table_name = ANY(%s);",
+                (tables,),
+            )
+            versions = {name: int(version) for name, version in cur.fetchall()}
+    except Exception as e:
+        conn.rollback()
+        if not _versions_missing_logged:
+            # Databases created before table_versions existed: re-run database/init.sql.
+            LOG.warning("could not read table versions, result caching disabled: %s", e)
+            _versions_missing_logged = True
+        return None
+    if len(versions) < len(tables):
+        return None
+    return tuple((t, versions[t]) for t in tables)
@@ -0,0 +1,298 @@
+# utils/table_router.py
+"""
+Local table pre-selection for the NL2SQL pipeline.
+
+Asking the LLM which tables a question needs costs a full round trip before
+SQL generation starts. The router answers most questions locally:
+
+- each table is described once per schema version (name, description, column
+  names) and embedded with RAGService, so descriptions hit the embedding cache;
+- a question selects the tables whose cosine similarity is within
+  ROUTER_MARGIN of the best one, plus every table it hits by keyword (table
+  name words, then column name words, with a few domain aliases: "meds",
+  "drug", "rx", "prescribed");
+- the foreign-key graph then adds the tables on the shortest join path
+  between the selected ones, so prescription_medications comes along when
+  patients and medications are both needed.
+
+A decision is confident only on embedding evidence: the best similarity
+clears TABLE_ROUTER_MIN_SIMILARITY and every table left out scores at least
+ROUTER_CONFIDENT_GAP below it. Nearly every question says "patient" or
+"prescription", so a keyword hit alone says little. Otherwise the caller falls
+back to the LLM selection prompt.
+
+Each decision also carries ``candidates``: the selection plus every table
+within ROUTER_WIDE_MARGIN of the best (or above the similarity floor), with
+their join paths. The SQL runner widens to that set when generated SQL names
+a column or relation the narrowed schema did not show.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+
+from utils.schema_catalog import SchemaSnapshot
+
+LOG = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[a-z]+")
+
+TOKEN_ALIASES = {
+    "med": "medication",
+    "medicine": "medication",
+    "drug": "medication",
+    "rx": "prescription",
+    "prescribed": "prescription",
+    "prescribe": "prescription",
+    "taking": "medication",
+    "therapy": "medication",
+    "born": "birth",
+    "age": "birth",
+}
+
+# Column words too generic to say anything about which table is meant.
+_GENERIC_COLUMN_WORDS = frozenset({"id", "name", "at", "created", "updated", "date", "of", "text", "raw", "json", "hash"})
+
+NAME_HIT_WEIGHT = 1.0
+COLUMN_HIT_WEIGHT = 0.5
+ROUTER_MARGIN = 0.05
+ROUTER_CONFIDENT_GAP = 0.1
+ROUTER_WIDE_MARGIN = 0.15
+
+
+def _stem(word: str) -> str:
+    if word.endswith("ies") and len(word) > 4:
+        word = word[:-3] + "y"
+    elif word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        word = word[:-1]
+    return TOKEN_ALIASES.get(word, word)
+
+
+def words(text: str) -> Set[str]:
+    return {_stem(w) for w in _WORD.findall(text.lower().replace("_", " "))}
+
+
+def _references(col: Dict[str, Any]) -> Optional[str]:
+    ref = (col.get("foreign_key") or {}).get("references")
+    if not ref:
+        return None
+    return ref.split("(")[0].split(".")[-1].lower()
+
+
+def table_document(t: Dict[str, Any]) -> str:
+    """The text a table is embedded as."""
+    cols = ", ".join(c["name"].replace("_", " ") for c in t["columns"])
+    desc = f" {t['description']}." if t.get("description") else ""
+    return f"Table {t['name'].replace('_', ' ')}.{desc} Columns: {cols}."
+
+
+@dataclass
+class RouteDecision:
+    tables: List[str]
+    confident: bool
+    confidence: float
+    scores: Dict[str, float] = field(default_factory=dict)
+    joins_added: List[str] = field(default_factory=list)
+    # Similarity of the best table minus that of the best table left out.
+    gap: float = 0.0
+    candidates: List[str] = field(default_factory=list)
+
+
+class TableRouter:
+    def __init__(self, rag=None, min_similarity: float = 0.45):
+        if rag is None:
+            from tools.rag_tool import RAGService
+            rag = RAGService()
+        self.rag = rag
+        self.min_similarity = min_similarity
+        self._version: Optional[str] = None
+        self._names: List[str] = []
+        self._vectors: Optional[np.ndarray] = None
+        self._name_words: Dict[str, Set[str]] = {}
+        self._column_words: Dict[str, Set[str]] = {}
+        self._graph: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "routed": 0,
+            "low_confidence": 0,
+            "join_expansions": 0,
+            "index_builds": 0,
+            "embedding_errors": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    @staticmethod
+    def _unit_rows(vectors: List[List[float]]) -> np.ndarray:
+        m = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return m / norms
+
+    async def _ensure_index(self, snapshot: SchemaSnapshot) -> None:
+        if self._version == snapshot.version:
+            return
+        tables = [item["table"] for item in snapshot.items]
+        names = [t["name"].lower() for t in tables]
+        graph: Dict[str, Set[str]] = {n: set() for n in names}
+        column_words: Dict[str, Set[str]] = {}
+        for name, t in zip(names, tables):
+            column_words[name] = set()
+            for col in t["columns"]:
+                ref = _references(col)
+                if ref is None:
+                    column_words[name] |= words(col["name"]) - _GENERIC_COLUMN_WORDS
+                elif ref in graph and ref != name:
+                    # patient_id names the referenced table, not this one.
+                    graph[name].add(ref)
+                    graph[ref].add(name)
+        try:
+            vectors = self._unit_rows(await self.rag.aembed_many([table_document(t) for t in tables])) if tables else None
+        except Exception as e:
+            # Keyword routing still works; the next request retries the embeddings.
+            LOG.warning("table router embeddings unavailable: %s", e)
+            self._count("embedding_errors")
+            vectors = None
+        with self._lock:
+            self._names = names
+            self._name_words = {n: words(n) for n in names}
+            self._column_words = column_words
+            self._graph = graph
+            self._vectors = vectors
+            self._version = snapshot.version if vectors is not None else None
+            self.counters["index_builds"] += 1
+
+    def _with_joins(self, selected: List[str]) -> List[str]:
+        """Tables on the shortest join paths between the selected ones, not already selected."""
+        joins: List[str] = []
+        for i, a in enumerate(selected):
+            for b in selected[i + 1:]:
+                for t in self._join_path(a, b):
+                    if t not in selected and t not in joins:
+                        joins.append(t)
+        return joins
+
+    def _join_path(self, a: str, b: str) -> List[str]:
+        """Tables strictly between a and b on the shortest foreign-key path."""
+        prev: Dict[str, Optional[str]] = {a: None}
+        queue = deque([a])
+        while queue:
+            node = queue.popleft()
+            if node == b:
+                path = []
+                node = prev[b]
+                while node is not None and node != a:
+                    path.append(node)
+                    node = prev[node]
+                return path
+            for nxt in self._graph.get(node, ()):
+                if nxt not in prev:
+                    prev[nxt] = node
+                    queue.append(nxt)
+        return []
+
+    async def aroute(self, question: str, snapshot: SchemaSnapshot) -> RouteDecision:
+        await self._ensure_index(snapshot)
+        q_words = words(question)
+
+        with self._lock:
+            names, vectors = self._names, self._vectors
+            name_words, column_words = self._name_words, self._column_words
+
+        keyword = np.zeros(len(names), dtype=np.float32)
+        for i, name in enumerate(names):
+            if name_words[name] <= q_words:
+                keyword[i] = NAME_HIT_WEIGHT
+            elif column_words[name] & q_words:
+                keyword[i] = COLUMN_HIT_WEIGHT
+
+        sims = np.zeros(len(names), dtype=np.float32)
+        if vectors is not None:
+            try:
+                q = np.asarray(await self.rag.aembed_query(question), dtype=np.float32)
+                norm = float(np.linalg.norm(q))
+                sims = vectors @ (q / norm if norm else q)
+            except Exception as e:
+                LOG.warning("table router could not embed the question: %s", e)
+                self._count("embedding_errors")
+                vectors = None
+
+        if not names:
+            return RouteDecision([], False, 0.0)
+        # Keywords add tables but never crowd out the ones the embeddings point at
+        # ("insulin prescriptions" names prescriptions, but means prescription_medications).
+        best = float(sims.max())
+        selected = [n for n, sim, k in zip(names, sims, keyword)
+                    if k > 0 or (vectors is not None and sim >= best - ROUTER_MARGIN)]
+        if not selected:
+            selected = list(names)
+        joins = self._with_joins(selected)
+        tables = selected + joins
+
+        left_out = [float(sim) for n, sim in zip(names, sims) if n not in tables]
+        gap = best - max(left_out) if left_out else 1.0
+        # Keywords only add tables; whether the pick is safe is judged on the embeddings
+        # (no embeddings means no confidence).
+        confident = vectors is not None and best >= self.min_similarity and gap >= ROUTER_CONFIDENT_GAP
+
+        if vectors is None:
+            candidates = list(names)
+        else:
+            wide = [n for n, sim in zip(names, sims)
+                    if n not in tables and (sim >= best - ROUTER_WIDE_MARGIN or sim >= self.min_similarity)]
+            candidates = tables + wide
+            candidates += self._with_joins(candidates)
+        self._count("routed")
+        if joins:
+            self._count("join_expansions")
+        if not confident:
+            self._count("low_confidence")
+        return RouteDecision(
+            tables=tables,
+            confident=confident,
+            confidence=round(best, 4),
+            scores={n: round(float(s), 4) for n, s in zip(names, sims + keyword)},
+            joins_added=joins,
+            gap=round(gap, 4),
+            candidates=candidates,
+        )
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+            version, tables = self._version, len(self._names)
+        routed = counters["routed"]
+        return {
+            "schema_version": version,
+            "tables": tables,
+            "confident_ratio": round(1 - counters["low_confidence"] / routed, 4) if routed else 0.0,
+            **counters,
+        }
+
+
+_router: Optional[TableRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_table_router() -> TableRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = TableRouter(min_similarity=float(os.getenv("TABLE_ROUTER_MIN_SIMILARITY", "0.45")))
+        return _router
+
+
+def table_router_stats() -> Optional[Dict[str, object]]:
+    with _router_lock:
+        router = _router
+    return router.stats() if router is not None else None
@@ -0,0 +1,98 @@
+# utils/tokenizer.py
+"""
+Token counting backed by the Hugging Face `tokenizers` package.
+
+The tokenizer is downloaded from the hub once per (model, revision) and shared;
+``model_id`` may also be the path of a vendored tokenizer.json. If it cannot be
+loaded (offline, missing package) we fall back to a conservative
+character-based estimate so callers never fail just because counting is degraded.
+
+Servers call ``preload()`` at startup so the download happens on a background
+thread; until it finishes, counts are estimated instead of blocking the caller.
+"""
+
+from __future__ import annotations
+
+import os
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+
+# Rough upper bound for BPE tokenizers on English/medical text.
+CHARS_PER_TOKEN_ESTIMATE = 3
+
+
+class TokenCounter:
+    def __init__(self, model_id: str, revision: Optional[str] = None):
+        self.model_id = model_id
+        self.revision = revision
+        self._tokenizer = None
+        self._loaded = False
+        self._loader: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def preload(self) -> None:
+        """Start loading on a background thread; counts are estimated until it is ready."""
+        with self._lock:
+            if self._loaded or self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self._load, name="tokenizer-load", daemon=True)
+        self._loader.start()
+
+    def _load(self):
+        if self._loaded:
+            return self._tokenizer
+        if self._loader is not None and threading.current_thread() is not self._loader:
+            return None  # still loading in the background
+        with self._lock:
+            if not self._loaded:
+                try:
+                    from tokenizers import Tokenizer
+                    if os.path.isfile(self.model_id):
+                        self._tokenizer = Tokenizer.from_file(self.model_id)
+                    else:
+                        self._tokenizer = Tokenizer.from_pretrained(self.model_id, revision=self.revision or "main")
+                except Exception as e:
+                    LOG.warning("tokenizer %s unavailable, estimating token counts: %s", self.model_id, e)
+                    self._tokenizer = None
+                self._loaded = True
+        return self._tokenizer
+
+    @property
+    def exact(self) -> bool:
+        return self._load() is not None
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        tokenizer = self._load()
+        if tokenizer is None:
+            return [len(t) // CHARS_PER_TOKEN_ESTIMATE + 1 for t in texts]
+        return [len(enc.ids) for enc in tokenizer.encode_batch(texts, add_special_tokens=True)]
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Longest prefix of ``text`` that fits in ``max_tokens`` tokens."""
+        if max_tokens <= 0:
+            return ""
+        tokenizer = self._load()
+        if tokenizer is None:
+            return text[:(max_tokens - 1) * CHARS_PER_TOKEN_ESTIMATE]
+        enc = tokenizer.encode(text, add_special_tokens=False)
+        if len(enc.ids) <= max_tokens:
+            return text
+        return text[:enc.offsets[max_tokens - 1][1]]
+
+
+_counters: Dict[Tuple[str, Optional[str]], TokenCounter] = {}
+_counters_lock = threading.Lock()
+
+
+def get_token_counter(model_id: str, revision: Optional[str] = None) -> TokenCounter:
+    key = (model_id, revision)
+    with _counters_lock:
+        if key not in _counters:
+            _counters[key] = TokenCounter(model_id, revision)
+        return _counters[key]
@@ -12,8 +12,22 @@ tools_prompts = {
         "  }\n"
         "}"
     ),
+    "web_search_many": (
+        "Use this tool instead of several web_search_tool calls when a question needs more than one search "
+        "(e.g. drug, interaction and guideline). The searches run in parallel and the results come back merged and de-duplicated. "
+        "Tool Call Format:\n"
+        "{\n"
+        "  'tool': 'web_search_many',\n"
+        "  'input': {\n"
+        "    'queries': ['<search query>', '<search query>'],\n"
+        "    'num_results': <number>,\n"
+        "    'from_date': '<YYYY_MM_DD>',\n"
+        "    'to_date': '<YYYY_MM_DD>'\n"
+        "  }\n"
+        "}"
+    ),
     "send_email": (
-        "Use this tool to send an email via SMTP. You must provide recipient, subject, and body. SMTP configuration is hardcoded in the tool. "
+        "Use this tool to send an email via SMTP. You must provide recipient, subject, and body. SMTP settings come from the server configuration. "
         "Tool Call Format:\n"
         "{\n"
         "  'tool': 'send_email',\n"
@@ -26,6 +40,7 @@ tools_prompts = {
     ),
     "templated_query_tool": (
         "Use this tool to run a named SQL query and get a results overview and chart. "
+        "The chart comes back as a link you can include in your answer. "
         "Tool Call Format:\n"
         "{\n"
         "  'tool': 'templated_query_tool',\n"
@@ -0,0 +1,226 @@
+# vector_index.py
+"""
+Typed pgvector column and ANN index management for patients.patient_case_embedding,
+plus the shared k-NN query used by the patient semantic search tools.
+
+    python -m vector_index --provider qwen --method hnsw
+    python -m vector_index --method ivfflat --lists 1000
+
+The column is typed to the active provider's dimension (rows with other dimensions
+are cleared so the backfill worker re-embeds them) and the index is (re)built
+concurrently with the operator class matching the search distance operator.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import argparse
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import get_db_conn, vector_literal
+
+LOG = logging.getLogger(__name__)
+
+TABLE = "patients"
+COLUMN = "patient_case_embedding"
+
+# Dimension stored per provider. OpenAI vectors are requested shortened to 1536 so they
+# stay under pgvector's 2000-dimension limit for indexed `vector` columns.
+PROVIDER_DIMENSIONS: Dict[str, int] = {"qwen": 1024, "openai": 1536}
+
+# `<#>` (negative inner product) is what the search tools order by.
+DISTANCE_OPERATOR = "<#>"
+OPERATOR_CLASSES = {"<#>": "vector_ip_ops", "<=>": "vector_cosine_ops", "<->": "vector_l2_ops"}
+
+INDEX_NAMES = {"hnsw": f"{TABLE}_case_embedding_hnsw", "ivfflat": f"{TABLE}_case_embedding_ivfflat"}
+
+# pgvector's hnsw.ef_search default, used when a search does not pass its own.
+DEFAULT_EF_SEARCH = 40
+
+
+@dataclass(frozen=True)
+class IndexConfig:
+    method: str = "hnsw"
+    # HNSW build parameters
+    m: int = 16
+    ef_construction: int = 64
+    # IVFFlat build parameter; None = rows / 1000 (min 10), or sqrt(rows) above a million rows
+    lists: Optional[int] = None
+    maintenance_work_mem: str = "512MB"
+
+
+KNN_SQL = f"""
+    SELECT
+        id,
+        patient_case_summary,
+        {COLUMN} {DISTANCE_OPERATOR} %(vector)s::vector AS similarity
+    FROM {TABLE}
+    WHERE {COLUMN} IS NOT NULL
+    ORDER BY similarity ASC
+    LIMIT %(k)s;
+"""
+
+
+def column_type(cur) -> str:
+    cur.execute(
+        """
+        SELECT format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attname = %s AND NOT a.attisdropped;
+        """,
+        (TABLE, COLUMN),
+    )
+    row = cur.fetchone()
+    return row[0] if row else ""
+
+
+def ensure_vector_column(conn, provider: str = "qwen") -> bool:
+    """Type the embedding column as vector(dim) for ``provider``; returns True if it changed."""
+    dim = PROVIDER_DIMENSIONS[provider]
+    wanted = f"vector({dim})"
+    with conn.cursor() as cur:
+        if column_type(cur) == wanted:
+            return False
+        cur.execute(
+            f"UPDATE {TABLE} SET {COLUMN} = NULL WHERE {COLUMN} IS NOT NULL AND vector_dims({COLUMN}) <> %s;",
+            (dim,),
+        )
+        LOG.info("cleared %d vectors with a dimension other than %d", cur.rowcount, dim)
+        cur.execute(f"ALTER TABLE {TABLE} ALTER COLUMN {COLUMN} TYPE {wanted};")
+    conn.commit()
+    return True
+
+
+def _default_lists(rows: int) -> int:
+    if rows <= 1_000_000:
+        return max(10, rows // 1000)
+    return int(rows ** 0.5)
+
+
+def build_index(conn, cfg: Optional[IndexConfig] = None) -> str:
+    """(Re)build the ANN index for ``cfg.method`` and drop the other method's index."""
+    cfg = cfg or IndexConfig()
+    if cfg.method not in INDEX_NAMES:
+        raise ValueError(f"Unknown index method: {cfg.method}")
+    name = INDEX_NAMES[cfg.method]
+    opclass = OPERATOR_CLASSES[DISTANCE_OPERATOR]
+
+    if cfg.method == "hnsw":
+        options = f"m = {int(cfg.m)}, ef_construction = {int(cfg.ef_construction)}"
+    else:
+        lists = cfg.lists
+        if lists is None:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT COUNT(*) FROM {TABLE} WHERE {COLUMN} IS NOT NULL;")
+                lists = _default_lists(cur.fetchone()[0])
+            conn.commit()
+        options = f"lists = {int(lists)}"
+
+    # Build under a temporary name and swap, so searches keep an index throughout.
+    # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction block.
+    building = f"{name}_new"
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT set_config('maintenance_work_mem', %s, false);", (cfg.maintenance_work_mem,))
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {building};")
+            cur.execute(
+                f"CREATE INDEX CONCURRENTLY {building} ON {TABLE} "
+                f"USING {cfg.method} ({COLUMN} {opclass}) WITH ({options});"
+            )
+            for old in INDEX_NAMES.values():
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {old};")
+            cur.execute(f"ALTER INDEX {building} RENAME TO {name};")
+            cur.execute(f"ANALYZE {TABLE};")
+    finally:
+        conn.autocommit = autocommit
+    LOG.info("built %s (%s)", name, options)
+    return name
+
+
+def _apply_search_knobs(cur, k: int, ef_search: Optional[int], probes: Optional[int]) -> None:
+    # Transaction-local, so pooled connections go back with the server defaults.
+    # HNSW returns at most ef_search rows, so never let it drop below k (even by default).
+    ef = max(int(ef_search) if ef_search is not None else DEFAULT_EF_SEARCH, k)
+    cur.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(ef),))
+    if probes is not None:
+        cur.execute("SELECT set_config('ivfflat.probes', %s, true);", (str(int(probes)),))
+
+
+def _index_scans(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    found = []
+    if plan.get("Node Type") in ("Index Scan", "Index Only Scan", "Bitmap Index Scan"):
+        found.append({"node": plan["Node Type"], "index": plan.get("Index Name")})
+    for child in plan.get("Plans") or []:
+        found.extend(_index_scans(child))
+    return found
+
+
+def plan_info(cur, params: Dict[str, Any]) -> Dict[str, Any]:
+    cur.execute("EXPLAIN (FORMAT JSON) " + KNN_SQL, params)
+    raw = cur.fetchone()[0]
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+    ann = [s for s in _index_scans(plan) if s["index"] in INDEX_NAMES.values()]
+    return {
+        "index_used": bool(ann),
+        "index_name": ann[0]["index"] if ann else None,
+        "top_node": plan.get("Node Type"),
+        "estimated_cost": plan.get("Total Cost"),
+    }
+
+
+def knn_search(
+    conn,
+    vector: List[float],
+    k: int,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+    explain: bool = False,
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Run the k-NN query; with ``explain`` also report whether the ANN index served it."""
+    params = {"vector": vector_literal(vector), "k": k}
+    info = None
+    with conn.cursor() as cur:
+        _apply_search_knobs(cur, k, ef_search, probes)
+        if explain:
+            info = plan_info(cur, params)
+            info.update({"ef_search": max(ef_search or DEFAULT_EF_SEARCH, k), "probes": probes})
+        cur.execute(KNN_SQL, params)
+        rows = cur.fetchall()
+    results = [{"id": r[0], "summary": r[1], "similarity": r[2]} for r in rows]
+    return results, info
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Type the patient embedding column and build its ANN index.")
+    parser.add_argument("--provider", default="qwen", choices=sorted(PROVIDER_DIMENSIONS))
+    parser.add_argument("--method", default=IndexConfig.method, choices=sorted(INDEX_NAMES))
+    parser.add_argument("--m", type=int, default=IndexConfig.m)
+    parser.add_argument("--ef-construction", type=int, default=IndexConfig.ef_construction)
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument("--maintenance-work-mem", default=IndexConfig.maintenance_work_mem)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    cfg = IndexConfig(
+        method=args.method,
+        m=args.m,
+        ef_construction=args.ef_construction,
+        lists=args.lists,
+        maintenance_work_mem=args.maintenance_work_mem,
+    )
+    conn = get_db_conn()
+    try:
+        if ensure_vector_column(conn, args.provider):
+            LOG.info("column typed as vector(%d); run workers.embedding_backfill to fill cleared rows",
+                     PROVIDER_DIMENSIONS[args.provider])
+        build_index(conn, cfg)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+# workers/embedding_backfill.py
+"""
+Backfill and incremental re-embedding for patients.patient_case_embedding.
+
+A row needs embedding when its summary has no vector yet, when the summary changed
+since it was embedded (md5 mismatch) or when it was embedded by another model.
+
+    python -m workers.embedding_backfill               # embed stale rows, resuming from the checkpoint
+    python -m workers.embedding_backfill --restart     # ignore the saved checkpoint
+    python -m workers.embedding_backfill --follow      # then LISTEN for summary changes
+
+Rows are streamed through a server-side cursor, embedded in token-aware batches and
+written back with one multi-row UPDATE per batch, so memory stays flat on any table size.
+"""
+
+from __future__ import annotations
+
+import time
+import select
+import hashlib
+import logging
+import argparse
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+from psycopg2.extras import execute_values
+
+from db import get_db_conn, get_pool, vector_literal
+from tools.rag_tool import RAGKernel
+
+LOG = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "patient_case_changed"
+
+STALE_PREDICATE = """
+    patient_case_summary IS NOT NULL
+    AND (
+        patient_case_embedding IS NULL
+        OR patient_case_embedded_hash IS DISTINCT FROM md5(patient_case_summary)
+        OR patient_case_embedding_model IS DISTINCT FROM %(model)s
+    )
+"""
+
+UPDATE_SQL = """
+    UPDATE patients AS p
+    SET patient_case_embedding = v.embedding::vector,
+        patient_case_embedded_hash = v.hash,
+        patient_case_embedding_model = v.model
+    FROM (VALUES %s) AS v(id, embedding, hash, model)
+    WHERE p.id = v.id
+      AND md5(p.patient_case_summary) = v.hash
+"""
+
+Row = Tuple[int, str]
+
+
+@dataclass(frozen=True)
+class BackfillConfig:
+    job: str = "patient_case_embedding"
+    provider: str = "qwen"
+    batch_size: int = 64
+    fetch_size: int = 2000
+    # Follow mode: flush a partial batch this long after its oldest change arrived.
+    debounce_seconds: float = 1.0
+    # Follow mode: rescan for stale rows this often in case a notification was missed.
+    sweep_interval: float = 300.0
+
+
+class PatientEmbeddingBackfill:
+    def __init__(self, cfg: Optional[BackfillConfig] = None, kernel: Optional[RAGKernel] = None):
+        self.cfg = cfg or BackfillConfig()
+        self.kernel = kernel or RAGKernel(provider=self.cfg.provider)
+
+    @property
+    def _params(self):
+        return {"model": self.kernel.model_tag}
+
+    # ---- checkpoints -------------------------------------------------
+
+    def load_checkpoint(self) -> int:
+        with get_pool().connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT last_id FROM embedding_backfill_checkpoints WHERE job = %s;", (self.cfg.job,))
+            row = cur.fetchone()
+        return row[0] if row else 0
+
+    def _save_checkpoint(self, cur, last_id: int, rows: int) -> None:
+        cur.execute(
+            """
+            INSERT INTO embedding_backfill_checkpoints (job, last_id, rows_done, updated_at)
+            VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (job) DO UPDATE
+            SET last_id = EXCLUDED.last_id,
+                rows_done = embedding_backfill_checkpoints.rows_done + EXCLUDED.rows_done,
+                updated_at = EXCLUDED.updated_at;
+            """,
+            (self.cfg.job, last_id, rows),
+        )
+
+    def reset_checkpoint(self) -> None:
+        with get_pool().connection() as conn, conn.cursor() as cur:
+            self._save_checkpoint(cur, 0, 0)
+
+    # ---- embedding + write-back -------------------------------------
+
+    def _write(self, batch: Sequence[Row], checkpoint: bool) -> int:
+        texts = [summary for _, summary in batch]
+        vectors = self.kernel.encoder.encode_many(texts)
+        values = [
+            (row_id, vector_literal(vec), hashlib.md5(summary.encode("utf-8")).hexdigest(), self.kernel.model_tag)
+            for (row_id, summary), vec in zip(batch, vectors)
+        ]
+        with get_pool().connection() as conn, conn.cursor() as cur:
+            execute_values(cur, UPDATE_SQL, values, template="(%s, %s, %s, %s)", page_size=len(values))
+            updated = cur.rowcount
+            if checkpoint:
+                self._save_checkpoint(cur, batch[-1][0], updated)
+        return updated
+
+    def run(self, restart: bool = False) -> int:
+        """Embed every stale row once; returns the number of rows written."""
+        last_id = 0 if restart else self.load_checkpoint()
+        if last_id:
+            LOG.info("resuming %s after id %d", self.cfg.job, last_id)
+
+        done = 0
+        started = time.monotonic()
+        # Dedicated connection: the named cursor lives in its own read transaction
+        # while writes commit batch by batch on pooled connections.
+        read_conn = get_db_conn()
+        try:
+            with read_conn.cursor(name=f"{self.cfg.job}_scan") as cur:
+                cur.itersize = self.cfg.fetch_size
+                cur.execute(
+                    f"SELECT id, patient_case_summary FROM patients "
+                    f"WHERE id > %(last_id)s AND {STALE_PREDICATE} ORDER BY id;",
+                    {**self._params, "last_id": last_id},
+                )
+                batch: List[Row] = []
+                for row in cur:
+                    batch.append(row)
+                    if len(batch) >= self.cfg.batch_size:
+                        done += self._write(batch, checkpoint=True)
+                        batch = []
+                        LOG.info("%s: %d rows embedded (%.1f rows/s)", self.cfg.job, done,
+                                 done / max(time.monotonic() - started, 1e-9))
+                if batch:
+                    done += self._write(batch, checkpoint=True)
+        finally:
+            read_conn.close()
+
+        # Scan finished: the next run starts from the beginning again.
+        self.reset_checkpoint()
+        LOG.info("%s complete: %d rows embedded in %.1fs", self.cfg.job, done, time.monotonic() - started)
+        return done
+
+    def embed_ids(self, ids: Sequence[int]) -> int:
+        """Re-embed specific rows, skipping any that are already up to date."""
+        with get_pool().connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                f"SELECT id, patient_case_summary FROM patients "
+                f"WHERE id = ANY(%(ids)s) AND {STALE_PREDICATE} ORDER BY id;",
+                {**self._params, "ids": list(ids)},
+            )
+            rows = cur.fetchall()
+        done = 0
+        for start in range(0, len(rows), self.cfg.batch_size):
+            done += self._write(rows[start:start + self.cfg.batch_size], checkpoint=False)
+        return done
+
+    # ---- incremental mode --------------------------------------------
+
+    def follow(self) -> None:
+        """LISTEN for summary changes and re-embed them in debounced batches."""
+        conn = get_db_conn()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {NOTIFY_CHANNEL};")
+        LOG.info("listening on %s", NOTIFY_CHANNEL)
+
+        pending = set()
+        oldest = 0.0  # when the oldest pending id arrived
+        last_sweep = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                # Wake for whichever comes first: the oldest pending id's debounce
+                # deadline or the next sweep. A steady stream of notifications never
+                # postpones either.
+                deadline = last_sweep + self.cfg.sweep_interval
+                if pending:
+                    deadline = min(deadline, oldest + self.cfg.debounce_seconds)
+                if select.select([conn], [], [], max(0.0, min(deadline - now, 5.0)))[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        note = conn.notifies.pop(0)
+                        try:
+                            row_id = int(note.payload)
+                        except ValueError:
+                            LOG.warning("ignoring notification payload %r", note.payload)
+                            continue
+                        if not pending:
+                            oldest = time.monotonic()
+                        pending.add(row_id)
+
+                now = time.monotonic()
+                if pending and (len(pending) >= self.cfg.batch_size or now - oldest >= self.cfg.debounce_seconds):
+                    ids, pending = sorted(pending), set()
+                    try:
+                        LOG.info("re-embedded %d of %d changed rows", self.embed_ids(ids), len(ids))
+                    except Exception:
+                        # e.g. TEI briefly down: the rows stay stale, so the next sweep picks them up.
+                        LOG.exception("re-embedding %d changed rows failed; leaving them to the next sweep", len(ids))
+
+                if now - last_sweep >= self.cfg.sweep_interval:
+                    try:
+                        self.run()
+                    except Exception:
+                        # The checkpoint keeps the progress made; the next sweep resumes from it.
+                        LOG.exception("sweep failed; retrying in %.0fs", self.cfg.sweep_interval)
+                    last_sweep = time.monotonic()
+        finally:
+            conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Embed patient case summaries into patients.patient_case_embedding.")
+    parser.add_argument("--provider", default=BackfillConfig.provider, choices=["qwen", "openai"])
+    parser.add_argument("--batch-size", type=int, default=BackfillConfig.batch_size)
+    parser.add_argument("--fetch-size", type=int, default=BackfillConfig.fetch_size)
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    parser.add_argument("--follow", action="store_true", help="keep running and re-embed rows as summaries change")
+    parser.add_argument("--sweep-interval", type=float, default=BackfillConfig.sweep_interval)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    cfg = BackfillConfig(
+        job=f"patient_case_embedding:{args.provider}",
+        provider=args.provider,
+        batch_size=args.batch_size,
+        fetch_size=args.fetch_size,
+        sweep_interval=args.sweep_interval,
+    )
+    worker = PatientEmbeddingBackfill(cfg)
+    try:
+        worker.run(restart=args.restart)
+        if args.follow:
+            worker.follow()
+    except KeyboardInterrupt:
+        LOG.info("interrupted; progress is checkpointed")
+
+
+if __name__ == "__main__":
+    main()
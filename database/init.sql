@@ -12,7 +12,7 @@ CREATE TABLE IF NOT EXISTS patients (
     phone TEXT,
     email TEXT,
     patient_case_summary TEXT,
-    patient_case_embedding vector,
+    patient_case_embedding vector(1024),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -457,3 +457,179 @@ SELECT setval('patients_id_seq',                (SELECT MAX(id) FROM patients));
 SELECT setval('medications_id_seq',            (SELECT MAX(id) FROM medications));
 SELECT setval('prescriptions_id_seq',         (SELECT MAX(id) FROM prescriptions));
 SELECT setval('prescription_medications_id_seq',(SELECT MAX(id) FROM prescription_medications));
+
+-- ============================================================
+-- 8. Embedding bookkeeping for the patient-case backfill worker
+--    (idempotent: safe to re-run against an existing database)
+-- ============================================================
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS patient_case_embedding_model TEXT;
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS patient_case_embedded_hash TEXT;
+
+CREATE INDEX IF NOT EXISTS patients_updated_at_idx ON patients (updated_at, id);
+
+-- Keep updated_at current on every row change.
+CREATE OR REPLACE FUNCTION patients_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS patients_touch_updated_at ON patients;
+CREATE TRIGGER patients_touch_updated_at
+    BEFORE UPDATE ON patients
+    FOR EACH ROW EXECUTE FUNCTION patients_touch_updated_at();
+
+-- Tell listening workers which patient summaries need (re-)embedding.
+CREATE OR REPLACE FUNCTION patients_notify_case_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' OR NEW.patient_case_summary IS DISTINCT FROM OLD.patient_case_summary THEN
+        PERFORM pg_notify('patient_case_changed', NEW.id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS patients_notify_case_changed ON patients;
+CREATE TRIGGER patients_notify_case_changed
+    AFTER INSERT OR UPDATE OF patient_case_summary ON patients
+    FOR EACH ROW EXECUTE FUNCTION patients_notify_case_changed();
+
+-- Resume points for backfill jobs.
+CREATE TABLE IF NOT EXISTS embedding_backfill_checkpoints (
+    job TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    rows_done BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- ============================================================
+-- 9. ANN index for patient semantic search
+--    Inner-product opclass to match the `<#>` ordering used by the search tools.
+--    Rebuild / switch to IVFFlat with: python -m vector_index --method ivfflat
+-- ============================================================
+CREATE INDEX IF NOT EXISTS patients_case_embedding_hnsw
+    ON patients USING hnsw (patient_case_embedding vector_ip_ops)
+    WITH (m = 16, ef_construction = 64);
+
+
+-- ============================================================
+-- 10. Per-table change versions for result caches
+--     Every writing statement appends a row to table_version_log in the
+--     writer's transaction, so a table's version
+--         table_versions.version + count(its table_version_log rows)
+--     changes exactly when the write becomes visible. Appending takes no
+--     shared row lock, so concurrent writers never wait for each other.
+--     Now and then a writer folds the log into table_versions; readers see
+--     the fold atomically, so the sum does not move.
+--     (idempotent: safe to re-run)
+-- ============================================================
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS table_version_log (
+    id BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS table_version_log_table_name_idx ON table_version_log (table_name);
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+DECLARE
+    entry BIGINT;
+BEGIN
+    INSERT INTO table_version_log (table_name) VALUES (TG_TABLE_NAME) RETURNING id INTO entry;
+    -- Fold every 256th entry. Only a READ COMMITTED writer that gets the advisory
+    -- lock folds (a REPEATABLE READ one could hit a serialization error), and it
+    -- locks the table_versions row only the other folders would touch.
+    IF entry % 256 = 0
+       AND current_setting('transaction_isolation') = 'read committed'
+       AND pg_try_advisory_xact_lock(hashtext('table_versions:' || TG_TABLE_NAME)) THEN
+        WITH folded AS (
+            DELETE FROM table_version_log WHERE table_name = TG_TABLE_NAME RETURNING 1
+        )
+        UPDATE table_versions
+        SET version = version + (SELECT count(*) FROM folded), updated_at = CURRENT_TIMESTAMP
+        WHERE table_name = TG_TABLE_NAME;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['patients', 'prescriptions', 'medications', 'prescription_medications'] LOOP
+        INSERT INTO table_versions (table_name) VALUES (t) ON CONFLICT DO NOTHING;
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_bump_version', t);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I '
+            'FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()',
+            t || '_bump_version', t
+        );
+    END LOOP;
+END;
+$$;
+
+-- ============================================================
+-- 11. Schema version for the NL2SQL schema catalog
+--     Bumped after DDL that creates, alters or drops a permanent object in
+--     the catalogued schema (schema_version.schema_name, the catalog's
+--     SCHEMA_CATALOG_SCHEMA), so the cached catalog
+--     (backend/utils/schema_catalog.py) is rebuilt only when that schema
+--     changed. Temporary tables and other schemas leave the version (and
+--     its row lock) alone, which also keeps CREATE TEMP TABLE working in
+--     READ ONLY transactions. Event triggers need a superuser; without one
+--     the catalog falls back to hashing pg_catalog. (idempotent: safe to re-run)
+-- ============================================================
+CREATE TABLE IF NOT EXISTS schema_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE schema_version ADD COLUMN IF NOT EXISTS schema_name TEXT NOT NULL DEFAULT 'public';
+
+INSERT INTO schema_version (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+-- SECURITY DEFINER: DDL run by any role must be able to bump the version.
+CREATE OR REPLACE FUNCTION bump_schema_version() RETURNS event_trigger AS $$
+BEGIN
+    -- Temporary objects report schema pg_temp, so they never match.
+    IF EXISTS (
+        SELECT 1 FROM pg_event_trigger_ddl_commands() c JOIN schema_version v ON c.schema_name = v.schema_name
+    ) THEN
+        UPDATE schema_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP;
+    END IF;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- DROP is not reported by pg_event_trigger_ddl_commands(); sql_drop lists what went.
+CREATE OR REPLACE FUNCTION bump_schema_version_on_drop() RETURNS event_trigger AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_event_trigger_dropped_objects() d JOIN schema_version v ON d.schema_name = v.schema_name
+        WHERE NOT d.is_temporary
+    ) THEN
+        UPDATE schema_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP;
+    END IF;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+DO $$
+BEGIN
+    DROP EVENT TRIGGER IF EXISTS bump_schema_version;
+    CREATE EVENT TRIGGER bump_schema_version ON ddl_command_end
+        EXECUTE FUNCTION bump_schema_version();
+    DROP EVENT TRIGGER IF EXISTS bump_schema_version_on_drop;
+    CREATE EVENT TRIGGER bump_schema_version_on_drop ON sql_drop
+        EXECUTE FUNCTION bump_schema_version_on_drop();
+EXCEPTION WHEN insufficient_privilege THEN
+    RAISE NOTICE 'bump_schema_version event trigger not installed (needs superuser)';
+END;
+$$;